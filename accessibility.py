@@ -0,0 +1,163 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Functions related to accessibility measures: number (or weight) of POIs reachable from each residential node within
+# travel time thresholds, aggregated straight from bounded shortest path searches (no O-D paths stored)
+
+# IMPORTS
+import csv
+import io
+import logging
+import numpy as np
+import networkx as nx
+from scipy.sparse.csgraph import dijkstra
+from csr_graph import CSRGraph
+from instrumentation import METRICS
+from util import db_connection, db_raw_connection, read_sql
+
+logger = logging.getLogger(__name__)
+
+
+# FUNCTIONS
+def get_accessibility_nodes(dbparams, nodes_schema, nodes_table, poi_schema=None, poi_table=None, weight_col=None):
+    """
+    Return the origin (res) nodes and the POI nodes with their weights. Without a POI table every poi node of the nodes
+    table counts once; with a POI table (e.g. esco.sg_poi) each node counts the POIs snapped to it (node_closest), or
+    the sum of their weight_col values.
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param nodes_schema: String containing database schema name of the nodes table
+    :param nodes_table: String containing database table name of the nodes table (nodeid, res, poi)
+    :param poi_schema: (optional) String containing database schema name of the POI table
+    :param poi_table: (optional) String containing database table name of the POI table (node_closest)
+    :param weight_col: (optional) String containing name of a numeric POI column to sum instead of counting POIs
+    :return: 3 numpy arrays: origin node IDs, POI node IDs (int64, sorted), and POI weights (float64)
+    """
+    # SQL to return res nodes
+    sql_orig = "SELECT nodeid::BIGINT AS nodeid from {}.{} WHERE res = 1 ORDER by nodeid;".format(nodes_schema, nodes_table)
+    # SQL to return poi nodes and weights
+    if poi_table is None:
+        sql_poi = "SELECT nodeid::BIGINT AS nodeid, 1::FLOAT8 AS weight from {}.{} WHERE poi = 1 ORDER by nodeid;".format(nodes_schema, nodes_table)
+    else:
+        weight_str = "sum({})".format(weight_col) if weight_col is not None else "count(*)"
+        sql_poi = "SELECT node_closest::BIGINT AS nodeid, {}::FLOAT8 AS weight from {}.{} WHERE node_closest IS NOT NULL GROUP BY node_closest ORDER by node_closest;".format(
+            weight_str, poi_schema, poi_table)
+
+    # connect to database
+    with db_connection(dbparams) as conn:
+        df_orig = read_sql(sql_orig, conn)
+        df_poi = read_sql(sql_poi, conn)
+
+    return df_orig['nodeid'].to_numpy(dtype=np.int64), df_poi['nodeid'].to_numpy(dtype=np.int64), df_poi['weight'].to_numpy(dtype=np.float64)
+
+
+def _bin_counts(times, weights, thresholds):
+    """
+    Sum POI weights into cumulative travel time threshold bins for a block of origins (one vectorized pass)
+    :param times: Numpy array (origins x POIs) of travel times, inf if unreachable
+    :param weights: Numpy array of POI weights
+    :param thresholds: Sorted numpy array of thresholds in seconds
+    :return: Numpy float64 array (origins x thresholds), weight of the POIs reached within each threshold
+    """
+    n_rows, n_bins = times.shape[0], len(thresholds) + 1
+    # bin k: thresholds[k-1] < time <= thresholds[k], last bin: beyond the largest threshold
+    bins = np.searchsorted(thresholds, times, side='left')
+    keys = (np.arange(n_rows)[:, None] * n_bins + bins).ravel()
+    sums = np.bincount(keys, weights=np.broadcast_to(weights, times.shape).ravel(), minlength=n_rows * n_bins)
+    return np.cumsum(sums.reshape(n_rows, n_bins), axis=1)[:, :-1]
+
+
+def compute_accessibility(graph, origins, pois, col_cost, thresholds=(300, 600, 900, 1800), weights=None, chunk_size=256):
+    """
+    Count (or weigh) the POI nodes reachable from each origin node within each travel time threshold. Each origin runs
+    one search bounded by the largest threshold.
+    :param graph: NetworkX graph object (create_networkx_object()) or CSRGraph object (create_csr_graph())
+    :param origins: Array of origin node IDs (get_accessibility_nodes())
+    :param pois: Array of POI node IDs
+    :param col_cost: String containing name of weight column ('time_drive_sec' or 'time_walk_sec')
+    :param thresholds: (optional) Travel time thresholds in seconds (default: 5, 10, 15, and 30 minutes)
+    :param weights: (optional) Array of POI weights aligned with pois (default: 1 per POI node)
+    :param chunk_size: (optional) Number of origin nodes searched per csgraph call (CSRGraph only)
+    :return: Numpy float64 array (origins x thresholds), origins not in the graph reach nothing (0)
+    """
+    origins = np.asarray(origins, dtype=np.int64)
+    pois = np.asarray(pois, dtype=np.int64)
+    thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+    weights = np.ones(len(pois)) if weights is None else np.asarray(weights, dtype=np.float64)
+    limit = thresholds[-1]
+    out = np.zeros((len(origins), len(thresholds)))
+
+    # array-backed graph: one bounded csgraph call per chunk of origins
+    if isinstance(graph, CSRGraph):
+        orig_idx = graph.index(origins)
+        poi_idx = graph.index(pois)
+        poi_found = poi_idx >= 0
+        poi_weights = weights[poi_found]
+        matrix = graph.matrix(col_cost)
+        rows = np.flatnonzero(orig_idx >= 0)
+        for c in range(0, len(rows), chunk_size):
+            chunk = rows[c:c + chunk_size]
+            with METRICS.timer('search'):
+                dist = dijkstra(matrix, directed=True, indices=orig_idx[chunk], limit=limit)
+            METRICS.count('searches', len(chunk))
+            METRICS.count('settled_nodes', int(np.isfinite(dist).sum()))
+            out[chunk] = _bin_counts(dist[:, poi_idx[poi_found]], poi_weights, thresholds)
+    # NetworkX graph: one bounded single-source search per origin
+    else:
+        poi_col = {poi: k for k, poi in enumerate(pois.tolist())}
+        rows = [r for r, orig in enumerate(origins.tolist()) if graph.has_node(orig)]
+        for c in range(0, len(rows), chunk_size):
+            chunk = rows[c:c + chunk_size]
+            times = np.full((len(chunk), len(pois)), np.inf)
+            with METRICS.timer('search'):
+                for k, r in enumerate(chunk):
+                    for node, time_sec in nx.single_source_dijkstra_path_length(graph, int(origins[r]), cutoff=limit, weight=col_cost).items():
+                        col = poi_col.get(int(node))
+                        if col is not None:
+                            times[k, col] = time_sec
+            METRICS.count('searches', len(chunk))
+            out[chunk] = _bin_counts(times, weights, thresholds)
+
+    if len(rows) < len(origins):
+        logger.warning('%s origin nodes are not in the graph', len(origins) - len(rows))
+
+    return out
+
+
+def accessibility2dbtable(dbparams, access_schema, access_table, origins, counts, thresholds, name):
+    """
+    Insert or replace per-origin accessibility results (compute_accessibility()) in a Postgres table with one row per
+    origin node and one column per mode and threshold, e.g. node_orig, walk_5min, walk_10min, ..., drive_30min
+    :param dbparams: dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param access_schema: String containing database schema name
+    :param access_table: String containing database table name (created if it does not exist)
+    :param origins: Array of origin node IDs
+    :param counts: Numpy array (origins x thresholds) from compute_accessibility()
+    :param thresholds: Travel time thresholds in seconds (same order as compute_accessibility())
+    :param name: String containing column name prefix ('walk', 'drive')
+    :return: None
+    """
+    columns = ['{}_{:g}min'.format(name, t / 60) for t in sorted(thresholds)]
+
+    # write the results as CSV into an in-memory buffer
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for orig, row in zip(np.asarray(origins).tolist(), counts.tolist()):
+        writer.writerow([orig] + row)
+    n_bytes = buffer.tell()
+    buffer.seek(0)
+
+    # connect to the database
+    with METRICS.timer('db_write'), db_raw_connection(dbparams) as conn:
+        cur = conn.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS {}.{} (node_orig NUMERIC PRIMARY KEY);".format(access_schema, access_table))
+        cur.execute("ALTER TABLE {}.{} {};".format(access_schema, access_table, ', '.join('ADD COLUMN IF NOT EXISTS {} FLOAT8'.format(col) for col in columns)))
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS {}_{}_staging (node_orig NUMERIC, {}) ON COMMIT DROP;".format(
+            access_table, name, ', '.join('{} FLOAT8'.format(col) for col in columns)))
+        cur.copy_expert("COPY {}_{}_staging (node_orig, {}) FROM STDIN WITH (FORMAT csv);".format(access_table, name, ', '.join(columns)), buffer)
+        cur.execute("INSERT INTO {}.{} AS t (node_orig, {}) SELECT node_orig, {} FROM {}_{}_staging ON CONFLICT (node_orig) DO UPDATE SET {};".format(
+            access_schema, access_table, ', '.join(columns), ', '.join(columns), access_table, name,
+            ', '.join('{} = EXCLUDED.{}'.format(col, col) for col in columns)))
+        conn.commit()
+        cur.close()
+    METRICS.count('rows_written', len(counts))
+    METRICS.count('bytes_written', n_bytes)
+
+    return
@@ -0,0 +1,306 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Functions related to benchmarking graph building, routing, and result writing on synthetic networks
+# (no SANDAG data or Postgres needed, SQLite stands in for the database)
+#
+# usage: python benchmark.py --network grid --size 100 --origins 20 --dests 50 --output results.json
+
+# IMPORTS
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from sqlalchemy import create_engine, event
+from contraction_hierarchy import build_contraction_hierarchy
+from csr_graph import CSRGraph
+from network_analysis import create_networkx_object, get_od_routes, find_shortest_route
+
+# synthetic node IDs start here (SANDAG-like 6+ digit IDs)
+FIRST_NODE = 100000
+# speed (mph) and share of edges, 65 mph edges are freeways (not walkable)
+SPEEDS = [25, 35, 45, 65]
+SPEED_SHARES = [0.5, 0.3, 0.15, 0.05]
+
+
+# FUNCTIONS
+def _edge_attributes(fnode, tnode, dist_meters, rng):
+    """
+    Build an esco.edges-shaped dataframe from edge node IDs and lengths (random speeds, drive and walk times)
+    :param fnode: Array of from node IDs
+    :param tnode: Array of to node IDs
+    :param dist_meters: Array of edge lengths in meters
+    :param rng: numpy random Generator
+    :return: Pandas dataframe with edgeid, roadsegid, fnode, tnode, dist_meters, time_drive_sec, time_walk_sec, walk columns
+    """
+    speed = rng.choice(SPEEDS, size=len(fnode), p=SPEED_SHARES)
+    edges = pd.DataFrame({'edgeid': np.arange(1, len(fnode) + 1), 'roadsegid': np.arange(1, len(fnode) + 1),
+                          'fnode': fnode, 'tnode': tnode, 'dist_meters': dist_meters,
+                          'time_drive_sec': dist_meters / (speed * 0.44704),  # same conversion as esco_schema.sql
+                          'time_walk_sec': dist_meters / 1.34112,
+                          'walk': (speed < 65).astype(int)})
+    return edges
+
+
+def make_grid_edges(size, spacing=100, seed=0):
+    """
+    Synthetic road grid of size x size intersections with jittered block lengths
+    :param size: Number of intersections per side
+    :param spacing: (optional) Average block length in meters
+    :param seed: (optional) Random seed
+    :return: Pandas dataframe (see _edge_attributes())
+    """
+    rng = np.random.default_rng(seed)
+    ids = FIRST_NODE + np.arange(size * size).reshape(size, size)
+    fnode = np.concatenate([ids[:, :-1].ravel(), ids[:-1, :].ravel()])
+    tnode = np.concatenate([ids[:, 1:].ravel(), ids[1:, :].ravel()])
+    dist_meters = spacing * rng.uniform(0.8, 1.2, size=len(fnode))
+    return _edge_attributes(fnode, tnode, dist_meters, rng)
+
+
+def make_geometric_edges(n_nodes, degree=6, spacing=100, seed=0):
+    """
+    Synthetic random geometric network: nodes scattered uniformly, edges between nodes closer than a radius chosen for
+    the requested average degree
+    :param n_nodes: Number of nodes
+    :param degree: (optional) Average node degree
+    :param spacing: (optional) Average distance between neighboring nodes in meters
+    :param seed: (optional) Random seed
+    :return: Pandas dataframe (see _edge_attributes())
+    """
+    rng = np.random.default_rng(seed)
+    side = spacing * np.sqrt(n_nodes)
+    xy = rng.uniform(0, side, size=(n_nodes, 2))
+    radius = side * np.sqrt(degree / (np.pi * n_nodes))
+    pairs = cKDTree(xy).query_pairs(radius, output_type='ndarray')
+    dist_meters = np.linalg.norm(xy[pairs[:, 0]] - xy[pairs[:, 1]], axis=1)
+    return _edge_attributes(FIRST_NODE + pairs[:, 0], FIRST_NODE + pairs[:, 1], dist_meters, rng)
+
+
+def make_od_frame(edges, n_origins, n_dests, seed=0):
+    """
+    Synthetic esco.od_routes-shaped frame: every pair of randomly drawn origin and destination nodes
+    :param edges: Pandas dataframe of edges (make_grid_edges(), make_geometric_edges())
+    :param n_origins: Number of origin nodes
+    :param n_dests: Number of destination nodes
+    :param seed: (optional) Random seed
+    :return: Pandas dataframe with routeid, node_orig, node_dest, and walk columns
+    """
+    rng = np.random.default_rng(seed)
+    nodes = np.unique(np.concatenate([edges['fnode'].to_numpy(), edges['tnode'].to_numpy()]))
+    origs = rng.choice(nodes, size=min(n_origins, len(nodes)), replace=False)
+    dests = rng.choice(nodes, size=min(n_dests, len(nodes)), replace=False)
+    od = pd.DataFrame({'node_orig': np.repeat(origs, len(dests)), 'node_dest': np.tile(dests, len(origs))})
+    od = od[od['node_orig'] != od['node_dest']].reset_index(drop=True)
+    od.insert(0, 'routeid', np.arange(1, len(od) + 1))
+    od['walk'] = 1
+    return od
+
+
+def sqlite_engine(db_dir):
+    """
+    SQLAlchemy engine for a SQLite stand-in database with an attached 'esco' schema
+    :param db_dir: String containing path to the database directory
+    :return: SQLAlchemy engine
+    """
+    engine = create_engine('sqlite:///{}'.format(os.path.join(db_dir, 'main.db')))
+
+    @event.listens_for(engine, 'connect')
+    def attach_schema(dbapi_conn, connection_record):
+        dbapi_conn.execute("ATTACH DATABASE '{}' AS esco".format(os.path.join(db_dir, 'esco.db')))
+
+    return engine
+
+
+def load_sqlite(db_dir, edges, od):
+    """
+    Write the synthetic edges and O-D frame to esco.edges and esco.od_routes (with empty walk path/time columns), on a
+    sqlite3 connection to the esco database file (pandas.to_sql() takes DBAPI connections for SQLite only)
+    :param db_dir: String containing path to the database directory (sqlite_engine())
+    :param edges: Pandas dataframe of edges
+    :param od: Pandas dataframe of O-D routes
+    :return: None
+    """
+    conn = sqlite3.connect(os.path.join(db_dir, 'esco.db'))
+    try:
+        edges.to_sql('edges', conn, if_exists='replace', index=False)
+        od.assign(walk_path=None, walk_time_sec=None).to_sql('od_routes', conn, if_exists='replace', index=False)
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS od_routes_pk ON od_routes (routeid);")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def write_update(db_path, paths_list):
+    """
+    SQLite version of routes2dbtable(): one UPDATE per route (executemany)
+    :param db_path: String containing path to the SQLite database file holding od_routes
+    :param paths_list: List with routeids, paths, and travel times (find_shortest_route())
+    :return: None
+    """
+    conn = sqlite3.connect(db_path)
+    conn.executemany("UPDATE od_routes SET walk_path = ?, walk_time_sec = ? WHERE routeid = ?;",
+                     [(row['walk_path'], row['walk_time_sec'], int(row['b_routeid'])) for row in paths_list])
+    conn.commit()
+    conn.close()
+
+
+def write_staging(db_path, paths_list):
+    """
+    SQLite version of routes2dbtable_copy(): bulk insert into a TEMP staging table + one UPDATE ... FROM
+    :param db_path: String containing path to the SQLite database file holding od_routes
+    :param paths_list: List with routeids, paths, and travel times (find_shortest_route())
+    :return: None
+    """
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TEMP TABLE staging (routeid INTEGER PRIMARY KEY, path TEXT, time_sec INTEGER);")
+    conn.executemany("INSERT INTO staging VALUES (?, ?, ?);",
+                     [(int(row['b_routeid']), row['walk_path'], row['walk_time_sec']) for row in paths_list])
+    conn.execute("UPDATE od_routes SET walk_path = s.path, walk_time_sec = s.time_sec FROM staging AS s WHERE od_routes.routeid = s.routeid;")
+    conn.commit()
+    conn.close()
+
+
+def measure(fn, memory=True):
+    """
+    Time one call of a function and, optionally, measure its peak Python memory in a second (traced) call
+    :param fn: Function without arguments
+    :param memory: (optional) Boolean, if True - run fn again under tracemalloc
+    :return: Tuple (result of the timed call, seconds, peak bytes or None)
+    """
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return result, seconds, peak
+
+
+def run_benchmarks(network='grid', size=100, n_origins=20, n_dests=50, methods=('pairwise', 'by_origin', 'csr'), memory=True, seed=0):
+    """
+    Run the graph build, routing, and write benchmarks on one synthetic network
+    :param network: (optional) 'grid' (size x size intersections) or 'geometric' (size * size random nodes)
+    :param size: (optional) Network size (see network)
+    :param n_origins: (optional) Number of O-D origin nodes
+    :param n_dests: (optional) Number of O-D destination nodes
+    :param methods: (optional) Routing methods: 'pairwise' (one search per route), 'by_origin' (one search per origin,
+        NetworkX), 'csr' (CSRGraph and scipy.sparse.csgraph), 'ch' (contraction hierarchy preprocessing and
+        many-to-many travel times of the O-D origins x destinations, no paths)
+    :param memory: (optional) Boolean, if True - measure peak memory of every step
+    :param seed: (optional) Random seed
+    :return: Dictionary of results (JSON serializable)
+    """
+    if network == 'grid':
+        edges = make_grid_edges(size, seed=seed)
+    elif network == 'geometric':
+        edges = make_geometric_edges(size * size, seed=seed)
+    else:
+        raise ValueError("Unknown network '{}'".format(network))
+    od = make_od_frame(edges, n_origins, n_dests, seed=seed)
+
+    results = []
+
+    def record(step, seconds, peak, items=None, unit=None):
+        entry = {'step': step, 'seconds': round(seconds, 6), 'peak_bytes': peak}
+        if items is not None:
+            entry[unit] = items
+            entry['{}_per_sec'.format(unit)] = round(items / seconds, 2) if seconds > 0 else None
+        results.append(entry)
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        load_sqlite(db_dir, edges, od)
+        engine = sqlite_engine(db_dir)
+        walk_edges = edges[edges['walk'] == 1]
+
+        # graph build (database read included for the NetworkX graph, as in main.py)
+        graph, seconds, peak = measure(lambda: create_networkx_object(engine, 'esco', 'edges', walk=True), memory)
+        record('build_networkx', seconds, peak, len(walk_edges), 'edges')
+        costs = {col: walk_edges[col].to_numpy() for col in ['dist_meters', 'time_drive_sec', 'time_walk_sec']}
+        csr_graph, seconds, peak = measure(lambda: CSRGraph.from_edges(walk_edges['fnode'].to_numpy(), walk_edges['tnode'].to_numpy(), costs), memory)
+        record('build_csr', seconds, peak, len(walk_edges), 'edges')
+
+        # O-D read
+        routes_df, seconds, peak = measure(lambda: get_od_routes(engine, 'esco', 'od_routes', walk=True), memory)
+        record('read_od', seconds, peak, len(routes_df), 'routes')
+
+        # routing
+        paths = None
+        for method in methods:
+            # contraction hierarchy: preprocessing, then one bucket query for all O-D pairs (times only)
+            if method == 'ch':
+                ch, seconds, peak = measure(lambda: build_contraction_hierarchy(csr_graph, 'time_walk_sec'), memory)
+                record('build_ch', seconds, peak, csr_graph.number_of_nodes(), 'nodes')
+                results[-1]['arcs'] = len(ch.fwd[1]) + len(ch.bwd[1])
+                origs, dests = routes_df['node_orig'].unique(), routes_df['node_dest'].unique()
+                _, seconds, peak = measure(lambda: ch.many_to_many(origs, dests), memory)
+                record('route_ch', seconds, peak, len(routes_df), 'routes')
+                continue
+            route_graph = csr_graph if method == 'csr' else graph
+            by_origin = method != 'pairwise'
+            (p, e), seconds, peak = measure(lambda: find_shortest_route(route_graph, routes_df, 'routeid', 'node_orig', 'node_dest', 'time_walk_sec', walk=True, by_origin=by_origin), memory)
+            record('route_{}'.format(method), seconds, peak, len(routes_df), 'routes')
+            results[-1]['errors'] = len(e)
+            paths = p
+
+        # writing (SQLite stand-ins for the per-row UPDATE and the staging table + UPDATE ... FROM writers)
+        if paths is not None:
+            db_path = os.path.join(db_dir, 'esco.db')
+            for name, writer in [('write_update', write_update), ('write_staging', write_staging)]:
+                _, seconds, peak = measure(lambda: writer(db_path, paths), memory)
+                record(name, seconds, peak, len(paths), 'routes')
+                results[-1]['bytes'] = sum(len(str(row['walk_path'])) + 8 for row in paths)
+
+        engine.dispose()
+
+    return {'network': network, 'size': size, 'nodes': csr_graph.number_of_nodes(), 'edges': csr_graph.number_of_edges(),
+            'routes': len(od), 'seed': seed, 'results': results}
+
+
+def _git_revision():
+    """
+    Current git commit of the repository (to label benchmark results), None outside a git checkout
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark graph building, routing, and result writing on synthetic networks.')
+    parser.add_argument('--network', choices=['grid', 'geometric'], default='grid', help='synthetic network type')
+    parser.add_argument('--size', type=int, default=100, help='grid side (geometric networks get size * size nodes)')
+    parser.add_argument('--origins', type=int, default=20, help='number of O-D origin nodes')
+    parser.add_argument('--dests', type=int, default=50, help='number of O-D destination nodes')
+    parser.add_argument('--methods', nargs='+', choices=['pairwise', 'by_origin', 'csr', 'ch'], default=['pairwise', 'by_origin', 'csr'],
+                        help='routing methods to benchmark')
+    parser.add_argument('--no-memory', action='store_true', help='skip the (slower) peak memory measurements')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--output', help='JSON output file (default: print to stdout)')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.network, args.size, args.origins, args.dests, args.methods, not args.no_memory, args.seed)
+    report.update({'revision': _git_revision(), 'python': platform.python_version(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')})
+
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Functions related to contraction hierarchy preprocessing and many-to-many (bucket) travel time queries
+
+# IMPORTS
+import heapq
+import math
+import os
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from csr_graph import CSRGraph
+
+
+# FUNCTIONS
+def _graph_arcs(graph, col_cost):
+    """
+    List the arcs of a NetworkX graph object or CSRGraph object
+    :param graph: NetworkX graph object (create_networkx_object()) or CSRGraph object (create_csr_graph())
+    :param col_cost: String containing name of weight column ('time_drive_sec' or 'time_walk_sec')
+    :return: Sorted numpy int64 array of node IDs and a list of (from index, to index, weight) arcs
+    """
+    if isinstance(graph, CSRGraph):
+        node_ids = np.asarray(graph.node_ids, dtype=np.int64)
+        src = np.repeat(np.arange(len(node_ids)), np.diff(graph.indptr))
+        arcs = list(zip(src.tolist(), graph.indices.tolist(), graph.costs[col_cost].tolist()))
+        return node_ids, arcs
+
+    node_ids = np.array(sorted(int(node) for node in graph.nodes), dtype=np.int64)
+    index = {node: k for k, node in enumerate(node_ids.tolist())}
+    arcs = []
+    for u, v, w in graph.edges(data=col_cost):
+        arcs.append((index[int(u)], index[int(v)], float(w)))
+        # undirected edges can be traversed both ways
+        if not graph.is_directed():
+            arcs.append((index[int(v)], index[int(u)], float(w)))
+    return node_ids, arcs
+
+
+def _witness_search(out_arcs, source, skip, max_cost, settle_limit, targets):
+    """
+    Bounded Dijkstra search on the remaining (not yet contracted) graph, ignoring the node being contracted
+    :param out_arcs: List of dictionaries {to index: weight} per node
+    :param source: Index of the source node
+    :param skip: Index of the node being contracted
+    :param max_cost: Stop once the frontier passes this cost
+    :param settle_limit: Stop after this many settled nodes
+    :param targets: Set of node indices, stop once all of them are settled
+    :return: Dictionary {node index: distance} of settled nodes
+    """
+    dist = {source: 0.0}
+    settled = {}
+    heap = [(0.0, source)]
+    remaining = len(targets)
+    while heap and len(settled) < settle_limit and remaining > 0:
+        d, u = heapq.heappop(heap)
+        if u in settled:
+            continue
+        if d > max_cost:
+            break
+        settled[u] = d
+        if u in targets:
+            remaining -= 1
+        for v, w in out_arcs[u].items():
+            if v == skip:
+                continue
+            nd = d + w
+            if nd < dist.get(v, float('inf')):
+                dist[v] = nd
+                heapq.heappush(heap, (nd, v))
+    return settled
+
+
+def _shortcuts(out_arcs, in_arcs, v, settle_limit):
+    """
+    Shortcuts needed to contract node v (pairs u -> v -> x without a witness path of equal or lower cost)
+    :param out_arcs: List of dictionaries {to index: weight} per node (remaining graph)
+    :param in_arcs: List of dictionaries {from index: weight} per node (remaining graph)
+    :param v: Index of the node to contract
+    :param settle_limit: Maximum number of settled nodes per witness search
+    :return: List of (u, x, weight) shortcuts
+    """
+    shortcuts = []
+    if len(out_arcs[v]) == 0:
+        return shortcuts
+    max_out = max(out_arcs[v].values())
+    targets = set(out_arcs[v])
+    for u, w_uv in in_arcs[v].items():
+        settled = _witness_search(out_arcs, u, v, w_uv + max_out, settle_limit, targets - {u})
+        for x, w_vx in out_arcs[v].items():
+            if x == u:
+                continue
+            w = w_uv + w_vx
+            if settled.get(x, float('inf')) > w:
+                shortcuts.append((u, x, w))
+    return shortcuts
+
+
+def build_contraction_hierarchy(graph, col_cost, settle_limit=500):
+    """
+    Build a contraction hierarchy from a graph object. Nodes are contracted in order of edge difference (lazy updates),
+    adding shortcut arcs where no witness path exists. The result answers travel time queries with two small upward
+    searches (ContractionHierarchy.time(), ContractionHierarchy.many_to_many()). Preprocessing runs in Python and takes
+    about a minute per 10,000 nodes of a grid network, so save() the result and reuse it while the network is unchanged.
+    :param graph: NetworkX graph object (create_networkx_object()) or CSRGraph object (create_csr_graph())
+    :param col_cost: String containing name of weight column ('time_drive_sec' or 'time_walk_sec')
+    :param settle_limit: (optional) Maximum number of settled nodes per witness search (lower = faster preprocessing,
+        more shortcuts)
+    :return: ContractionHierarchy
+    """
+    node_ids, arcs = _graph_arcs(graph, col_cost)
+    n = len(node_ids)
+
+    # remaining graph (adjacency dictionaries, parallel arcs collapsed to the minimum weight)
+    out_arcs = [dict() for _ in range(n)]
+    in_arcs = [dict() for _ in range(n)]
+    for u, v, w in arcs:
+        if u != v and w < out_arcs[u].get(v, float('inf')):
+            out_arcs[u][v] = w
+            in_arcs[v][u] = w
+    # every arc of the hierarchy (original arcs and shortcuts)
+    all_arcs = [dict(arcs_u) for arcs_u in out_arcs]
+
+    # initial priorities: edge difference + number of contracted neighbors
+    contracted_neighbors = [0] * n
+    def priority(v, shortcuts):
+        return len(shortcuts) - len(out_arcs[v]) - len(in_arcs[v]) + contracted_neighbors[v]
+    heap = [(priority(v, _shortcuts(out_arcs, in_arcs, v, settle_limit)), v) for v in range(n)]
+    heapq.heapify(heap)
+
+    rank = np.full(n, -1, dtype=np.int64)
+    order = 0
+    while heap:
+        _, v = heapq.heappop(heap)
+        if rank[v] >= 0:
+            continue
+        # lazy update: re-queue if the priority got worse than the next node's
+        shortcuts = _shortcuts(out_arcs, in_arcs, v, settle_limit)
+        p = priority(v, shortcuts)
+        if heap and p > heap[0][0]:
+            heapq.heappush(heap, (p, v))
+            continue
+
+        # contract v: add the shortcuts of the priority check, then remove v from the remaining graph
+        for u, x, w in shortcuts:
+            if w < out_arcs[u].get(x, float('inf')):
+                out_arcs[u][x] = w
+                in_arcs[x][u] = w
+            if w < all_arcs[u].get(x, float('inf')):
+                all_arcs[u][x] = w
+        for x in out_arcs[v]:
+            del in_arcs[x][v]
+            contracted_neighbors[x] += 1
+        for u in in_arcs[v]:
+            del out_arcs[u][v]
+            contracted_neighbors[u] += 1
+        out_arcs[v] = {}
+        in_arcs[v] = {}
+        rank[v] = order
+        order += 1
+
+    # split arcs into the upward forward graph (rank increases) and the upward backward graph (reversed arcs)
+    fwd = [[] for _ in range(n)]
+    bwd = [[] for _ in range(n)]
+    for u in range(n):
+        for x, w in all_arcs[u].items():
+            if rank[u] < rank[x]:
+                fwd[u].append((x, w))
+            else:
+                bwd[x].append((u, w))
+
+    return ContractionHierarchy(node_ids, rank, _to_csr(fwd), _to_csr(bwd))
+
+
+def _to_csr(adjacency):
+    """
+    Convert adjacency lists to CSR arrays
+    :param adjacency: List of lists of (to index, weight) per node
+    :return: Tuple (indptr, indices, weights) of numpy arrays
+    """
+    indptr = np.zeros(len(adjacency) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(a) for a in adjacency])
+    indices = np.array([x for a in adjacency for x, _ in a], dtype=np.int32)
+    weights = np.array([w for a in adjacency for _, w in a], dtype=np.float64)
+    return indptr, indices, weights
+
+
+# CLASSES
+class ContractionHierarchy:
+    """
+    Contraction hierarchy index (build_contraction_hierarchy()) with point and many-to-many travel time queries.
+    Stored as two CSR upward graphs: forward (from lower to higher rank) and backward (reversed arcs into lower rank),
+    searched with scipy.sparse.csgraph.
+    """
+    def __init__(self, node_ids, rank, fwd, bwd, fingerprint=None):
+        """
+        :param node_ids: Sorted numpy int64 array of node IDs (index i = node_ids[i])
+        :param rank: Numpy array of contraction order per node index
+        :param fwd: Tuple (indptr, indices, weights) of the upward forward graph
+        :param bwd: Tuple (indptr, indices, weights) of the upward backward graph
+        :param fingerprint: (optional) String fingerprint of the edges table the index was built from (get_edges_fingerprint())
+        """
+        self.node_ids = node_ids
+        self.rank = rank
+        self.fwd = fwd
+        self.bwd = bwd
+        self.fingerprint = fingerprint
+        self._matrices = {}
+
+    def save(self, path):
+        """
+        Save the index (and its fingerprint) to a numpy .npz file
+        :param path: String containing path to the output file
+        :return: None
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        np.savez(path, node_ids=self.node_ids, rank=self.rank,
+                 fwd_indptr=self.fwd[0], fwd_indices=self.fwd[1], fwd_weights=self.fwd[2],
+                 bwd_indptr=self.bwd[0], bwd_indices=self.bwd[1], bwd_weights=self.bwd[2],
+                 fingerprint=np.array(self.fingerprint or ''))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index saved with save()
+        :param path: String containing path to the .npz file
+        :return: ContractionHierarchy
+        """
+        data = np.load(path)
+        # files saved without a fingerprint never match the edges table
+        fingerprint = str(data['fingerprint']) if 'fingerprint' in data.files else ''
+        return cls(data['node_ids'], data['rank'],
+                   (data['fwd_indptr'], data['fwd_indices'], data['fwd_weights']),
+                   (data['bwd_indptr'], data['bwd_indices'], data['bwd_weights']), fingerprint or None)
+
+    def index(self, nodes):
+        """
+        Look up the index of one or more node IDs (as CSRGraph.index())
+        :param nodes: Node ID or array of node IDs
+        :return: Integer index or numpy array of indices (-1 for nodes not in the index)
+        """
+        nodes_arr = np.asarray(nodes, dtype=np.int64)
+        if len(self.node_ids) == 0:
+            idx = np.full(nodes_arr.shape, -1, dtype=np.int64)
+        else:
+            pos = np.minimum(np.searchsorted(self.node_ids, nodes_arr), len(self.node_ids) - 1)
+            idx = np.where(self.node_ids[pos] == nodes_arr, pos, -1)
+        if idx.ndim == 0:
+            return int(idx)
+        return idx
+
+    def _upward_matrix(self, csr):
+        """
+        SciPy CSR matrix of one upward graph (built once per graph)
+        :param csr: Tuple (indptr, indices, weights), self.fwd or self.bwd
+        :return: scipy.sparse.csr_matrix
+        """
+        key = 'fwd' if csr is self.fwd else 'bwd'
+        if key not in self._matrices:
+            n = len(self.node_ids)
+            indptr, indices, weights = csr
+            self._matrices[key] = csr_matrix((weights, indices, indptr), shape=(n, n))
+        return self._matrices[key]
+
+    def _search_spaces(self, csr, nodes, chunk_size=256):
+        """
+        Upward searches (scipy.sparse.csgraph, typically a few hundred settled nodes each) from a list of nodes
+        :param csr: Tuple (indptr, indices, weights), self.fwd or self.bwd
+        :param nodes: Array of node IDs (nodes not in the index settle nothing)
+        :param chunk_size: (optional) Number of searches per csgraph call (one dense row of distances each)
+        :return: 3 numpy arrays: position of the source node in nodes, settled node index, and distance
+        """
+        sources = self.index(np.asarray(nodes, dtype=np.int64).reshape(-1))
+        positions = np.flatnonzero(sources >= 0)
+        sources = sources[positions]
+        matrix = self._upward_matrix(csr)
+        rows, settled, dists = [], [], []
+        for c in range(0, len(sources), chunk_size):
+            dist = dijkstra(matrix, directed=True, indices=sources[c:c + chunk_size])
+            r, v = np.nonzero(np.isfinite(dist))
+            rows.append(positions[r + c])
+            settled.append(v)
+            dists.append(dist[r, v])
+        if len(rows) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+        return np.concatenate(rows), np.concatenate(settled), np.concatenate(dists)
+
+    def time(self, orig, dest):
+        """
+        Travel time between two nodes with a bidirectional upward search (forward from the origin, backward from the
+        destination, alternating), on dictionaries so a query only touches the few hundred nodes it settles. Each
+        direction stops once its smallest tentative distance can't improve the best meeting node.
+        :param orig: Origin node ID
+        :param dest: Destination node ID
+        :return: Float travel time (inf if unreachable or a node is not in the index)
+        """
+        source, target = self.index(orig), self.index(dest)
+        if source < 0 or target < 0:
+            return math.inf
+
+        graphs = (self.fwd, self.bwd)
+        dist = ({source: 0.0}, {target: 0.0})
+        heaps = ([(0.0, source)], [(0.0, target)])
+        settled = (set(), set())
+        best = math.inf
+        side = 0
+        while True:
+            done = [len(heap) == 0 or heap[0][0] >= best for heap in heaps]
+            if all(done):
+                return best
+            if done[side]:
+                side = 1 - side
+            d_u, u = heapq.heappop(heaps[side])
+            if u not in settled[side]:
+                settled[side].add(u)
+                # meeting node: upward distance from both ends
+                if u in dist[1 - side]:
+                    best = min(best, d_u + dist[1 - side][u])
+                indptr, indices, weights = graphs[side]
+                for k in range(indptr[u], indptr[u + 1]):
+                    v, d_v = int(indices[k]), d_u + float(weights[k])
+                    if d_v < dist[side].get(v, math.inf):
+                        dist[side][v] = d_v
+                        heapq.heappush(heaps[side], (d_v, v))
+            side = 1 - side
+
+    def buckets(self, dests):
+        """
+        Buckets of a set of destinations (backward upward searches), sorted by meeting node. Built once and reused by
+        many_to_many() for every chunk of origins of a matrix (write_travel_matrix())
+        :param dests: Array of destination node IDs
+        :return: 3 numpy arrays: meeting node index, destination column, and distance
+        """
+        cols, nodes, ds = self._search_spaces(self.bwd, dests)
+        order = np.argsort(nodes, kind='stable')
+        return nodes[order], cols[order], ds[order]
+
+    def many_to_many(self, origs, dests, max_entries=2 ** 22, buckets=None):
+        """
+        Travel time matrix between origin and destination nodes with bucket queries: the backward upward searches of
+        all destinations fill per-node buckets (one array sorted by node), and the forward upward searches of the
+        origins are joined with the buckets of the nodes they settle in vectorized blocks
+        :param origs: Array of origin node IDs
+        :param dests: Array of destination node IDs
+        :param max_entries: (optional) Maximum number of (origin, destination, meeting node) candidates per block
+        :param buckets: (optional) Buckets of dests (buckets()), to reuse the backward searches across calls
+        :return: Numpy float64 array (len(origs) x len(dests)), inf if unreachable or a node is not in the index
+        """
+        # backward searches fill the buckets: destination column and distance per meeting node, sorted by node
+        if buckets is None:
+            buckets = self.buckets(dests)
+        bucket_nodes, bucket_cols, bucket_ds = buckets
+
+        # forward searches: bucket range of every settled node
+        rows, nodes, d = self._search_spaces(self.fwd, origs)
+        start = np.searchsorted(bucket_nodes, nodes, side='left')
+        counts = np.searchsorted(bucket_nodes, nodes, side='right') - start
+        hits = np.flatnonzero(counts)
+        rows, d, start, counts = rows[hits], d[hits], start[hits], counts[hits]
+
+        # join settled nodes with their buckets in blocks of at most max_entries candidates (a block always takes at
+        # least one settled node), keeping the minimum per origin and destination
+        out = np.full((len(origs), len(dests)), np.inf)
+        flat = out.reshape(-1)  # flat (origin * destinations + destination) view, faster for ufunc.at
+        ends = np.cumsum(counts)
+        k = 0
+        while k < len(counts):
+            stop = max(int(np.searchsorted(ends, ends[k] - counts[k] + max_entries, side='right')), k + 1)
+            block_counts = counts[k:stop]
+            entry = np.repeat(np.arange(k, stop), block_counts)
+            offset = np.arange(len(entry)) - np.repeat(np.cumsum(block_counts) - block_counts, block_counts)
+            pos = start[entry] + offset
+            np.minimum.at(flat, rows[entry] * len(dests) + bucket_cols[pos], d[entry] + bucket_ds[pos])
+            k = stop
+        return out
@@ -0,0 +1,306 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Array-backed (compressed sparse row) graph used as an alternative to the NetworkX graph object
+
+# IMPORTS
+import json
+import os
+import numpy as np
+import networkx as nx
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+# CLASSES
+class CSRGraph:
+    """
+    Compact graph stored as compressed sparse row arrays.
+    Node IDs are remapped to contiguous int32 indices (position in node_ids) and every cost column is stored as a
+    float64 array aligned with the CSR column indices. Parallel edges are collapsed to the minimum cost per column, or
+    to the value of the parallel edge with the minimum cost of another column (aligned columns, see from_edges()).
+    """
+    def __init__(self, node_ids, indptr, indices, costs, directed=False, coords=None):
+        """
+        :param node_ids: Numpy array of sorted node IDs (index i = node_ids[i])
+        :param indptr: Numpy array of CSR row pointers (length = number of nodes + 1)
+        :param indices: Numpy int32 array of CSR column indices (target node index of each arc)
+        :param costs: Dictionary of numpy float64 arrays aligned with indices {'time_walk_sec': array, ...}
+        :param directed: Boolean, True if arcs were loaded in one direction only
+        :param coords: (optional) Numpy float64 array (number of nodes x 2) of node x/y coordinates (NaN if unknown)
+        """
+        self.node_ids = node_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.costs = costs
+        self.directed = directed
+        self.coords = coords
+        self._matrices = {}
+        self._arc_keys = None
+        self._components = {}
+
+    @classmethod
+    def from_edges(cls, fnode, tnode, costs, directed=False, aligned=None, node_ids=None):
+        """
+        Build a CSRGraph from edge list arrays
+        :param fnode: Array of from node IDs
+        :param tnode: Array of to node IDs
+        :param costs: Dictionary of cost arrays aligned with fnode/tnode {'time_walk_sec': array, ...}
+        :param directed: (optional) Boolean, if False - every edge can be traversed in both directions
+        :param aligned: (optional) Dictionary {column: cost column} of columns in costs that are collapsed to the value of
+            the parallel edge with the minimum cost column (e.g. {'walk_dist_meters': 'time_walk_sec'}: the length of the
+            edge a walking route takes), instead of their own minimum
+        :param node_ids: (optional) Sorted numpy int64 array of all node IDs (e.g. NodeIndex.node_ids), so the graph uses
+            the same indices as the node index (default: the nodes of the edges)
+        :return: CSRGraph
+        """
+        aligned = aligned or {}
+        fnode = np.asarray(fnode)
+        tnode = np.asarray(tnode)
+        costs = {col: np.asarray(arr, dtype=np.float64) for col, arr in costs.items()}
+
+        # remap node IDs to contiguous indices
+        if node_ids is None:
+            node_ids, inverse = np.unique(np.concatenate([fnode, tnode]), return_inverse=True)
+        else:
+            ends = np.concatenate([fnode, tnode]).astype(np.int64)
+            inverse = np.searchsorted(node_ids, ends)
+            if len(ends) > 0 and (inverse.max() >= len(node_ids) or np.any(node_ids[np.minimum(inverse, len(node_ids) - 1)] != ends)):
+                raise ValueError('Edge nodes missing from the node index')
+        src = inverse[:len(fnode)].astype(np.int32)
+        dst = inverse[len(fnode):].astype(np.int32)
+
+        # add reverse arcs for undirected graphs
+        if not directed:
+            src, dst = np.concatenate([src, dst]), np.concatenate([dst, src])
+            costs = {col: np.concatenate([arr, arr]) for col, arr in costs.items()}
+
+        # drop self loops (never part of a shortest path)
+        keep = src != dst
+        src, dst = src[keep], dst[keep]
+        costs = {col: arr[keep] for col, arr in costs.items()}
+
+        # sort arcs by (from, to) and collapse parallel arcs to their minimum cost
+        order = np.lexsort((dst, src))
+        first = np.ones(len(src), dtype=bool)
+        first[1:] = (src[order][1:] != src[order][:-1]) | (dst[order][1:] != dst[order][:-1])
+        starts = np.flatnonzero(first)
+        collapsed = {}
+        for col, arr in costs.items():
+            if col in aligned:
+                # first arc of each (from, to) group when sorted by the cost column
+                order_cost = np.lexsort((costs[aligned[col]], dst, src))
+                collapsed[col] = arr[order_cost][starts]
+            elif len(starts) > 0:
+                collapsed[col] = np.minimum.reduceat(arr[order], starts)
+            else:
+                collapsed[col] = arr[order]
+        costs = collapsed
+        src, dst = src[order][starts], dst[order][starts]
+
+        # row pointers
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=len(node_ids)), out=indptr[1:])
+
+        return cls(node_ids, indptr, dst, costs, directed)
+
+    def save(self, graph_dir, meta=None):
+        """
+        Save the graph arrays to a directory of .npy files (one file per array, so they can be memory-mapped by load()).
+        graph.json is written last and marks the snapshot as complete.
+        :param graph_dir: String containing path to the output directory
+        :param meta: (optional) Dictionary of extra values stored in graph.json (e.g. the edges table fingerprint)
+        :return: None
+        """
+        os.makedirs(graph_dir, exist_ok=True)
+        meta_path = os.path.join(graph_dir, 'graph.json')
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        np.save(os.path.join(graph_dir, 'node_ids.npy'), self.node_ids)
+        np.save(os.path.join(graph_dir, 'indptr.npy'), self.indptr)
+        np.save(os.path.join(graph_dir, 'indices.npy'), self.indices)
+        for col, arr in self.costs.items():
+            np.save(os.path.join(graph_dir, 'cost_{}.npy'.format(col)), arr)
+        if self.coords is not None:
+            np.save(os.path.join(graph_dir, 'coords.npy'), self.coords)
+
+        meta = dict(meta or {}, directed=self.directed, costs=list(self.costs), coords=self.coords is not None)
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+
+    @staticmethod
+    def read_meta(graph_dir):
+        """
+        Read graph.json of a snapshot written by save()
+        :param graph_dir: String containing path to the snapshot directory
+        :return: Dictionary, or None if there is no complete snapshot
+        """
+        meta_path = os.path.join(graph_dir, 'graph.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            return json.load(f)
+
+    @classmethod
+    def load(cls, graph_dir, mmap_mode='r'):
+        """
+        Load a graph snapshot written by save()
+        :param graph_dir: String containing path to the snapshot directory
+        :param mmap_mode: (optional) numpy memory-map mode ('r': arrays are paged in from disk on use, None: read into memory)
+        :return: CSRGraph
+        """
+        meta = cls.read_meta(graph_dir)
+        if meta is None:
+            raise FileNotFoundError('No graph snapshot in {}'.format(graph_dir))
+
+        def load_array(name):
+            return np.load(os.path.join(graph_dir, '{}.npy'.format(name)), mmap_mode=mmap_mode)
+
+        costs = {col: load_array('cost_{}'.format(col)) for col in meta['costs']}
+        coords = load_array('coords') if meta.get('coords') else None
+        return cls(load_array('node_ids'), load_array('indptr'), load_array('indices'), costs, meta['directed'], coords)
+
+    def number_of_nodes(self):
+        return len(self.node_ids)
+
+    def number_of_edges(self):
+        # undirected edges are stored as two arcs
+        if self.directed:
+            return len(self.indices)
+        return len(self.indices) // 2
+
+    def is_directed(self):
+        return self.directed
+
+    def has_node(self, node):
+        return self.index(node) >= 0
+
+    def index(self, nodes):
+        """
+        Look up the contiguous index of one or more node IDs
+        :param nodes: Node ID or array of node IDs
+        :return: Integer index or numpy array of indices (-1 for nodes not in the graph)
+        """
+        nodes_arr = np.asarray(nodes, dtype=self.node_ids.dtype)
+        pos = np.searchsorted(self.node_ids, nodes_arr)
+        pos = np.minimum(pos, len(self.node_ids) - 1)
+        found = self.node_ids[pos] == nodes_arr
+        idx = np.where(found, pos, -1)
+        if idx.ndim == 0:
+            return int(idx)
+        return idx
+
+    def matrix(self, col_cost):
+        """
+        SciPy CSR matrix of one cost column (for scipy.sparse.csgraph routines)
+        :param col_cost: String containing name of cost column ('time_drive_sec', 'time_walk_sec', 'dist_meters')
+        :return: scipy.sparse.csr_matrix
+        """
+        if col_cost not in self._matrices:
+            n = len(self.node_ids)
+            self._matrices[col_cost] = csr_matrix((self.costs[col_cost], self.indices, self.indptr), shape=(n, n))
+        return self._matrices[col_cost]
+
+    def components(self, col_cost):
+        """
+        Weakly connected component label of every node over the arcs with a finite cost (cached per cost column). Nodes
+        with different labels are never connected; for a directed graph, nodes with the same label may still be
+        unreachable.
+        :param col_cost: String containing name of cost column ('time_drive_sec', 'time_walk_sec')
+        :return: Numpy int32 array of component labels aligned with node_ids
+        """
+        if col_cost not in self._components:
+            n = len(self.node_ids)
+            finite = np.isfinite(self.costs[col_cost])
+            src = np.repeat(np.arange(n), np.diff(self.indptr))[finite]
+            links = csr_matrix((np.ones(len(src), dtype=np.int8), (src, np.asarray(self.indices)[finite])), shape=(n, n))
+            self._components[col_cost] = connected_components(links, directed=True, connection='weak')[1]
+        return self._components[col_cost]
+
+    def path(self, predecessors, dest_idx):
+        """
+        Rebuild a path (node IDs) from a scipy.sparse.csgraph predecessor row
+        :param predecessors: Numpy array of predecessor indices for one source node
+        :param dest_idx: Integer index of the destination node
+        :return: List of node IDs from source to destination
+        """
+        idx = [dest_idx]
+        while predecessors[idx[-1]] >= 0:
+            idx.append(predecessors[idx[-1]])
+        idx.reverse()
+        return self.node_ids[idx].tolist()
+
+    def arc_values(self, col, from_idx, to_idx):
+        """
+        Look up the value of a cost column for arcs given by their end node indices
+        :param col: String containing name of cost column
+        :param from_idx: Numpy array of from node indices
+        :param to_idx: Numpy array of to node indices (each arc must exist)
+        :return: Numpy float64 array
+        """
+        pos, _ = self._arc_positions(from_idx, to_idx)
+        return self.costs[col][pos]
+
+    def has_arcs(self, from_idx, to_idx):
+        """
+        Check which arcs exist
+        :param from_idx: Numpy array of from node indices (-1 for nodes not in the graph)
+        :param to_idx: Numpy array of to node indices (-1 for nodes not in the graph)
+        :return: Numpy boolean array
+        """
+        from_idx = np.asarray(from_idx, dtype=np.int64)
+        to_idx = np.asarray(to_idx, dtype=np.int64)
+        _, found = self._arc_positions(from_idx, to_idx)
+        return found & (from_idx >= 0) & (to_idx >= 0)
+
+    def _arc_positions(self, from_idx, to_idx):
+        """
+        Positions of arcs in the indices/costs arrays
+        :return: Numpy array of positions and numpy boolean array (True where the arc exists)
+        """
+        # arcs are sorted by (from, to), so from * n + to is a sorted key
+        n = len(self.node_ids)
+        if self._arc_keys is None:
+            src = np.repeat(np.arange(n, dtype=np.int64), np.diff(self.indptr))
+            self._arc_keys = src * n + self.indices
+        keys = np.asarray(from_idx, dtype=np.int64) * n + np.asarray(to_idx, dtype=np.int64)
+        pos = np.searchsorted(self._arc_keys, keys)
+        found = self._arc_keys[np.minimum(pos, max(len(self._arc_keys) - 1, 0))] == keys if len(self._arc_keys) > 0 else np.zeros(keys.shape, dtype=bool)
+        return pos, found
+
+    def accumulate(self, col, predecessors):
+        """
+        Sum a cost column along the shortest path tree of one search (e.g. the length in meters of every time-shortest
+        path), by pointer jumping over the predecessor row instead of walking each path
+        :param col: String containing name of cost column ('dist_meters', 'walk_dist_meters', ...)
+        :param predecessors: Numpy array of predecessor indices for one source node (scipy.sparse.csgraph)
+        :return: Numpy float64 array with the accumulated value per node index (0 at the source and unreached nodes)
+        """
+        acc = np.zeros(len(predecessors))
+        reached = np.flatnonzero(predecessors >= 0)
+        acc[reached] = self.arc_values(col, predecessors[reached], reached)
+        # after k rounds every node holds the sum of its last 2^k arcs
+        jump = predecessors.copy()
+        active = reached[jump[reached] >= 0]
+        while len(active) > 0:
+            acc[active] += acc[jump[active]]
+            jump[active] = jump[jump[active]]
+            active = active[jump[active] >= 0]
+        return acc
+
+    def to_networkx(self):
+        """
+        Convert to a NetworkX graph object with the same edges and cost attributes (parity checks), and x/y node
+        attributes if the graph has node coordinates
+        :return: NetworkX Graph or DiGraph
+        """
+        graph = nx.DiGraph() if self.directed else nx.Graph()
+        graph.add_nodes_from(self.node_ids.tolist())
+        if self.coords is not None:
+            for node, (x, y) in zip(self.node_ids.tolist(), self.coords.tolist()):
+                graph.nodes[node]['x'] = x
+                graph.nodes[node]['y'] = y
+        src = np.repeat(np.arange(len(self.node_ids)), np.diff(self.indptr))
+        for k in range(len(self.indices)):
+            attrs = {col: float(arr[k]) for col, arr in self.costs.items()}
+            graph.add_edge(self.node_ids[src[k]].item(), self.node_ids[self.indices[k]].item(), **attrs)
+        return graph
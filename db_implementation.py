@@ -2,19 +2,29 @@
 # Functions related to basic database set up
 
 # IMPORTS
+import numpy
 import pandas as pd
+import fiona
 import geopandas as gpd
 import psycopg2
 import io
+import itertools
+import logging
+import time
 import sqlalchemy
-from util import sqlalchemy_engine, psycopg2_connect
+from scipy.spatial import cKDTree
+from shapely import wkb
+from util import db_connection, db_raw_connection, read_sql
+from instrumentation import METRICS
+
+logger = logging.getLogger(__name__)
 
 
 # FUNCTIONS
 def set_primary_key(dbparams, pkey_schema, pkey_table, pkey_name, pkey_cols_list):
     """
     Create a primary key constraint for a Postgres table
-    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname)
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
     :param pkey_schema: String containing name of database schema
     :param pkey_table: String containing name of database table
     :param pkey_name: String containing name of primary key
@@ -28,12 +38,10 @@ def set_primary_key(dbparams, pkey_schema, pkey_table, pkey_name, pkey_cols_list
     pkey_cols_str = pkey_cols_str[:-2]
 
     pkey_str = "ALTER TABLE {}.{} ADD CONSTRAINT {} PRIMARY KEY ({});".format(pkey_schema, pkey_table, pkey_name, pkey_cols_str)
-    print(pkey_str)
+    logger.info(pkey_str)
 
-    # connet to the database
-    engine = sqlalchemy_engine(dbparams)
-    # create primary key
-    with engine.connect() as conn:
+    # connect to the database and create primary key
+    with db_connection(dbparams) as conn:
         conn.execute(pkey_str)
 
     return
@@ -42,7 +50,7 @@ def set_primary_key(dbparams, pkey_schema, pkey_table, pkey_name, pkey_cols_list
 def set_foreign_key(dbparams, main_schema, main_table, fkey_name, main_cols_list, foreign_schema, foreign_table, foreign_cols_list):
     """
     Create a foreign key constraint for a Postgres table
-    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname)
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
     :param main_schema: String containing name of table schema
     :param main_table: String containing name of table
     :param fkey_name: String containing name of foreign key
@@ -65,12 +73,10 @@ def set_foreign_key(dbparams, main_schema, main_table, fkey_name, main_cols_list
 
     fkey_str = "ALTER TABLE {}.{} ADD CONSTRAINT {} FOREIGN KEY ({}) REFERENCES {}.{} ({});".format(
         main_schema, main_table, fkey_name, main_cols_str, foreign_schema, foreign_table, foreign_cols_str)
-    print(fkey_str)
+    logger.info(fkey_str)
 
-    # connect to the database
-    engine = sqlalchemy_engine(dbparams)
-    # create the foreign key
-    with engine.connect() as conn:
+    # connect to the database and create the foreign key
+    with db_connection(dbparams) as conn:
         conn.execute(fkey_str)
 
     return
@@ -79,7 +85,7 @@ def set_foreign_key(dbparams, main_schema, main_table, fkey_name, main_cols_list
 def create_spatial_index(dbparams, schema, table, index_name, geom_col, randomize=False):
     """
     Create a spatial index on a table's geometry column
-    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname)
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
     :param schema: String containing name of schema
     :param table: String containing name of table
     :param index_name: String containing index name
@@ -97,8 +103,7 @@ def create_spatial_index(dbparams, schema, table, index_name, geom_col, randomiz
         sql_str3 = "ALTER TABLE {}.{}_temp RENAME TO {};".format(schema, table, table)
 
     # connect to the database
-    engine = sqlalchemy_engine(dbparams)
-    with engine.connect() as conn:
+    with db_connection(dbparams) as conn:
         # replace table with identical table with randomized rows
         if randomize is True:
             conn.execute(sql_str1)
@@ -110,31 +115,143 @@ def create_spatial_index(dbparams, schema, table, index_name, geom_col, randomiz
     return
 
 
-def shp2dbtable(shp_path, dbparams, dbschema, dbtable, pkey=None, fkey=None):
+def _copy_chunk(cur, dbschema, dbtable, df):
     """
-    Create a Postgres table from a shapefile
-    :param shp_path: String containing path to shapefile
-    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname)
+    Write one dataframe chunk to a Postgres table with COPY (CSV format, empty values become NULL)
+    :param cur: psycopg2 cursor
     :param dbschema: String containing database schema name
     :param dbtable: String containing database table name
-    :param pkey: (optional) List with primary key arguments [pkey_name, pkey_cols_list]
-    :param fkey: (optional) 2D List with foreign key arguments [[fkey_name, fkey_cols_list, ref_schema, ref_table, ref_cols_list],...]
-    :return: None
+    :param df: Pandas dataframe with the table's column names
+    :return: Number of bytes copied
     """
-    # read shapefile as a geodataframe
-    gdf = gpd.read_file(shp_path)
+    buffer = io.StringIO()
+    df.to_csv(buffer, header=False, index=False)
+    n_bytes = buffer.tell()
+    buffer.seek(0)
+
+    cols_str = ", ".join('"{}"'.format(col) for col in df.columns)
+    cur.copy_expert("COPY {}.{} ({}) FROM STDIN WITH (FORMAT csv);".format(dbschema, dbtable, cols_str), buffer)
+
+    return n_bytes
+
+
+def _create_table_sql(dbschema, dbtable, df, extra_cols=None):
+    """
+    SQL replacing a Postgres table with an empty table for the columns of a dataframe (the column types pandas.to_sql()
+    would use: BIGINT, DOUBLE PRECISION, BOOLEAN, TIMESTAMP, or TEXT)
+    :param dbschema: String containing database schema name
+    :param dbtable: String containing database table name
+    :param df: Pandas dataframe (e.g. the first chunk of a file)
+    :param extra_cols: (optional) List of column definitions added after the dataframe columns (e.g. a geometry column)
+    :return: String containing SQL (DROP TABLE IF EXISTS and CREATE TABLE)
+    """
+    types = {'i': 'BIGINT', 'u': 'BIGINT', 'f': 'DOUBLE PRECISION', 'b': 'BOOLEAN', 'M': 'TIMESTAMP'}
+    cols = ['"{}" {}'.format(col, types.get(df[col].dtype.kind, 'TEXT')) for col in df.columns] + list(extra_cols or [])
+    return "DROP TABLE IF EXISTS {}.{}; CREATE TABLE {}.{} ({});".format(dbschema, dbtable, dbschema, dbtable, ", ".join(cols))
+
+
+def _copy_chunks(dbparams, dbschema, dbtable, chunks, create_sql=None):
+    """
+    Stream dataframe chunks into a Postgres table (one COPY per chunk, one transaction) and report the throughput.
+    Integer columns of the first chunk stay integers in later chunks with missing values.
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param dbschema: String containing database schema name
+    :param dbtable: String containing database table name
+    :param chunks: Iterable of Pandas dataframes
+    :param create_sql: (optional) String containing SQL creating the table (_create_table_sql()), run in the same
+        transaction as the COPY, so a failed load leaves neither a new half-loaded table nor a dropped old table
+    :return: Number of rows copied
+    """
+    rows = 0
+    n_bytes = 0
+    int_cols = None
+    st = time.time()
 
     # connect to the database
-    engine = sqlalchemy_engine(dbparams)
+    with METRICS.timer('db_write'), db_raw_connection(dbparams) as conn:
+        cur = conn.cursor()
+        try:
+            if create_sql is not None:
+                cur.execute(create_sql)
+            for chunk in chunks:
+                # integer columns with missing values are read as floats
+                if int_cols is None:
+                    int_cols = [col for col in chunk.columns if chunk[col].dtype.kind in 'iu']
+                chunk = chunk.astype({col: 'Int64' for col in int_cols if chunk[col].dtype.kind == 'f'})
+
+                n_bytes += _copy_chunk(cur, dbschema, dbtable, chunk)
+                rows += len(chunk)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+    seconds = max(time.time() - st, 1e-9)
+    METRICS.count('rows_written', rows)
+    METRICS.count('bytes_written', n_bytes)
+    logger.info("New table created: %s.%s (%s rows in %.1f seconds, %.0f rows/s, %.1f MB/s)", dbschema, dbtable, rows, seconds,
+                rows / seconds, n_bytes / seconds / 1e6)
+
+    return rows
+
+
+def _read_shp_chunks(shp_path, chunk_size):
+    """
+    Generator of fixed-size geodataframe chunks of a shapefile, read with one pass of a single reader
+    :param shp_path: String containing path to shapefile
+    :param chunk_size: Number of features per chunk
+    :return: Generator of geodataframes
+    """
+    with fiona.open(shp_path) as src:
+        crs = src.crs_wkt or None
+        features = iter(src)
+        while True:
+            batch = list(itertools.islice(features, chunk_size))
+            if len(batch) == 0:
+                break
+            yield gpd.GeoDataFrame.from_features(batch, crs=crs)
 
-    # create new table from geodataframe (in public) with spatial index
-    gdf.to_postgis("{}".format(dbtable), engine)
 
-    # move table to desired schema (from public)
-    sql_string = "ALTER TABLE {} SET SCHEMA {};".format(dbtable, dbschema)
-    with engine.connect() as conn:
-        result = conn.execute(sql_string)
-    print("New table created: {}.{}".format(dbschema, dbtable))
+def shp2dbtable(shp_path, dbparams, dbschema, dbtable, pkey=None, fkey=None, spatial_index=True, chunk_size=50000):
+    """
+    Create a Postgres table from a shapefile. The shapefile is read and copied in chunks (geometry as hex EWKB), directly
+    into the target schema, so memory stays bounded by chunk_size. Keys and the spatial index are created after the load.
+    Column types are taken from the first chunk.
+    :param shp_path: String containing path to shapefile
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param dbschema: String containing database schema name
+    :param dbtable: String containing database table name
+    :param pkey: (optional) List with primary key arguments [pkey_name, pkey_cols_list]
+    :param fkey: (optional) 2D List with foreign key arguments [[fkey_name, fkey_cols_list, ref_schema, ref_table, ref_cols_list],...]
+    :param spatial_index: (optional) String containing name of the spatial index on the geometry column, True (default)
+        for idx_{dbtable}_{geometry column} (the index to_postgis() created), or None for no spatial index
+    :param chunk_size: (optional) Number of features read and copied per chunk
+    :return: None
+    """
+    chunks = _read_shp_chunks(shp_path, chunk_size)
+    first = next(chunks, None)
+    if first is None:
+        raise ValueError("Shapefile {} has no features".format(shp_path))
+    geom_col = first.geometry.name
+    srid = first.crs.to_epsg() if first.crs is not None else 0
+    # CRS without an EPSG code: geometry without SRID (set it later with UpdateGeometrySRID())
+    if srid is None:
+        logger.warning('%s: CRS has no EPSG code, geometry is stored with SRID 0', shp_path)
+        srid = 0
+
+    # SQL to create the new empty table in the target schema (attribute columns + geometry column)
+    create_sql = _create_table_sql(dbschema, dbtable, first.drop(columns=geom_col), ['"{}" geometry(Geometry, {})'.format(geom_col, srid)])
+
+    def ewkb_chunks():
+        for gdf in itertools.chain([first], chunks):
+            df = pd.DataFrame(gdf.drop(columns=geom_col))
+            df[geom_col] = [None if geom is None else wkb.dumps(geom, hex=True, srid=srid) for geom in gdf.geometry]
+            yield df
+
+    # create the table and copy the features chunk by chunk (one transaction)
+    _copy_chunks(dbparams, dbschema, dbtable, ewkb_chunks(), create_sql)
 
     # create primary key
     if pkey is not None:
@@ -143,44 +260,38 @@ def shp2dbtable(shp_path, dbparams, dbschema, dbtable, pkey=None, fkey=None):
     if fkey is not None:
         for i in range(len(fkey)):
             set_foreign_key(dbparams, dbschema, dbtable, fkey[i][0], fkey[i][1], fkey[i][2], fkey[i][3], fkey[i][4])
+    # create spatial index
+    if spatial_index is True:
+        spatial_index = 'idx_{}_{}'.format(dbtable, geom_col)
+    if spatial_index:
+        create_spatial_index(dbparams, dbschema, dbtable, spatial_index, '"{}"'.format(geom_col))
 
     return
 
 
-def csv2dbtable(csv_path, dbparams, dbschema, dbtable, pkey=None, fkey=None):
+def csv2dbtable(csv_path, dbparams, dbschema, dbtable, pkey=None, fkey=None, chunk_size=100000, dtype=None):
     """
-    Create a Postgres table from a CSV file
+    Create a Postgres table from a CSV file. The file is read and copied in chunks, so memory stays bounded by chunk_size.
+    Column types are taken from the first chunk (pin them with dtype if later rows differ).
     :param csv_path: String containing path to a CSV file
-    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname)
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
     :param dbschema: String containing database schema name
     :param dbtable: String containing database table
     :param pkey: (optional) List with primary key arguments [pkey_name, pkey_cols_list]
     :param fkey: (optional) 2D List with foreign key arguments [[fkey_name, fkey_cols_list, ref_schema, ref_table, ref_cols_list],...]
+    :param chunk_size: (optional) Number of rows read and copied per chunk
+    :param dtype: (optional) Dictionary of column types passed to pandas.read_csv() (e.g. {'naics_code': str})
     :return: None
     """
-    # read csv as a dataframe
-    df = pd.read_csv(csv_path)
-
-    # connect to the database
-    engine = sqlalchemy_engine(dbparams)
-    with engine.connect() as conn:
-        # create new empty table from dataframe (drops old table if exists and creates new empty table)
-        df.head(0).to_sql(dbtable, engine, schema=dbschema, if_exists='replace', index=False)
+    # read csv in chunks
+    chunks = pd.read_csv(csv_path, chunksize=chunk_size, dtype=dtype)
+    first = next(chunks)
 
-    # copy contents of dataframe into Postgres table
-    conn = psycopg2_connect(dbparams)
-    cur = conn.cursor()
-
-    output = io.StringIO()
-    df.to_csv(output, sep='\t', header=False, index=False)
-    output.seek(0)
-    contents = output.getvalue()
-    cur.copy_from(output, '{}.{}'.format(dbschema, dbtable), null="")  # null values become ''
-    print("New table created: {}.{}".format(dbschema, dbtable))
+    # SQL to create new empty table from dataframe (drops old table if exists and creates new empty table)
+    create_sql = _create_table_sql(dbschema, dbtable, first)
 
-    conn.commit()
-    cur.close()
-    conn.close()
+    # create the table and copy contents of csv into it chunk by chunk (one transaction)
+    _copy_chunks(dbparams, dbschema, dbtable, itertools.chain([first], chunks), create_sql)
 
     # create primary key
     if pkey is not None:
@@ -196,7 +307,7 @@ def csv2dbtable(csv_path, dbparams, dbschema, dbtable, pkey=None, fkey=None):
 def create_project_tables(dbparams, old_dbschema, old_dbtable, new_dbschema, new_dbtable, cols_dict, randomize=False, where_clause=None, pkey=None, fkey=None, spatial_index=None):
     """
     Create a basic Postgres table from another Postgres table (SELECT cols FROM table WHERE condition)
-    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname)
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
     :param old_dbschema: String containing database schema name of parent table
     :param old_dbtable: String containing database name of parent table
     :param new_dbschema: String containing database name of new table's schema
@@ -222,12 +333,10 @@ def create_project_tables(dbparams, old_dbschema, old_dbtable, new_dbschema, new
         sql_str = "CREATE TABLE {}.{} AS ({} WHERE {});".format(new_dbschema, new_dbtable, select_str, where_clause)
     if randomize:
         sql_str = "CREATE TABLE {}.{} AS ({} WHERE {}) ORDER BY random();".format(new_dbschema, new_dbtable, select_str, where_clause)
-    print(sql_str)
+    logger.info(sql_str)
 
-    # connect to the database
-    engine = sqlalchemy_engine(dbparams)
-    # create new database table
-    with engine.connect() as conn:
+    # connect to the database and create new database table
+    with db_connection(dbparams) as conn:
         conn.execute(sqlalchemy.text(sql_str))
 
     # create primary key
@@ -242,3 +351,108 @@ def create_project_tables(dbparams, old_dbschema, old_dbtable, new_dbschema, new
         create_spatial_index(dbparams, new_dbschema, new_dbtable, spatial_index[0], spatial_index[1], spatial_index[2])
 
     return
+
+
+def nearest_nodes(node_ids, node_xy, point_xy, k=1, valid_nodes=None):
+    """
+    Find the nearest network node of every point with a KD-tree (vectorized, projected coordinates)
+    :param node_ids: Array of node IDs
+    :param node_xy: Numpy array (number of nodes x 2) of node coordinates
+    :param point_xy: Numpy array (number of points x 2) of point coordinates
+    :param k: (optional) Number of nearest nodes returned per point (at most the number of nodes)
+    :param valid_nodes: (optional) Array of node IDs a point may snap to (e.g. the nodes of the main connected
+        component of the routing graph). The nearest valid node among the k candidates is used; points without a valid
+        candidate fall back to the nearest valid node overall.
+    :return: 4 numpy arrays: nearest node IDs, distances, and the k candidate node IDs and distances (points x k)
+    """
+    node_ids = numpy.asarray(node_ids)
+    node_xy = numpy.asarray(node_xy, dtype=float)
+    point_xy = numpy.asarray(point_xy, dtype=float)
+    if len(node_xy) == 0:
+        raise ValueError('No nodes to snap to')
+
+    # k nearest nodes of every point (always 2D: points x k), cKDTree pads missing neighbors with an out of range index
+    k = min(k, len(node_xy))
+    dist, idx = cKDTree(node_xy).query(point_xy, k=k)
+    dist = dist.reshape(len(point_xy), k)
+    idx = idx.reshape(len(point_xy), k)
+    cand_ids = node_ids[idx]
+
+    if valid_nodes is None:
+        return cand_ids[:, 0], dist[:, 0], cand_ids, dist
+
+    # first valid candidate of every point
+    valid = numpy.isin(cand_ids, numpy.asarray(valid_nodes))
+    first = valid.argmax(axis=1)
+    rows = numpy.arange(len(point_xy))
+    nearest, nearest_dist = cand_ids[rows, first], dist[rows, first]
+
+    # no valid node among the candidates: nearest valid node overall
+    missing = ~valid.any(axis=1)
+    if missing.any():
+        valid_mask = numpy.isin(node_ids, numpy.asarray(valid_nodes))
+        if not valid_mask.any():
+            raise ValueError('None of the valid nodes are in the nodes table')
+        fallback_dist, fallback_idx = cKDTree(node_xy[valid_mask]).query(point_xy[missing])
+        nearest[missing] = node_ids[valid_mask][fallback_idx]
+        nearest_dist[missing] = fallback_dist
+
+    return nearest, nearest_dist, cand_ids, dist
+
+
+def snap_points_to_nodes(dbparams, points_schema, points_table, id_col, nodes_schema, nodes_table, k=1, valid_nodes=None):
+    """
+    Set the node_closest and node_dist_meters columns of a Postgres point table (parcels, pois) to the nearest network
+    node, in place of the nearest neighbor (<->) SQL. Coordinates are loaded once (EPSG 2230, feet), all nearest node
+    queries are answered by nearest_nodes(), and the result is written with one COPY into a staging table and one
+    UPDATE ... FROM.
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param points_schema: String containing schema name of the point table
+    :param points_table: String containing name of the point table (point or polygon geometry, centroids are used)
+    :param id_col: String containing name of the point table's unique ID column ('resid', 'placekey')
+    :param nodes_schema: String containing schema name of the nodes table
+    :param nodes_table: String containing name of the nodes table (nodeid, geometry)
+    :param k: (optional) Number of nearest nodes considered per point (see nearest_nodes())
+    :param valid_nodes: (optional) Array of node IDs a point may snap to (see nearest_nodes())
+    :return: Pandas dataframe with id_col, node_closest, node_dist_meters, and (k > 1) the candidate nodes_k and
+        dists_k_meters lists
+    """
+    # SQL to return node and point coordinates
+    nodes_str = "SELECT nodeid::BIGINT AS nodeid, ST_X(geometry) AS x, ST_Y(geometry) AS y FROM {}.{};".format(nodes_schema, nodes_table)
+    points_str = "SELECT {} AS pointid, ST_X(ST_Centroid(geometry)) AS x, ST_Y(ST_Centroid(geometry)) AS y FROM {}.{};".format(id_col, points_schema, points_table)
+
+    # connect to the database
+    with METRICS.timer('db_read'), db_connection(dbparams) as conn:
+        nodes = read_sql(nodes_str, conn)
+        points = read_sql(points_str, conn)
+    METRICS.count('rows_fetched', len(nodes) + len(points))
+
+    # nearest nodes (distances in feet -> meters, rounded as in esco_schema.sql)
+    nearest, dist_ft, cand_ids, cand_dist_ft = nearest_nodes(nodes['nodeid'].to_numpy(), nodes[['x', 'y']].to_numpy(), points[['x', 'y']].to_numpy(), k, valid_nodes)
+    df = pd.DataFrame({id_col: points['pointid'], 'node_closest': nearest, 'node_dist_meters': numpy.round(dist_ft / 3.28084, 5)})
+    if k > 1:
+        df['nodes_k'] = cand_ids.tolist()
+        df['dists_k_meters'] = numpy.round(cand_dist_ft / 3.28084, 5).tolist()
+
+    # write the result as CSV into an in-memory buffer
+    output = io.StringIO()
+    df[[id_col, 'node_closest', 'node_dist_meters']].to_csv(output, header=False, index=False)
+    n_bytes = output.tell()
+    output.seek(0)
+
+    # copy into a staging table and update the point table with one join
+    staging = "{}_snap_staging".format(points_table)
+    with METRICS.timer('db_write'), db_raw_connection(dbparams) as conn:
+        cur = conn.cursor()
+        cur.execute("ALTER TABLE {}.{} ADD COLUMN IF NOT EXISTS node_closest NUMERIC, ADD COLUMN IF NOT EXISTS node_dist_meters NUMERIC;".format(points_schema, points_table))
+        cur.execute("CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} AS pointid, node_closest, node_dist_meters FROM {}.{} LIMIT 0;".format(staging, id_col, points_schema, points_table))
+        cur.copy_expert("COPY {} (pointid, node_closest, node_dist_meters) FROM STDIN WITH (FORMAT csv);".format(staging), output)
+        cur.execute("UPDATE {}.{} AS t SET node_closest = s.node_closest, node_dist_meters = s.node_dist_meters FROM {} AS s WHERE t.{} = s.pointid;".format(
+            points_schema, points_table, staging, id_col))
+        conn.commit()
+        cur.close()
+    METRICS.count('rows_written', len(df))
+    METRICS.count('bytes_written', n_bytes)
+    logger.info("Snapped %s points of %s.%s to %s.%s", len(df), points_schema, points_table, nodes_schema, nodes_table)
+
+    return df
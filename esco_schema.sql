@@ -72,6 +72,7 @@ INSERT INTO  esco.edges (roadsegid, fnode, tnode, dist_meters, time_drive_sec, t
 ALTER TABLE esco.edges RENAME TO edges_directed;
 
 -- find nodes closest to res parcels and pois (use nearest neighbor)
+-- (faster alternative for large schemas: db_implementation.snap_points_to_nodes() in main.py, KD-tree in Python + one COPY/UPDATE per table)
 ALTER TABLE esco.parcels_2017 ADD COLUMN node_closest NUMERIC, ADD COLUMN node_dist_meters NUMERIC;
 UPDATE esco.parcels_2017 AS t1 SET node_closest = t2.node_closest, node_dist_meters = t2.node_dist_meters FROM (
 WITH parcels AS (SELECT resid, geometry AS resgeom FROM esco.parcels_2017),
@@ -110,6 +111,10 @@ ALTER TABLE esco.od_routes RENAME COLUMN time_drive_sec to drive_time_sec;
 -- Pedestrian routes - same as road network, only check for O-D <= 5 miles apart --> ~8050 meters (reference Bradley et al., 2010)
 --add binary walk column (1=TRUE, route can use pedestrian mode.)
 ALTER TABLE esco.od_routes ADD COLUMN walk INT DEFAULT 0;
+-- with a walk search budget (main.py WALK_MAX_COST = 6000 -> find_shortest_route(..., max_cost=6000)) the euclidean
+-- pre-filter below and the travel time clean up at the end can be skipped: mark every route walkable instead,
+-- routes beyond the budget get an empty walk_path and a NULL walk_time_sec
+-- UPDATE esco.od_routes SET walk = 1;
 WITH t AS (SELECT routes.node_orig, routes.node_dest, orig.geometry AS orig_geom, dest.geometry AS dest_geom
             FROM esco.od_routes routes LEFT JOIN esco.nodes orig ON routes.node_orig = orig.nodeid
             LEFT JOIN esco.nodes dest ON routes.node_dest = dest.nodeid),
@@ -133,6 +138,7 @@ UPDATE esco.edges SET walk = t.walk FROM t WHERE esco.edges.roadsegid = t.roadse
 SELECT COUNT(*) FROM esco.edges WHERE walk = 1; --11,499 walkable edges (not freeways, highways, or ramps)
 
 -- change binary walk column in od_routes to 1 where travel time <6000 sec (5 miles at 3mph), 0 otherwise
+-- (not needed with the walk search budget: walkable routes are the routes WHERE walk_time_sec IS NOT NULL)
 WITH t as (SELECT routeid, CASE WHEN walk_time_sec > 6000 THEN 0 WHEN walk_time_sec IS NULL THEN 0 WHEN walk_time_sec <= 6000 THEN 1 END walk FROM esco.od_routes)
 UPDATE esco.od_routes SET walk = t.walk FROM t WHERE esco.od_routes.routeid = t.routeid;
 SELECT SUM(walk) FROM esco.od_routes; --1,232,988 walkable od pairs with time < 6000 sec (5 miles at 3mph)
@@ -0,0 +1,403 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Functions related to incremental recomputation of O-D routes after edits to the edges table
+
+# IMPORTS
+import logging
+import os
+import numpy as np
+import pandas as pd
+import networkx as nx
+from scipy.sparse.csgraph import dijkstra
+from sqlalchemy import text
+from csr_graph import CSRGraph
+from network_analysis import find_shortest_route, routes2dbtable_copy
+from path_codec import decode_path, decode_path_text
+from util import db_connection, db_raw_connection, read_sql
+
+logger = logging.getLogger(__name__)
+
+
+# FUNCTIONS
+def get_changed_edges(dbparams, edge_schema, edge_table, edgeids=None, roadsegids=None):
+    """
+    Return the node pairs of edited edges. Deleted edges are no longer in the table, refresh_changed_routes() finds
+    them by diffing the stored paths against the graph (deleted_edges()).
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param edge_schema: String containing database schema name
+    :param edge_table: String containing database table name
+    :param edgeids: (optional) List of changed 'edgeid' values
+    :param roadsegids: (optional) List of changed 'roadsegid' values (all edges of the road segments)
+    :return: List of (fnode, tnode) integer tuples
+    """
+    # SQL to return the node IDs of the changed edges
+    sql_str = "SELECT fnode::BIGINT AS fnode, tnode::BIGINT AS tnode from {}.{} WHERE edgeid = ANY(:edgeids) OR roadsegid = ANY(:roadsegids);".format(edge_schema, edge_table)
+    params = {'edgeids': [int(e) for e in edgeids or []], 'roadsegids': [int(r) for r in roadsegids or []]}
+
+    # connect to database
+    with db_connection(dbparams) as conn:
+        rows = conn.execute(text(sql_str), params).fetchall()
+
+    return [(int(fnode), int(tnode)) for fnode, tnode in rows]
+
+
+def path_decoder(path_format):
+    """
+    Function decoding stored paths of one path storage format
+    :param path_format: Path storage format: 'text', 'bytea', or 'array'
+    :return: Function returning the list of node IDs of a stored path
+    """
+    if path_format == 'text':
+        return decode_path_text
+    elif path_format == 'bytea':
+        return decode_path
+    elif path_format == 'array':
+        return list
+    raise ValueError("Paths stored with path format '{}' can't be read (the incremental update needs stored paths)".format(path_format))
+
+
+def read_route_paths(dbparams, routes_schema, routes_table, col_path, path_format='text', batch_size=10000, walk=False):
+    """
+    Generator of stored route paths read through one named (server-side) cursor
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param routes_schema: String containing database schema name
+    :param routes_table: String containing database table name
+    :param col_path: Name of column storing the route path (drive_path, walk_path)
+    :param path_format: (optional) Path storage format of col_path: 'text', 'bytea', or 'array'
+    :param batch_size: (optional) Number of rows fetched per round trip
+    :param walk: Boolean, True if walking routes and False for driving routes
+    :return: Generator of (routeid, list of node IDs) tuples
+    """
+    decode = path_decoder(path_format)
+
+    # SQL to return the stored paths
+    sql_str = "SELECT routeid, {} from {}.{} WHERE {} IS NOT NULL".format(col_path, routes_schema, routes_table, col_path)
+    if walk:
+        sql_str += " AND walk = 1"
+    sql_str += " ORDER by routeid;"
+
+    # connect to database
+    with db_raw_connection(dbparams) as conn:
+        try:
+            # named cursor -> rows stay on the server until fetched
+            cur = conn.cursor(name='paths_{}_{}'.format(routes_table, col_path))
+            cur.itersize = batch_size
+            cur.execute(sql_str)
+            for routeid, path in cur:
+                yield routeid, decode(path)
+            cur.close()
+        finally:
+            # end the read-only transaction holding the cursor
+            conn.rollback()
+
+
+def get_route_times(dbparams, routes_schema, routes_table, col_time, walk=False):
+    """
+    Return the O-D nodes and stored travel time of every route
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param routes_schema: String containing database schema name
+    :param routes_table: String containing database table name
+    :param col_time: Name of column storing the route cost (drive_time_sec, walk_time_sec)
+    :param walk: Boolean, True if walking routes and False for driving routes
+    :return: Pandas dataframe containing routeid, node_orig, node_dest (int64), and time (float, NaN if NULL) columns
+    """
+    # SQL to return node IDs as integers and times as floats
+    sql_str = "SELECT routeid, node_orig::BIGINT AS node_orig, node_dest::BIGINT AS node_dest, {}::FLOAT8 AS time from {}.{}".format(col_time, routes_schema, routes_table)
+    if walk:
+        sql_str += " WHERE walk = 1;"
+    else:
+        sql_str += ";"
+
+    # connect to database
+    with db_connection(dbparams) as conn:
+        df = read_sql(sql_str, conn)
+
+    return df
+
+
+def _distances(graph, node, col_cost, max_cost=None, reverse=False):
+    """
+    Single-source search distances of every node from (or, with reverse=True, to) one node
+    :param graph: NetworkX graph object or CSRGraph object
+    :param node: Node ID
+    :param col_cost: String containing name of weight column ('time_drive_sec' or 'time_walk_sec')
+    :param max_cost: (optional) Search budget in col_cost units
+    :param reverse: (optional) Boolean, if True - distances to the node (directed graphs only differ)
+    :return: Dictionary {node ID (int): distance}
+    """
+    if isinstance(graph, CSRGraph):
+        weights = graph.matrix(col_cost)
+        if reverse and graph.is_directed():
+            weights = weights.T.tocsr()
+        dist = dijkstra(weights, directed=True, indices=graph.index(node), limit=np.inf if max_cost is None else max_cost)
+        reached = np.flatnonzero(np.isfinite(dist))
+        return dict(zip(graph.node_ids[reached].tolist(), dist[reached].tolist()))
+
+    if reverse and graph.is_directed():
+        graph = graph.reverse(copy=False)
+    dist = nx.single_source_dijkstra_path_length(graph, node, cutoff=max_cost, weight=col_cost)
+    return {int(n): d for n, d in dist.items()}
+
+
+def _edge_cost(graph, u, v, col_cost):
+    """
+    Cost of the arc u -> v in the current graph
+    :return: Float, or None if there is no such arc (e.g. a deleted edge)
+    """
+    if isinstance(graph, CSRGraph):
+        u_idx, v_idx = graph.index(u), graph.index(v)
+        if u_idx < 0 or v_idx < 0:
+            return None
+        row = slice(graph.indptr[u_idx], graph.indptr[u_idx + 1])
+        hits = np.flatnonzero(graph.indices[row] == v_idx)
+        return float(graph.costs[col_cost][row][hits[0]]) if len(hits) > 0 else None
+
+    if graph.has_edge(u, v):
+        return float(graph[u][v][col_cost])
+    return None
+
+
+def deleted_edges(graph, index):
+    """
+    Edges of the stored paths (EdgeRouteIndex) that are no longer in the graph. Deleted edges can't be looked up in the
+    edges table (get_changed_edges()), so the routes through them are found by diffing the index against the graph.
+    :param graph: NetworkX graph object or CSRGraph object built from the edited edges table
+    :param index: EdgeRouteIndex built from the stored paths (before the edit)
+    :return: List of (fnode, tnode) integer tuples
+    """
+    n = max(len(index.node_ids), 1)
+    fnode, tnode = index.node_ids[index.edge_keys // n], index.node_ids[index.edge_keys % n]
+
+    # an undirected index edge is still there if either arc is (the graph is directed or undirected like the index)
+    if isinstance(graph, CSRGraph):
+        from_idx, to_idx = graph.index(fnode), graph.index(tnode)
+        found = graph.has_arcs(from_idx, to_idx)
+        if not index.directed:
+            found |= graph.has_arcs(to_idx, from_idx)
+    else:
+        found = np.array([graph.has_edge(u, v) or (not index.directed and graph.has_edge(v, u))
+                          for u, v in zip(fnode.tolist(), tnode.tolist())], dtype=bool)
+
+    missing = np.flatnonzero(~found)
+    return list(zip(fnode[missing].tolist(), tnode[missing].tolist()))
+
+
+def find_improvable_routes(graph, route_times, changed_edges, col_cost, max_cost=None):
+    """
+    Find the routes whose stored travel time could drop because of the changed edges: a route (o, d) can now use the
+    arc u -> v if dist(o, u) + cost(u, v) + dist(v, d) rounds below its stored time. Routes without a stored time
+    (unreachable or beyond max_cost) qualify as soon as the new time is within the budget.
+    :param graph: NetworkX graph object or CSRGraph object built from the edited edges table
+    :param route_times: Pandas dataframe (get_route_times())
+    :param changed_edges: List of (fnode, tnode) tuples (get_changed_edges())
+    :param col_cost: String containing name of weight column ('time_drive_sec' or 'time_walk_sec')
+    :param max_cost: (optional) Search budget in col_cost units
+    :return: Numpy array of routeids
+    """
+    orig = pd.Series(route_times['node_orig'].to_numpy())
+    dest = pd.Series(route_times['node_dest'].to_numpy())
+    stored = route_times['time'].to_numpy()
+    stored = np.where(np.isnan(stored), np.inf if max_cost is None else max_cost + 0.5, stored)
+
+    # arcs of the changed edges (both directions for undirected graphs)
+    arcs = set()
+    for u, v in changed_edges:
+        arcs.add((int(u), int(v)))
+        if not graph.is_directed():
+            arcs.add((int(v), int(u)))
+
+    improvable = np.zeros(len(route_times), dtype=bool)
+    for u, v in arcs:
+        cost = _edge_cost(graph, u, v, col_cost)
+        if cost is None:
+            continue
+        # best time through u -> v for every O-D pair
+        to_u = orig.map(_distances(graph, u, col_cost, max_cost, reverse=True)).to_numpy(dtype=float, na_value=np.inf)
+        from_v = dest.map(_distances(graph, v, col_cost, max_cost)).to_numpy(dtype=float, na_value=np.inf)
+        improvable |= np.round(to_u + cost + from_v) < stored
+
+    return route_times['routeid'].to_numpy()[improvable]
+
+
+def refresh_changed_routes(dbparams, graph, index, changed_edges, routes_schema, routes_table, col_cost, walk=False, path_format='text', max_cost=None):
+    """
+    Recompute only the O-D routes affected by edited edges: routes whose stored path uses a changed or deleted edge
+    (EdgeRouteIndex, deleted_edges()) and routes that could improve through a changed edge (find_improvable_routes()).
+    Results are written with routes2dbtable_copy() and the index is updated with the new paths.
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param graph: NetworkX graph object or CSRGraph object built from the edited edges table
+    :param index: EdgeRouteIndex built from the stored paths (before the edit)
+    :param changed_edges: List of (fnode, tnode) tuples (get_changed_edges()), deleted edges are found from the index
+    :param routes_schema: String containing database schema name
+    :param routes_table: String containing database table name
+    :param col_cost: String containing name of weight column ('time_drive_sec' or 'time_walk_sec')
+    :param walk: Boolean, True if walking routes and False for driving routes
+    :param path_format: (optional) Path storage format of the path column: 'text', 'bytea', or 'array'
+    :param max_cost: (optional) Search budget in col_cost units (see find_shortest_route())
+    :return: 2 list objects: p (paths) and e (errors), see find_shortest_route()
+    """
+    col_path, col_time = ('walk_path', 'walk_time_sec') if walk else ('drive_path', 'drive_time_sec')
+    # fails before any route is written if the new paths can't be indexed
+    decode = path_decoder(path_format)
+
+    # affected routes
+    route_times = get_route_times(dbparams, routes_schema, routes_table, col_time, walk)
+    deleted = deleted_edges(graph, index)
+    using = index.routes(list(changed_edges) + deleted)
+    improvable = find_improvable_routes(graph, route_times, changed_edges, col_cost, max_cost)
+    affected = np.union1d(using, improvable)
+    logger.info('%s edges deleted, %s routes use the changed or deleted edges, %s could improve, %s to recompute',
+                len(deleted), len(using), len(improvable), len(affected))
+
+    # recompute and write the affected routes
+    od = route_times.loc[route_times['routeid'].isin(affected), ['routeid', 'node_orig', 'node_dest']].reset_index(drop=True)
+    od['node_orig'] = od['node_orig'].astype(object)
+    od['node_dest'] = od['node_dest'].astype(object)
+    p, e = find_shortest_route(graph, od, 'routeid', 'node_orig', 'node_dest', col_cost, walk=walk, by_origin=True, path_format=path_format, max_cost=max_cost)
+    if len(p) > 0:
+        routes2dbtable_copy(dbparams, routes_schema, routes_table, col_path, col_time, p, path_format=path_format)
+
+    # replace the paths of the recomputed routes in the index
+    index.replace(affected, [(row['b_routeid'], decode(row[col_path])) for row in p])
+
+    return p, e
+
+
+# CLASSES
+class EdgeRouteIndex:
+    """
+    Reverse index edge -> routes built from the stored route paths. Node IDs are remapped to dense indices, each edge
+    is one int64 key (sorted), and the routeids using an edge are a slice of one routeid array (CSR layout).
+    Edges of undirected graphs are stored once, as (smaller node, larger node).
+    """
+    def __init__(self, node_ids, edge_keys, indptr, routeids, directed=False):
+        """
+        :param node_ids: Sorted numpy int64 array of node IDs found in the paths
+        :param edge_keys: Sorted numpy int64 array of edge keys (from index * number of nodes + to index)
+        :param indptr: Numpy int64 array, routeids of edge_keys[k] are routeids[indptr[k]:indptr[k + 1]]
+        :param routeids: Numpy int64 array of routeids grouped by edge
+        :param directed: Boolean, True if (u, v) and (v, u) are different edges
+        """
+        self.node_ids = node_ids
+        self.edge_keys = edge_keys
+        self.indptr = indptr
+        self.routeids = routeids
+        self.directed = directed
+
+    @classmethod
+    def from_pairs(cls, fnode, tnode, routeids, directed=False):
+        """
+        Build an index from aligned arrays of edge node IDs and routeids
+        :param fnode: Array of from node IDs
+        :param tnode: Array of to node IDs
+        :param routeids: Array of routeids
+        :param directed: (optional) Boolean, True if (u, v) and (v, u) are different edges
+        :return: EdgeRouteIndex
+        """
+        fnode = np.asarray(fnode, dtype=np.int64)
+        tnode = np.asarray(tnode, dtype=np.int64)
+        routeids = np.asarray(routeids, dtype=np.int64)
+        if not directed:
+            fnode, tnode = np.minimum(fnode, tnode), np.maximum(fnode, tnode)
+
+        # remap node IDs to dense indices and combine each edge into one key
+        node_ids, inverse = np.unique(np.concatenate([fnode, tnode]), return_inverse=True)
+        keys = inverse[:len(fnode)].astype(np.int64) * len(node_ids) + inverse[len(fnode):]
+
+        # group routeids by edge (one entry per edge and route)
+        order = np.lexsort((routeids, keys))
+        keys, routeids = keys[order], routeids[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = (keys[1:] != keys[:-1]) | (routeids[1:] != routeids[:-1])
+        keys, routeids = keys[first], routeids[first]
+        edge_keys, counts = np.unique(keys, return_counts=True)
+        indptr = np.zeros(len(edge_keys) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+
+        return cls(node_ids, edge_keys, indptr, routeids, directed)
+
+    @classmethod
+    def build(cls, paths, directed=False):
+        """
+        Build an index from route paths
+        :param paths: Iterable of (routeid, list of node IDs) tuples (read_route_paths())
+        :param directed: (optional) Boolean, True if (u, v) and (v, u) are different edges
+        :return: EdgeRouteIndex
+        """
+        fnode, tnode, routeids = [], [], []
+        for routeid, path in paths:
+            if len(path) < 2:
+                continue
+            path = np.asarray(path, dtype=np.int64)
+            fnode.append(path[:-1])
+            tnode.append(path[1:])
+            routeids.append(np.full(len(path) - 1, routeid, dtype=np.int64))
+        if len(fnode) == 0:
+            return cls.from_pairs([], [], [], directed)
+        return cls.from_pairs(np.concatenate(fnode), np.concatenate(tnode), np.concatenate(routeids), directed)
+
+    def pairs(self):
+        """
+        Expand the index to aligned arrays of edge node IDs and routeids (one entry per edge and route)
+        :return: 3 numpy int64 arrays: fnode, tnode, and routeids
+        """
+        keys = np.repeat(self.edge_keys, np.diff(self.indptr))
+        n = max(len(self.node_ids), 1)
+        return self.node_ids[keys // n], self.node_ids[keys % n], self.routeids
+
+    def routes(self, edges):
+        """
+        Routes whose path uses any of the given edges
+        :param edges: List of (fnode, tnode) tuples
+        :return: Sorted numpy int64 array of unique routeids
+        """
+        found = []
+        n = len(self.node_ids)
+        for u, v in edges:
+            u, v = int(u), int(v)
+            if not self.directed:
+                u, v = min(u, v), max(u, v)
+            u_idx, v_idx = np.searchsorted(self.node_ids, [u, v])
+            if u_idx >= n or v_idx >= n or self.node_ids[u_idx] != u or self.node_ids[v_idx] != v:
+                continue
+            key = u_idx * n + v_idx
+            k = np.searchsorted(self.edge_keys, key)
+            if k < len(self.edge_keys) and self.edge_keys[k] == key:
+                found.append(self.routeids[self.indptr[k]:self.indptr[k + 1]])
+        if len(found) == 0:
+            return np.array([], dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+    def replace(self, routeids, paths):
+        """
+        Replace the paths of recomputed routes (the index is rebuilt in place)
+        :param routeids: Array of routeids to remove
+        :param paths: Iterable of (routeid, list of node IDs) tuples to add
+        :return: None
+        """
+        fnode, tnode, old_routeids = self.pairs()
+        keep = ~np.isin(old_routeids, np.asarray(routeids, dtype=np.int64))
+        new = EdgeRouteIndex.build(paths, self.directed)
+        new_fnode, new_tnode, new_routeids = new.pairs()
+        rebuilt = EdgeRouteIndex.from_pairs(np.concatenate([fnode[keep], new_fnode]), np.concatenate([tnode[keep], new_tnode]),
+                                            np.concatenate([old_routeids[keep], new_routeids]), self.directed)
+        self.__dict__.update(rebuilt.__dict__)
+
+    def save(self, path):
+        """
+        Save the index to a numpy .npz file
+        :param path: String containing path to the output file
+        :return: None
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        np.savez(path, node_ids=self.node_ids, edge_keys=self.edge_keys, indptr=self.indptr, routeids=self.routeids,
+                 directed=self.directed)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index saved with save()
+        :param path: String containing path to the .npz file
+        :return: EdgeRouteIndex
+        """
+        data = np.load(path)
+        return cls(data['node_ids'], data['edge_keys'], data['indptr'], data['routeids'], bool(data['directed']))
@@ -0,0 +1,213 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Functions related to run instrumentation: per-stage timers and counters, reported through pluggable sinks
+# (structured log line, CSV file, or Prometheus text file)
+
+# IMPORTS
+import csv
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+# CLASSES
+class Metrics:
+    """
+    Registry of counters (rows fetched, searches, settled nodes, bytes written, errors by exception type, ...) and timers
+    (calls, total and max seconds per stage). Updates take one lock, so the registry can be shared by the pipeline
+    threads; helpers add per-batch totals rather than per-route increments to keep the overhead negligible.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        """
+        Add to a counter
+        :param name: String containing counter name (e.g. 'rows_fetched')
+        :param value: (optional) Number to add
+        :return: None
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def count_errors(self, errors):
+        """
+        Count routing errors by exception type (counters 'errors.{exception class}')
+        :param errors: List of error dictionaries with an 'exception' key (find_shortest_route())
+        :return: None
+        """
+        for err in errors:
+            self.count('errors.{}'.format(type(err['exception']).__name__))
+
+    def add_time(self, name, seconds, calls=1):
+        """
+        Add elapsed time to a timer (the max is tracked per add_time() call, i.e. the mean per call when calls > 1)
+        :param name: String containing timer name (e.g. 'db_read')
+        :param seconds: Elapsed seconds
+        :param calls: (optional) Number of calls the elapsed time covers
+        :return: None
+        """
+        with self._lock:
+            n, total, longest = self.timers.get(name, (0, 0.0, 0.0))
+            self.timers[name] = (n + calls, total + seconds, max(longest, seconds / max(calls, 1)))
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Context manager timing one call of a stage
+        :param name: String containing timer name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        """
+        Copy of the current values
+        :return: Dictionary {'counters': {name: value}, 'timers': {name: (calls, total seconds, max seconds)}}
+        """
+        with self._lock:
+            return {'counters': dict(self.counters), 'timers': dict(self.timers)}
+
+    def merge(self, snapshot):
+        """
+        Add the values of a snapshot (e.g. from a worker process) to this registry
+        :param snapshot: Dictionary (snapshot())
+        :return: None
+        """
+        for name, value in snapshot['counters'].items():
+            self.count(name, value)
+        with self._lock:
+            for name, (calls, total, longest) in snapshot['timers'].items():
+                n, t, m = self.timers.get(name, (0, 0.0, 0.0))
+                self.timers[name] = (n + calls, t + total, max(m, longest))
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.timers = {}
+
+
+class LogSink:
+    """
+    Report all metrics as one structured (key=value) log line, led by the context values of the report (batch, rows, ...)
+    """
+    def write(self, snapshot, context=None):
+        items = ['{}={}'.format(name, value) for name, value in (context or {}).items()]
+        items += ['{}={}'.format(name, value) for name, value in sorted(snapshot['counters'].items())]
+        for name, (calls, total, longest) in sorted(snapshot['timers'].items()):
+            items.append('{}.calls={} {}.sec={:.4f} {}.max_sec={:.4f}'.format(name, calls, name, total, name, longest))
+        logger.info('metrics %s', ' '.join(items))
+
+
+class CSVSink:
+    """
+    Append metrics to a CSV file (timestamp, metric, value), one row per value and report (context values first)
+    """
+    def __init__(self, path):
+        """
+        :param path: String containing path to the CSV file (created with a header row if missing)
+        """
+        self.path = path
+
+    def write(self, snapshot, context=None):
+        new_file = not os.path.exists(self.path)
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+        with open(self.path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(['timestamp', 'metric', 'value'])
+            for name, value in (context or {}).items():
+                writer.writerow([stamp, name, value])
+            for name, value in sorted(snapshot['counters'].items()):
+                writer.writerow([stamp, name, value])
+            for name, (calls, total, longest) in sorted(snapshot['timers'].items()):
+                writer.writerow([stamp, '{}.calls'.format(name), calls])
+                writer.writerow([stamp, '{}.sec'.format(name), round(total, 6)])
+                writer.writerow([stamp, '{}.max_sec'.format(name), round(longest, 6)])
+
+
+class PrometheusSink:
+    """
+    Write metrics in the Prometheus text exposition format (node_exporter textfile collector). The file is replaced
+    atomically, so a scrape never sees a partial file. Error counters become one metric with a 'type' label, numeric
+    context values of the last report (batch, rows, ...) become gauges.
+    """
+    def __init__(self, path, prefix='abm'):
+        """
+        :param path: String containing path to the .prom file
+        :param prefix: (optional) Metric name prefix
+        """
+        self.path = path
+        self.prefix = prefix
+
+    def write(self, snapshot, context=None):
+        lines = []
+        errors = {}
+        for name, value in (context or {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                metric = '{}_last_{}'.format(self.prefix, name)
+                lines += ['# TYPE {} gauge'.format(metric), '{} {}'.format(metric, value)]
+        for name, value in sorted(snapshot['counters'].items()):
+            if name.startswith('errors.'):
+                errors[name[len('errors.'):]] = value
+                continue
+            metric = '{}_{}_total'.format(self.prefix, name.replace('.', '_'))
+            lines += ['# TYPE {} counter'.format(metric), '{} {}'.format(metric, value)]
+        if errors:
+            metric = '{}_errors_total'.format(self.prefix)
+            lines.append('# TYPE {} counter'.format(metric))
+            lines += ['{}{{type="{}"}} {}'.format(metric, err, value) for err, value in sorted(errors.items())]
+        for name, (calls, total, longest) in sorted(snapshot['timers'].items()):
+            metric = '{}_{}_seconds'.format(self.prefix, name.replace('.', '_'))
+            lines += ['# TYPE {}_total counter'.format(metric), '{}_total {}'.format(metric, total),
+                      '# TYPE {}_calls_total counter'.format(metric), '{}_calls_total {}'.format(metric, calls),
+                      '# TYPE {}_max gauge'.format(metric), '{}_max {}'.format(metric, longest)]
+
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.path)
+
+
+# shared registry used by the helper modules
+METRICS = Metrics()
+
+
+# FUNCTIONS
+def make_sink(kind, path=None):
+    """
+    Create a metrics sink
+    :param kind: 'log', 'csv', or 'prometheus'
+    :param path: (optional) String containing output file path ('csv' and 'prometheus' only)
+    :return: LogSink, CSVSink, or PrometheusSink
+    """
+    if kind == 'log':
+        return LogSink()
+    if kind == 'csv':
+        return CSVSink(path or 'metrics.csv')
+    if kind == 'prometheus':
+        return PrometheusSink(path or 'metrics.prom')
+    raise ValueError("Unknown metrics sink '{}'".format(kind))
+
+
+def report_metrics(sinks, metrics=METRICS, **context):
+    """
+    Write the current metrics to one or more sinks
+    :param sinks: Sink or list of sinks (make_sink())
+    :param metrics: (optional) Metrics registry (default: the shared METRICS registry)
+    :param context: (optional) Values describing this report, e.g. batch=12, rows=10000, errors=3, sec=41.2
+    :return: None
+    """
+    if not isinstance(sinks, (list, tuple)):
+        sinks = [sinks]
+    snapshot = metrics.snapshot()
+    for sink in sinks:
+        sink.write(snapshot, context)
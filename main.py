@@ -2,11 +2,25 @@
 
 # Notes: Python 3.8 environment (abmsd_env), use EPSG 2230 projection for all (SG originally in 4326)
 
+import logging
+import os
 import time
-from db_implementation import shp2dbtable, csv2dbtable, create_project_tables, set_primary_key, set_foreign_key, create_spatial_index
-from network_analysis import create_networkx_object, get_od_routes, find_shortest_route, routes2dbtable
+from functools import partial
+from db_implementation import shp2dbtable, csv2dbtable, create_project_tables, set_primary_key, set_foreign_key, create_spatial_index, snap_points_to_nodes
+from network_analysis import create_networkx_object, create_csr_graph, create_csr_graph_cached, get_edges_fingerprint, get_od_routes, get_od_batch, iter_od_batches, stream_od_routes, od_records2df, find_shortest_route, find_shortest_route_modes, routes2dbtable, add_route_columns, routes2dbtable_copy, routes2dbtable_copy_modes
 from passwords import get_db_pass
-from util import get_next_routeid
+from parallel_routing import ParallelRouter
+from pipeline import run_pipeline
+from contraction_hierarchy import build_contraction_hierarchy, ContractionHierarchy
+from incremental import EdgeRouteIndex, get_changed_edges, read_route_paths, refresh_changed_routes
+from instrumentation import make_sink, report_metrics
+from worker import run_worker
+from route_stats import RouteStats, report_route_stats
+from node_index import load_node_index
+from accessibility import get_accessibility_nodes, compute_accessibility, accessibility2dbtable
+from point_query import PointRouter
+from travel_matrix import get_matrix_nodes, write_travel_matrix
+from util import get_next_routeid, sqlalchemy_engine, create_batch_ledger, reset_running_batches, claim_batch, finish_batch, finish_batch_sql, fail_batch
 
 # file paths
 ROADS_SHP = './data/RoadsAll_2017.shp'
@@ -24,14 +38,50 @@ DB_CONN = {
     'user': 'jembury',
     'password': DB_PASS
 }
+DB_POOL_SIZE = 5  # connections kept open in the shared pool (sqlalchemy_engine())
 
 # network analysis variables
 ROW_LIMIT = 10000
 WALK = True
 DRIVE = False
+MULTI_MODE = False  # True: walk and drive routes in one pass (one CSRGraph, one O-D read and one write per batch), WALK/DRIVE are ignored (no LEDGER_TABLE, WORKER, or PROCESSES > 1)
+WALK_MAX_COST = 6000  # walk search budget in seconds (5 miles at 3 mph), pairs beyond it get an empty path and NULL time
+BY_ORIGIN = True  # one single-source search per origin node instead of one search per O-D pair
+SYMMETRIC = False  # route each unordered O-D pair once and reuse the reversed path for the opposite direction (undirected graph only)
+CSR_GRAPH = False  # True: array-backed CSRGraph with scipy.sparse.csgraph routing, False: NetworkX graph
+NODE_INDEX_FILE = None  # dense node index (.npy, also stored as esco.nodes.nodeidx): O-D batches carry dense node indices, graphs are numbered by them
+GRAPH_CACHE_DIR = None  # local graph snapshot directory (memory-mapped arrays, rebuilt only when esco.edges changes)
+PROCESSES = 1  # number of worker processes sharing the graph (1 = route in the main process)
+COPY_WRITE = True  # True: COPY into a staging table + one UPDATE ... FROM per batch, False: one UPDATE per route
+PIPELINE = False  # True: overlap fetching, routing, and writing of consecutive batches
+QUEUE_SIZE = 2  # (PIPELINE only) maximum number of batches waiting between two stages
+SERVER_CURSOR = True  # (PIPELINE only) stream batches through one server-side cursor instead of one query per batch
+PATH_FORMAT = 'text'  # route path storage: 'text' (str(list)), 'bytea' (delta-encoded varints), 'array' (BIGINT[]), None (times only, needs LEDGER_TABLE)
+MATRIX_DIR = None  # write a memory-mapped res/poi x poi travel time matrix to this directory instead of od_routes rows
+ACCESS_TABLE = None  # per-origin accessibility table (e.g. 'accessibility'): POIs reachable from each res node within ACCESS_THRESHOLDS, no od_routes rows
+ACCESS_THRESHOLDS = [300, 600, 900, 1800]  # (ACCESS_TABLE only) travel time thresholds in seconds, one column each (e.g. walk_5min)
+ACCESS_POI_TABLE = None  # (ACCESS_TABLE only) weight each node by its POIs in this table (e.g. 'sg_poi'), None: count esco.nodes.poi nodes
+CH_FILE = None  # (MATRIX_DIR only) contraction hierarchy .npz file, built on first use and reused while the edges fingerprint is unchanged
+CHANGED_EDGEIDS = None  # edited esco.edges edgeid values, e.g. [101, 102]: recompute only the routes they affect ([]: deleted edges only, found from EDGE_INDEX_FILE)
+CHANGED_ROADSEGIDS = None  # edited roadsegid values (all edges of the road segments), same as CHANGED_EDGEIDS
+EDGE_INDEX_FILE = 'edge_routes.npz'  # (CHANGED_* only) edge -> route reverse index, built from the stored paths on first use
+LEDGER_TABLE = None  # batch ledger table (e.g. 'od_batches') for checkpoint/resume, None: resume with get_next_routeid()
+MAX_ATTEMPTS = 3  # (LEDGER_TABLE only) failed batches are retried until they reach this number of attempts
+WORKER = False  # (LEDGER_TABLE only) True: run as one of many workers (any host) claiming leased batches from the ledger
+LEASE_SECONDS = 600  # (WORKER only) batches of a worker that stops renewing its lease are reclaimed after this many seconds
+RESULTS_TABLE = None  # (COPY_WRITE only) append results to this table instead of updating od_routes (no resume)
+METRICS_SINK = 'log'  # run metrics (timers and counters) reported after every batch: 'log', 'csv', or 'prometheus'
+METRICS_FILE = None  # (METRICS_SINK 'csv' or 'prometheus') output file, e.g. 'metrics.csv' or '/var/lib/node_exporter/abm.prom'
+STATS_DIR = None  # travel time summary and frequency tables (route_stats_*.csv) written here at the end of the run, None: log only
 
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    metrics_sink = make_sink(METRICS_SINK, METRICS_FILE)
+
+    # create the shared connection pool used by all database helpers
+    sqlalchemy_engine(DB_CONN, pool_size=DB_POOL_SIZE, pool_pre_ping=True)
+
     ##############
     # RAW SCHEMA #
     ##############
@@ -55,6 +105,10 @@ if __name__ == '__main__':
     # set_primary_key(DB_CONN, 'esco', 'sg_poi', 'placekey_pk', ['placekey'])
     # create_spatial_index(DB_CONN, 'esco', 'sg_poi', 'idx_sg_poi_geometry', 'geometry', False)
 
+    # nearest network node of each res parcel and poi (replaces the nearest neighbor SQL in esco_schema.sql)
+    # snap_points_to_nodes(DB_CONN, 'esco', 'parcels_2017', 'resid', 'esco', 'nodes')
+    # snap_points_to_nodes(DB_CONN, 'esco', 'sg_poi', 'placekey', 'esco', 'nodes')
+
     # keys/indexes for node, edge, od tables
     # create_spatial_index(DB_CONN, 'esco', 'nodes', 'idx_nodes_geometry', 'geometry', False)
     # set_foreign_key(DB_CONN, 'esco', 'roads_2017', 'roads_2017_fnode_fk', ['fnode'], 'esco', 'nodes', ['nodeid'])
@@ -72,49 +126,250 @@ if __name__ == '__main__':
     #########################
     od_len = ROW_LIMIT
 
-    if WALK:
-        # create networkx graph object from edges table in database (no freeways, highways, or ramps)
-        G = create_networkx_object(DB_CONN, 'esco', 'edges', walk=True)
+    # the multi-mode driver reads batches itself (no ledger, workers, or process pool)
+    if MULTI_MODE and (LEDGER_TABLE is not None or WORKER or PROCESSES > 1):
+        raise ValueError('MULTI_MODE cannot be combined with LEDGER_TABLE, WORKER, or PROCESSES > 1')
+    if WORKER and LEDGER_TABLE is None:
+        raise ValueError('WORKER requires LEDGER_TABLE to claim batches from')
+
+    # resume without a ledger (get_next_routeid()) finds the next route by its stored path, so paths must be stored
+    if PATH_FORMAT is None and LEDGER_TABLE is None and MATRIX_DIR is None and ACCESS_TABLE is None and CHANGED_EDGEIDS is None and CHANGED_ROADSEGIDS is None:
+        raise ValueError('PATH_FORMAT None (travel times only) requires LEDGER_TABLE to track finished routes')
+
+    # node ID -> index mapping shared by the graph and O-D reads (built once, reused while esco.nodes is unchanged)
+    node_index = None
+    int_nodes = NODE_INDEX_FILE is not None
+    if int_nodes:
+        node_index = load_node_index(DB_CONN, 'esco', 'nodes', NODE_INDEX_FILE)
+    # NetworkX graphs are labeled by node index for O-D routing only (the matrix, accessibility, and incremental modes look up node IDs)
+    nx_node_index = node_index if MATRIX_DIR is None and ACCESS_TABLE is None and CHANGED_EDGEIDS is None and CHANGED_ROADSEGIDS is None else None
+
+    if MULTI_MODE:
+        # create one graph object for both modes from edges table in database (walk costs are infinite on freeways, highways, and ramps)
+        if GRAPH_CACHE_DIR is not None:
+            G = create_csr_graph_cached(DB_CONN, 'esco', 'edges', GRAPH_CACHE_DIR, multi_mode=True, node_index=node_index)
+        else:
+            G = create_csr_graph(DB_CONN, 'esco', 'edges', multi_mode=True, node_index=node_index)
+        # get first routeid for network analysis (every route gets a drive path)
+        first_routeid = get_next_routeid(DB_CONN, 'esco', 'od_routes')
+        # add path, time, and length columns once (not per batch)
+        add_route_columns(DB_CONN, 'esco', 'od_routes', 'walk_path', 'walk_time_sec', path_format=PATH_FORMAT, col_dist='walk_dist_meters')
+        add_route_columns(DB_CONN, 'esco', 'od_routes', 'drive_path', 'drive_time_sec', path_format=PATH_FORMAT, col_dist='drive_dist_meters')
+    if WALK and not MULTI_MODE:
+        # create graph object from edges table in database (no freeways, highways, or ramps)
+        if GRAPH_CACHE_DIR is not None:
+            G = create_csr_graph_cached(DB_CONN, 'esco', 'edges', GRAPH_CACHE_DIR, walk=True, node_index=node_index)
+            if not CSR_GRAPH:
+                G = G.to_networkx()
+        elif CSR_GRAPH:
+            G = create_csr_graph(DB_CONN, 'esco', 'edges', walk=True, node_index=node_index)
+        else:
+            G = create_networkx_object(DB_CONN, 'esco', 'edges', walk=True, int_nodes=int_nodes, node_index=nx_node_index)
         # get first routeid for network analysis
         first_routeid = get_next_routeid(DB_CONN, 'esco', 'od_routes', walk=True)
-    if DRIVE:
-        # create networkx graph object from edges table in database (all road types)
-        G = create_networkx_object(DB_CONN, 'esco', 'edges')
+        # add path and time columns once (not per batch)
+        if COPY_WRITE:
+            add_route_columns(DB_CONN, 'esco', 'od_routes', 'walk_path', 'walk_time_sec', path_format=PATH_FORMAT)
+    if DRIVE and not MULTI_MODE:
+        # create graph object from edges table in database (all road types)
+        if GRAPH_CACHE_DIR is not None:
+            G = create_csr_graph_cached(DB_CONN, 'esco', 'edges', GRAPH_CACHE_DIR, node_index=node_index)
+            if not CSR_GRAPH:
+                G = G.to_networkx()
+        elif CSR_GRAPH:
+            G = create_csr_graph(DB_CONN, 'esco', 'edges', node_index=node_index)
+        else:
+            G = create_networkx_object(DB_CONN, 'esco', 'edges', int_nodes=int_nodes, node_index=nx_node_index)
         # get first routeid for network analysis
         first_routeid = get_next_routeid(DB_CONN, 'esco', 'od_routes')
+        # add path and time columns once (not per batch)
+        if COPY_WRITE:
+            add_route_columns(DB_CONN, 'esco', 'od_routes', 'drive_path', 'drive_time_sec', path_format=PATH_FORMAT)
+
+    logging.info('Graph object has %s nodes and %s edges.', G.number_of_nodes(), G.number_of_edges())
+
+    # travel time statistics per mode, updated as batches are routed
+    route_stats = {'walk': RouteStats(), 'drive': RouteStats()}
+    mode_stats = route_stats['drive'] if DRIVE else route_stats['walk']
 
-    print('NetworkX graph object has {} nodes and {} edges.'.format(G.number_of_nodes(), G.number_of_edges()))
-    print(od_len, first_routeid)
+    # O-D route batches (the incremental, matrix, accessibility, and multi-mode branches route on their own)
+    od_routing = CHANGED_EDGEIDS is None and CHANGED_ROADSEGIDS is None and MATRIX_DIR is None and ACCESS_TABLE is None and not MULTI_MODE
 
-    while od_len == ROW_LIMIT:
+    # route with a pool of worker processes (graph is inherited by the workers, not copied)
+    router = None
+    if PROCESSES > 1 and od_routing:
+        router = ParallelRouter(G, PROCESSES)
+        route_batch = partial(router.find_shortest_route, symmetric=SYMMETRIC, stats=mode_stats)
+    else:
+        route_batch = partial(find_shortest_route, G, symmetric=SYMMETRIC, stats=mode_stats)
+
+    # incremental update: recompute only the routes affected by edited edges
+    if CHANGED_EDGEIDS is not None or CHANGED_ROADSEGIDS is not None:
+        col_cost, col_path, max_cost = ('time_walk_sec', 'walk_path', WALK_MAX_COST) if WALK else ('time_drive_sec', 'drive_path', None)
+        # reverse index edge -> routes (built from the stored paths, which still follow the old network)
+        if os.path.exists(EDGE_INDEX_FILE):
+            index = EdgeRouteIndex.load(EDGE_INDEX_FILE)
+        else:
+            index = EdgeRouteIndex.build(read_route_paths(DB_CONN, 'esco', 'od_routes', col_path, PATH_FORMAT, ROW_LIMIT, walk=WALK))
+        changed = get_changed_edges(DB_CONN, 'esco', 'edges', CHANGED_EDGEIDS, CHANGED_ROADSEGIDS)
+        paths, errors = refresh_changed_routes(DB_CONN, G, index, changed, 'esco', 'od_routes', col_cost, walk=WALK, path_format=PATH_FORMAT, max_cost=max_cost)
+        index.save(EDGE_INDEX_FILE)
+        logging.info('%s routes recomputed, %s errors', len(paths), len(errors))
+    # dense travel time matrix output (TravelMatrix lookups instead of od_routes rows)
+    elif MATRIX_DIR is not None:
+        origins, destinations = get_matrix_nodes(DB_CONN, 'esco', 'nodes')
+        col_cost, name = ('time_walk_sec', 'walk') if WALK else ('time_drive_sec', 'drive')
+        matrix_graph = G
+        # contraction hierarchy preprocessing (rebuilt when the fingerprint of the edges table changes)
+        if CH_FILE is not None:
+            fingerprint = get_edges_fingerprint(DB_CONN, 'esco', 'edges', WALK)
+            if os.path.exists(CH_FILE):
+                matrix_graph = ContractionHierarchy.load(CH_FILE)
+            if matrix_graph is G or matrix_graph.fingerprint != fingerprint:
+                start = time.time()
+                matrix_graph = build_contraction_hierarchy(G, col_cost)
+                matrix_graph.fingerprint = fingerprint
+                matrix_graph.save(CH_FILE)
+                logging.info('Contraction hierarchy built in %.1f seconds: %s', time.time() - start, CH_FILE)
+        write_travel_matrix(matrix_graph, origins, destinations, col_cost, MATRIX_DIR, name)
+    # accessibility: one bounded search per res node, reachable POIs counted per threshold (no paths stored)
+    elif ACCESS_TABLE is not None:
+        origins, pois, weights = get_accessibility_nodes(DB_CONN, 'esco', 'nodes', 'esco', ACCESS_POI_TABLE)
+        col_cost, name = ('time_walk_sec', 'walk') if WALK else ('time_drive_sec', 'drive')
         st = time.time()
+        counts = compute_accessibility(G, origins, pois, col_cost, ACCESS_THRESHOLDS, weights)
+        accessibility2dbtable(DB_CONN, 'esco', ACCESS_TABLE, origins, counts, ACCESS_THRESHOLDS, name)
+        logging.info('Accessibility of %s origins took %.1f seconds.', len(origins), time.time() - st)
+    # multi-mode driver: walk and drive routes of each batch from one read, written together
+    elif MULTI_MODE:
+        batches = iter_od_batches(DB_CONN, 'esco', 'od_routes', ROW_LIMIT, first_routeid, node_index=node_index)
+        route = partial(find_shortest_route_modes, G, col_id='routeid', col_orig='node_orig', col_dest='node_dest', path_format=PATH_FORMAT, walk_max_cost=WALK_MAX_COST, stats=route_stats)
+        write = partial(routes2dbtable_copy_modes, DB_CONN, 'esco', 'od_routes', path_format=PATH_FORMAT)
+        if PIPELINE:
+            run_pipeline(batches, route, write, QUEUE_SIZE)
+        else:
+            for od in batches:
+                st = time.time()
+                paths, errors = route(od)
+                write(paths)
+                report_metrics(metrics_sink, rows=len(od), errors=len(errors), sec=round(time.time() - st, 3))
+    # distributed workers: every worker process (on any host) runs this branch against the same ledger
+    elif LEDGER_TABLE is not None and WORKER:
+        if WALK:
+            mode, col_cost, col_path, col_time, max_cost = 'walk', 'time_walk_sec', 'walk_path', 'walk_time_sec', WALK_MAX_COST
+        if DRIVE:
+            mode, col_cost, col_path, col_time, max_cost = 'drive', 'time_drive_sec', 'drive_path', 'drive_time_sec', None
+        # safe to run from every worker (batches are only created once)
+        create_batch_ledger(DB_CONN, 'esco', LEDGER_TABLE, 'esco', 'od_routes', mode, ROW_LIMIT)
+        route = partial(route_batch, col_id='routeid', col_orig='node_orig', col_dest='node_dest', col_cost=col_cost, walk=WALK, by_origin=BY_ORIGIN, path_format=PATH_FORMAT, max_cost=max_cost)
+        # COPY write, so results and the batch's 'done' status are committed together
+        write = partial(routes2dbtable_copy, DB_CONN, 'esco', 'od_routes', col_path, col_time, results_table=RESULTS_TABLE, path_format=PATH_FORMAT)
+        run_worker(DB_CONN, 'esco', LEDGER_TABLE, 'esco', 'od_routes', mode, route, write, LEASE_SECONDS, MAX_ATTEMPTS, node_index=node_index)
+    # batch ledger driver: claim batches from the ledger, results and 'done' status are committed together
+    elif LEDGER_TABLE is not None:
         if WALK:
-            # get routes from routes table in database
-            od = get_od_routes(DB_CONN, 'esco', 'od_routes', od_len, first_routeid, walk=True)
-            # find shortest routes using Dijkstra's algorithm and calculate travel times
-            paths, errors = find_shortest_route(G, od, 'routeid', 'node_orig', 'node_dest', 'time_walk_sec', walk=True)
-            # commit paths and travel times to the routes table in database
-            routes2dbtable(DB_CONN, 'esco', 'od_routes', 'walk_path', 'walk_time_sec', paths, walk=True)
-            # get first_routeid for next iteration
-            od_len = len(od)
-            first_routeid = get_next_routeid(DB_CONN, 'esco', 'od_routes', walk=True)
+            mode, col_cost, col_path, col_time, max_cost = 'walk', 'time_walk_sec', 'walk_path', 'walk_time_sec', WALK_MAX_COST
         if DRIVE:
-            # get routes from routes table in database
-            od = get_od_routes(DB_CONN, 'esco', 'od_routes', od_len, first_routeid)
-            # find shortest routes using Dijkstra's algorithm and calculate travel times
-            paths, errors = find_shortest_route(G, od, 'routeid', 'node_orig', 'node_dest', 'time_drive_sec')
-            # commit paths and travel times to the routes table in database
-            routes2dbtable(DB_CONN, 'esco', 'od_routes', 'drive_path', 'drive_time_sec', paths)
-            # get first_routeid for next iteration
-            od_len = len(od)
-            first_routeid += od_len
-
-        # print('Shortest path routes: ', paths)
-        if len(errors) > 0:
-            print('Shortest path errors: ', len(errors))
+            mode, col_cost, col_path, col_time, max_cost = 'drive', 'time_drive_sec', 'drive_path', 'drive_time_sec', None
+        create_batch_ledger(DB_CONN, 'esco', LEDGER_TABLE, 'esco', 'od_routes', mode, ROW_LIMIT)
+        reset_running_batches(DB_CONN, 'esco', LEDGER_TABLE, mode)
+
+        batch = claim_batch(DB_CONN, 'esco', LEDGER_TABLE, mode, MAX_ATTEMPTS)
+        while batch is not None:
+            st = time.time()
+            try:
+                od = get_od_batch(DB_CONN, 'esco', 'od_routes', batch['first_routeid'], batch['last_routeid'], walk=WALK, node_index=node_index)
+                paths, errors = route_batch(od, 'routeid', 'node_orig', 'node_dest', col_cost, walk=WALK, by_origin=BY_ORIGIN, path_format=PATH_FORMAT, max_cost=max_cost)
+                if COPY_WRITE:
+                    routes2dbtable_copy(DB_CONN, 'esco', 'od_routes', col_path, col_time, paths, RESULTS_TABLE, PATH_FORMAT,
+                                        finish_batch_sql('esco', LEDGER_TABLE, batch['batchid'], len(errors)))
+                else:
+                    routes2dbtable(DB_CONN, 'esco', 'od_routes', col_path, col_time, paths, walk=WALK, path_format=PATH_FORMAT)
+                    finish_batch(DB_CONN, 'esco', LEDGER_TABLE, batch['batchid'], len(errors))
+                report_metrics(metrics_sink, batch=batch['batchid'], rows=len(od), errors=len(errors), sec=round(time.time() - st, 3))
+            except Exception as e_message:
+                fail_batch(DB_CONN, 'esco', LEDGER_TABLE, batch['batchid'], e_message)
+                logging.warning('Batch %s failed (attempt %s): %s', batch['batchid'], batch['attempts'], e_message)
+                report_metrics(metrics_sink, batch=batch['batchid'], failed=1, sec=round(time.time() - st, 3))
+            batch = claim_batch(DB_CONN, 'esco', LEDGER_TABLE, mode, MAX_ATTEMPTS)
+    # pipelined driver: the next batch is fetched and the last batch is written while the current batch is routed
+    elif PIPELINE:
+        if WALK:
+            if SERVER_CURSOR and SYMMETRIC:
+                # both directions of a pair in one batch, resume from the routes without a stored path
+                batches = map(partial(od_records2df, node_index=node_index), stream_od_routes(DB_CONN, 'esco', 'od_routes', ROW_LIMIT, walk=True, symmetric=True, col_path='walk_path'))
+            elif SERVER_CURSOR:
+                batches = map(partial(od_records2df, node_index=node_index), stream_od_routes(DB_CONN, 'esco', 'od_routes', ROW_LIMIT, first_routeid, walk=True))
+            else:
+                batches = iter_od_batches(DB_CONN, 'esco', 'od_routes', ROW_LIMIT, first_routeid, walk=True, node_index=node_index)
+            route = partial(route_batch, col_id='routeid', col_orig='node_orig', col_dest='node_dest', col_cost='time_walk_sec', walk=True, by_origin=BY_ORIGIN, path_format=PATH_FORMAT, max_cost=WALK_MAX_COST)
+            if SERVER_CURSOR and SYMMETRIC:
+                # every pair routed from its smaller node ID (batches are ordered by it)
+                route = partial(route, symmetric='canonical')
+            if COPY_WRITE:
+                write = partial(routes2dbtable_copy, DB_CONN, 'esco', 'od_routes', 'walk_path', 'walk_time_sec', results_table=RESULTS_TABLE, path_format=PATH_FORMAT)
+            else:
+                write = partial(routes2dbtable, DB_CONN, 'esco', 'od_routes', 'walk_path', 'walk_time_sec', walk=True, path_format=PATH_FORMAT)
+        if DRIVE:
+            if SERVER_CURSOR and SYMMETRIC:
+                batches = map(partial(od_records2df, node_index=node_index), stream_od_routes(DB_CONN, 'esco', 'od_routes', ROW_LIMIT, symmetric=True, col_path='drive_path'))
+            elif SERVER_CURSOR:
+                batches = map(partial(od_records2df, node_index=node_index), stream_od_routes(DB_CONN, 'esco', 'od_routes', ROW_LIMIT, first_routeid))
+            else:
+                batches = iter_od_batches(DB_CONN, 'esco', 'od_routes', ROW_LIMIT, first_routeid, node_index=node_index)
+            route = partial(route_batch, col_id='routeid', col_orig='node_orig', col_dest='node_dest', col_cost='time_drive_sec', by_origin=BY_ORIGIN, path_format=PATH_FORMAT)
+            if SERVER_CURSOR and SYMMETRIC:
+                route = partial(route, symmetric='canonical')
+            if COPY_WRITE:
+                write = partial(routes2dbtable_copy, DB_CONN, 'esco', 'od_routes', 'drive_path', 'drive_time_sec', results_table=RESULTS_TABLE, path_format=PATH_FORMAT)
+            else:
+                write = partial(routes2dbtable, DB_CONN, 'esco', 'od_routes', 'drive_path', 'drive_time_sec', path_format=PATH_FORMAT)
+        # logs a per-stage throughput report when finished
+        run_pipeline(batches, route, write, QUEUE_SIZE)
+    else:
+        while od_len == ROW_LIMIT:
+            st = time.time()
+            if WALK:
+                # get routes from routes table in database
+                od = get_od_routes(DB_CONN, 'esco', 'od_routes', od_len, first_routeid, walk=True, node_index=node_index)
+                # find shortest routes using Dijkstra's algorithm and calculate travel times
+                paths, errors = route_batch(od, 'routeid', 'node_orig', 'node_dest', 'time_walk_sec', walk=True, by_origin=BY_ORIGIN, path_format=PATH_FORMAT, max_cost=WALK_MAX_COST)
+                # commit paths and travel times to the routes table in database
+                if COPY_WRITE:
+                    routes2dbtable_copy(DB_CONN, 'esco', 'od_routes', 'walk_path', 'walk_time_sec', paths, RESULTS_TABLE, PATH_FORMAT)
+                else:
+                    routes2dbtable(DB_CONN, 'esco', 'od_routes', 'walk_path', 'walk_time_sec', paths, walk=True, path_format=PATH_FORMAT)
+                # get first_routeid for next iteration
+                od_len = len(od)
+                first_routeid = get_next_routeid(DB_CONN, 'esco', 'od_routes', walk=True)
+            if DRIVE:
+                # get routes from routes table in database
+                od = get_od_routes(DB_CONN, 'esco', 'od_routes', od_len, first_routeid, node_index=node_index)
+                # find shortest routes using Dijkstra's algorithm and calculate travel times
+                paths, errors = route_batch(od, 'routeid', 'node_orig', 'node_dest', 'time_drive_sec', by_origin=BY_ORIGIN, path_format=PATH_FORMAT)
+                # commit paths and travel times to the routes table in database
+                if COPY_WRITE:
+                    routes2dbtable_copy(DB_CONN, 'esco', 'od_routes', 'drive_path', 'drive_time_sec', paths, RESULTS_TABLE, PATH_FORMAT)
+                else:
+                    routes2dbtable(DB_CONN, 'esco', 'od_routes', 'drive_path', 'drive_time_sec', paths, path_format=PATH_FORMAT)
+                # get first_routeid for next iteration
+                od_len = len(od)
+                first_routeid += od_len
+
+            # print('Shortest path routes: ', paths)
             # print('Shortest path errors: ', len(errors), ' ', errors)
-        et = time.time()
-        processing_time = et - st
-        print("Last loop took {} seconds. Next loop has {} rows, starting with 'routeid' {}.".format(processing_time, od_len, first_routeid))
+            et = time.time()
+            processing_time = et - st
+            report_metrics(metrics_sink, rows=od_len, errors=len(errors), sec=round(processing_time, 3), next_routeid=first_routeid)
+
+    if router is not None:
+        router.close()
+
+    report_metrics(metrics_sink)
+    # summary tables from the streaming statistics (no queries on od_routes)
+    report_route_stats(route_stats, STATS_DIR)
 
-    print("Complete.")
+    # ad-hoc point queries between full matrix builds (A* guided by the node coordinates of esco.nodes)
+    # router = PointRouter(create_csr_graph(DB_CONN, 'esco', 'edges', walk=True, nodes_table='nodes'), 'time_walk_sec')
+    # path, time_sec, settled = router.route(orig_nodeid, dest_nodeid)
+    logging.info('Complete.')
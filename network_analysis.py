@@ -2,54 +2,259 @@
 # Functions related to network analysis for the O-D cost-distance matrix
 
 # IMPORTS
+import csv
+from functools import partial
+import io
+import logging
+import os
+import time
 import pandas as pd
 import numpy
 from psycopg2.extensions import register_adapter, AsIs
 import networkx as nx
-from sqlalchemy import Table, Column, Integer, String, MetaData, ForeignKey, update, text, bindparam
-from util import sqlalchemy_engine
+from scipy.sparse.csgraph import dijkstra
+from sqlalchemy import Table, Column, Integer, BigInteger, String, LargeBinary, MetaData, ForeignKey, update, text, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY
+from util import db_connection, db_raw_connection, LeaseLostError, read_sql
+from instrumentation import METRICS
+from csr_graph import CSRGraph
+from node_index import NodeIndex
+from path_codec import PATH_TYPES, format_path, encode_tree
+
+logger = logging.getLogger(__name__)
+
+# output columns of a multi-mode batch (find_shortest_route_modes())
+ROUTE_MODE_COLUMNS = ['walk_path', 'walk_time_sec', 'walk_dist_meters', 'drive_path', 'drive_time_sec', 'drive_dist_meters']
+
+
+# fixes numpy int64 values so they work with psycopg2 (registered once, on import)
+def addapt_numpy_float64(numpy_float64):
+    return AsIs(numpy_float64)
+def addapt_numpy_int64(numpy_int64):
+    return AsIs(numpy_int64)
+register_adapter(numpy.float64, addapt_numpy_float64)
+register_adapter(numpy.int64, addapt_numpy_int64)
 
 
 # FUNCTIONS
-def create_networkx_object(dbparams, edge_schema, edge_table, walk=False):
+def create_networkx_object(dbparams, edge_schema, edge_table, walk=False, int_nodes=False, nodes_table=None, node_index=None):
     """
     Create a directional NetworkX graph object using a Postgres table with the following columns:
         edge, fnode, tnode, dist_meters, travel_time_sec
-    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname)
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
     :param edge_schema: String containing database schema name
     :param edge_table: String containing database table name
     :param walk: Boolean, True if walking routes and False for driving routes
+    :param int_nodes: (optional) Boolean, if True - node IDs are Python integers and costs are floats instead of
+        Decimals (NUMERIC), compare equal to the int64 O-D node IDs of od_node_index()
+    :param nodes_table: (optional) String containing database table name of the nodes table in edge_schema (e.g.
+        'nodes'), node coordinates are stored as x and y node attributes (point_query.py)
+    :param node_index: (optional) NodeIndex object (node_index.py), the graph's nodes are the dense node indices
+        (graph.graph['node_ids'] maps them back to node IDs), routed with the index columns of the O-D batches
+        (od_node_index(), find_shortest_route()). For O-D routing only: other functions expect node ID labels.
     :return: NetworkX DiGraph
     """
     # SQL to return network info from database
+    if int_nodes or node_index is not None:
+        sql_str = "SELECT edgeid, roadsegid, fnode::BIGINT AS fnode, tnode::BIGINT AS tnode, dist_meters::FLOAT8 AS dist_meters, time_drive_sec::FLOAT8 AS time_drive_sec, time_walk_sec::FLOAT8 AS time_walk_sec, walk from {}.{}".format(edge_schema, edge_table)
+    else:
+        sql_str = "SELECT * from {}.{}".format(edge_schema, edge_table)
     if walk:
-        sql_str = "SELECT * from {}.{} WHERE walk = 1;".format(edge_schema, edge_table)
+        sql_str += " WHERE walk = 1;"
     else:
-        sql_str = "SELECT * from {}.{};".format(edge_schema, edge_table)
+        sql_str += ";"
 
     # connect to database
-    engine = sqlalchemy_engine(dbparams)
-    with engine.connect() as conn:
+    with METRICS.timer('db_read'), db_connection(dbparams) as conn:
         # create pandas dataframe with network info
-        df = pd.read_sql(sql_str, conn)
+        df = read_sql(sql_str, conn)
+    METRICS.count('rows_fetched', len(df))
 
     # create NetworkX Graph
-    # graph = nx.from_pandas_edgelist(df=df, source='fnode', target='tnode', edge_attr=True, create_using=nx.DiGraph)  # directed
-    graph = nx.from_pandas_edgelist(df=df, source='fnode', target='tnode', edge_attr=True)  # undirected
+    with METRICS.timer('graph_build'):
+        # dense node indices (one vectorized lookup per column)
+        if node_index is not None:
+            for col in ['fnode', 'tnode']:
+                df[col] = node_index.index(df[col].to_numpy())
+                if (df[col] < 0).any():
+                    raise ValueError('Edge nodes missing from the node index')
+        # Python integers hash faster than numpy integers
+        if int_nodes or node_index is not None:
+            df['fnode'] = df['fnode'].astype(object)
+            df['tnode'] = df['tnode'].astype(object)
+        # graph = nx.from_pandas_edgelist(df=df, source='fnode', target='tnode', edge_attr=True, create_using=nx.DiGraph)  # directed
+        graph = nx.from_pandas_edgelist(df=df, source='fnode', target='tnode', edge_attr=True)  # undirected
+        if node_index is not None:
+            graph.graph['node_ids'] = node_index.node_ids
+
+    # node coordinates (EPSG 2230 feet)
+    if nodes_table is not None:
+        nodes = list(graph.nodes)
+        node_ids = numpy.array(nodes, dtype=numpy.int64)
+        if node_index is not None:
+            node_ids = node_index.node_ids[node_ids]
+        order = numpy.argsort(node_ids)
+        coords = numpy.empty((len(nodes), 2))
+        coords[order] = get_node_coords(dbparams, edge_schema, nodes_table, node_ids[order])
+        for node, (x, y) in zip(nodes, coords.tolist()):
+            graph.nodes[node]['x'] = x
+            graph.nodes[node]['y'] = y
+
+    return graph
+
+
+def create_csr_graph(dbparams, edge_schema, edge_table, walk=False, directed=False, multi_mode=False, node_index=None, nodes_table=None):
+    """
+    Create an array-backed CSRGraph object (compressed sparse row) using a Postgres table with the following columns:
+        fnode, tnode, dist_meters, time_drive_sec, time_walk_sec, walk
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param edge_schema: String containing database schema name
+    :param edge_table: String containing database table name
+    :param walk: Boolean, True if walking routes and False for driving routes
+    :param directed: (optional) Boolean, True if edges can only be traversed from fnode to tnode
+    :param multi_mode: (optional) Boolean, if True - load every edge once for both modes (find_shortest_route_modes()):
+        time_walk_sec is infinite on edges with walk = 0, and walk_dist_meters/drive_dist_meters hold the length of the
+        parallel edge each mode takes
+    :param node_index: (optional) NodeIndex object (node_index.py), the graph's node indices are the node index's
+        (esco.nodes.nodeidx), so walk and drive graphs share one numbering
+    :param nodes_table: (optional) String containing database table name of the nodes table in edge_schema (e.g.
+        'nodes'), node coordinates are stored in graph.coords (point_query.py)
+    :return: CSRGraph
+    """
+    # SQL to return network info from database (node IDs as integers, costs as floats)
+    sql_str = "SELECT fnode::BIGINT AS fnode, tnode::BIGINT AS tnode, dist_meters::FLOAT8 AS dist_meters, time_drive_sec::FLOAT8 AS time_drive_sec, time_walk_sec::FLOAT8 AS time_walk_sec, walk from {}.{}".format(edge_schema, edge_table)
+    if walk and not multi_mode:
+        sql_str += " WHERE walk = 1;"
+    else:
+        sql_str += ";"
+
+    # connect to database
+    with METRICS.timer('db_read'), db_connection(dbparams) as conn:
+        # create pandas dataframe with network info
+        df = read_sql(sql_str, conn)
+    METRICS.count('rows_fetched', len(df))
+
+    # create CSR graph
+    with METRICS.timer('graph_build'):
+        costs = {col: df[col].to_numpy() for col in ['dist_meters', 'time_drive_sec', 'time_walk_sec']}
+        aligned = None
+        if multi_mode:
+            # no freeways, highways, or ramps for walking routes
+            costs['time_walk_sec'] = numpy.where(df['walk'].to_numpy() == 1, costs['time_walk_sec'], numpy.inf)
+            costs['walk_dist_meters'] = costs['dist_meters']
+            costs['drive_dist_meters'] = costs['dist_meters']
+            aligned = {'walk_dist_meters': 'time_walk_sec', 'drive_dist_meters': 'time_drive_sec'}
+        node_ids = node_index.node_ids if node_index is not None else None
+        graph = CSRGraph.from_edges(df['fnode'].to_numpy(), df['tnode'].to_numpy(), costs, directed, aligned, node_ids)
+
+    # node coordinates (EPSG 2230 feet)
+    if nodes_table is not None:
+        graph.coords = get_node_coords(dbparams, edge_schema, nodes_table, graph.node_ids)
+
+    return graph
+
+
+def get_node_coords(dbparams, nodes_schema, nodes_table, node_ids):
+    """
+    Read the x/y coordinates of the nodes' point geometry
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param nodes_schema: String containing database schema name
+    :param nodes_table: String containing database table name (nodeid, geometry)
+    :param node_ids: Sorted numpy int64 array of node IDs (e.g. CSRGraph.node_ids)
+    :return: Numpy float64 array (number of nodes x 2) aligned with node_ids, NaN for nodes not in the table
+    """
+    # SQL to return node coordinates
+    sql_str = "SELECT nodeid::BIGINT AS nodeid, ST_X(geometry) AS x, ST_Y(geometry) AS y FROM {}.{};".format(nodes_schema, nodes_table)
+
+    # connect to database
+    with METRICS.timer('db_read'), db_connection(dbparams) as conn:
+        df = read_sql(sql_str, conn)
+    METRICS.count('rows_fetched', len(df))
+
+    # align with node_ids
+    coords = numpy.full((len(node_ids), 2), numpy.nan)
+    if len(node_ids) > 0:
+        ids = df['nodeid'].to_numpy(dtype=numpy.int64)
+        pos = numpy.minimum(numpy.searchsorted(node_ids, ids), len(node_ids) - 1)
+        found = node_ids[pos] == ids
+        coords[pos[found]] = df[['x', 'y']].to_numpy(dtype=numpy.float64)[found]
+
+    return coords
+
+
+def get_edges_fingerprint(dbparams, edge_schema, edge_table, walk=False):
+    """
+    Fingerprint of the rows of a Postgres edges table (row count and an order-independent checksum of the row contents),
+    used to detect changes to the network since a graph snapshot was saved
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param edge_schema: String containing database schema name
+    :param edge_table: String containing database table name
+    :param walk: Boolean, True if walking routes and False for driving routes
+    :return: String '{row count}:{checksum}'
+    """
+    # SQL to count and checksum the rows loaded by create_csr_graph()
+    sql_str = "SELECT count(*) AS n, coalesce(sum(hashtext(e::text)::BIGINT), 0) AS checksum from {}.{} e".format(edge_schema, edge_table)
+    if walk:
+        sql_str += " WHERE walk = 1;"
+    else:
+        sql_str += ";"
+
+    # connect to database
+    with db_connection(dbparams) as conn:
+        n, checksum = conn.execute(text(sql_str)).fetchone()
+
+    return '{}:{}'.format(n, checksum)
+
+
+def create_csr_graph_cached(dbparams, edge_schema, edge_table, cache_dir, walk=False, directed=False, multi_mode=False, node_index=None, nodes_table=None):
+    """
+    create_csr_graph() with a local snapshot cache: the graph arrays are saved to {cache_dir}/{edge_table}_{walk|drive|multi}
+    and memory-mapped on later runs, as long as the fingerprint of the edges table (get_edges_fingerprint()) is unchanged
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param edge_schema: String containing database schema name
+    :param edge_table: String containing database table name
+    :param cache_dir: String containing path to the snapshot cache directory
+    :param walk: Boolean, True if walking routes and False for driving routes
+    :param directed: (optional) Boolean, True if edges can only be traversed from fnode to tnode
+    :param multi_mode: (optional) Boolean, True to load the graph for both modes (see create_csr_graph())
+    :param node_index: (optional) NodeIndex object, see create_csr_graph() (a snapshot with other node IDs is rebuilt)
+    :param nodes_table: (optional) String containing database table name of the nodes table, see create_csr_graph() (a
+        snapshot without node coordinates is rebuilt, delete the snapshot after the node geometry changes)
+    :return: CSRGraph
+    """
+    mode = 'multi' if multi_mode else 'walk' if walk else 'drive'
+    graph_dir = os.path.join(cache_dir, '{}_{}_{}'.format(edge_schema, edge_table, mode))
+    if directed:
+        graph_dir += '_directed'
+
+    # reuse the snapshot if the edges table has not changed
+    fingerprint = get_edges_fingerprint(dbparams, edge_schema, edge_table, walk and not multi_mode)
+    meta = CSRGraph.read_meta(graph_dir)
+    if meta is not None and meta.get('fingerprint') == fingerprint:
+        graph = CSRGraph.load(graph_dir)
+        if (node_index is None or numpy.array_equal(graph.node_ids, node_index.node_ids)) and (nodes_table is None or graph.coords is not None):
+            logger.info('Graph snapshot loaded: %s', graph_dir)
+            return graph
+
+    # rebuild from the database and replace the snapshot
+    graph = create_csr_graph(dbparams, edge_schema, edge_table, walk, directed, multi_mode, node_index, nodes_table)
+    graph.save(graph_dir, {'fingerprint': fingerprint})
+    logger.info('Graph snapshot saved: %s', graph_dir)
 
     return graph
 
 
-def get_od_routes(dbparams, routes_schema, routes_table, row_limit=None, first_row=None, walk=False):
+def get_od_routes(dbparams, routes_schema, routes_table, row_limit=None, first_row=None, walk=False, node_index=None):
     """
     Create a Pandas dataframe with O-D route node IDs from a Postgres table with the following columns:
         routeid, node_orig, node_dest
-    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname)
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
     :param routes_schema: String containing database schema name
     :param routes_table: String containing database table name
     :param row_limit: (optional) Number of rows to return
     :param first_row: (optional) First row's 'routeid'
     :param walk: Boolean, True if walking routes and False for driving routes
+    :param node_index: (optional) NodeIndex object, adds the dense node indices of the O-D nodes (od_node_index())
     :return: Pandas dataframe containing routeid, node_orig, and node_dest columns
     """
     # walking routes
@@ -70,45 +275,265 @@ def get_od_routes(dbparams, routes_schema, routes_table, row_limit=None, first_r
             sql_str = "SELECT * from {}.{} WHERE routeid >= {} ORDER by routeid LIMIT {};".format(routes_schema, routes_table, first_row, row_limit)
 
     # connect to data base
-    engine = sqlalchemy_engine(dbparams)
-    with engine.connect() as conn:
+    with METRICS.timer('db_read'), db_connection(dbparams) as conn:
+        # create a Pandas dataframe with O-D info
+        df = read_sql(sql_str, conn)
+    METRICS.count('rows_fetched', len(df))
+
+    if node_index is not None:
+        od_node_index(df, node_index)
+
+    return df
+
+
+def get_od_batch(dbparams, routes_schema, routes_table, first_row, last_row, walk=False, node_index=None):
+    """
+    Create a Pandas dataframe with the O-D routes of one batch (routeid range, see util.claim_batch())
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param routes_schema: String containing database schema name
+    :param routes_table: String containing database table name
+    :param first_row: First 'routeid' of the batch
+    :param last_row: Last 'routeid' of the batch
+    :param walk: Boolean, True if walking routes and False for driving routes
+    :param node_index: (optional) NodeIndex object, adds the dense node indices of the O-D nodes (od_node_index())
+    :return: Pandas dataframe containing routeid, node_orig, and node_dest columns
+    """
+    # SQL to return the batch's routes
+    sql_str = "SELECT routeid, node_orig, node_dest from {}.{} WHERE routeid BETWEEN {} AND {}".format(routes_schema, routes_table, first_row, last_row)
+    if walk:
+        sql_str += " AND walk = 1"
+    sql_str += " ORDER by routeid;"
+
+    # connect to data base
+    with METRICS.timer('db_read'), db_connection(dbparams) as conn:
         # create a Pandas dataframe with O-D info
-        df = pd.read_sql(sql_str, conn)
+        df = read_sql(sql_str, conn)
+    METRICS.count('rows_fetched', len(df))
+
+    if node_index is not None:
+        od_node_index(df, node_index)
+
+    return df
+
+
+def iter_od_batches(dbparams, routes_schema, routes_table, row_limit, first_row, walk=False, node_index=None):
+    """
+    Generator of O-D batches (get_od_routes()) paged by the last routeid of the previous batch, so the next batch can be
+    fetched before the previous batch is written to the database (run_pipeline())
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param routes_schema: String containing database schema name
+    :param routes_table: String containing database table name
+    :param row_limit: Number of rows per batch
+    :param first_row: First batch's 'routeid' (get_next_routeid())
+    :param walk: Boolean, True if walking routes and False for driving routes
+    :param node_index: (optional) NodeIndex object, adds the dense node indices of the O-D nodes (od_node_index())
+    :return: Generator of Pandas dataframes containing routeid, node_orig, and node_dest columns
+    """
+    od_len = row_limit
+    while od_len == row_limit:
+        od = get_od_routes(dbparams, routes_schema, routes_table, row_limit, first_row, walk, node_index)
+        od_len = len(od)
+        if od_len == 0:
+            break
+        # walking routes start after first_row, driving routes start at first_row
+        if walk:
+            first_row = od['routeid'].max()
+        else:
+            first_row = od['routeid'].max() + 1
+        yield od
+
+
+def stream_od_routes(dbparams, routes_schema, routes_table, batch_size, first_row=None, walk=False, symmetric=False, col_path=None):
+    """
+    Generator of fixed-size O-D batches read through one named (server-side) cursor. Only routeid, node_orig, and
+    node_dest are transferred, so memory stays flat regardless of table size.
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param routes_schema: String containing database schema name
+    :param routes_table: String containing database table name
+    :param batch_size: Number of rows per batch
+    :param first_row: (optional) Walking routes start after this 'routeid', driving routes start at this 'routeid'
+    :param walk: Boolean, True if walking routes and False for driving routes
+    :param symmetric: (optional) Boolean, if True - order by unordered node pair, so the pairs of each smaller node ID
+        are consecutive, and end every batch at a pair boundary (whole_pair_batches()), so both directions of an O-D
+        pair arrive in the same batch (route the batches with find_shortest_route(symmetric='canonical')). Batches may
+        then differ slightly from batch_size
+    :param col_path: (optional) String containing name of path column, only routes with no stored path are returned
+        (resume point for symmetric ordering, where routeid order no longer holds)
+    :return: Generator of numpy record arrays with int64 fields routeid, node_orig, and node_dest
+    """
+    # SQL to return the O-D node IDs as integers
+    sql_str = "SELECT routeid, node_orig::BIGINT, node_dest::BIGINT from {}.{}".format(routes_schema, routes_table)
+    conditions = []
+    if walk:
+        conditions.append("walk = 1")
+        if first_row is not None:
+            conditions.append("routeid > {}".format(first_row))
+    elif first_row is not None:
+        conditions.append("routeid >= {}".format(first_row))
+    if col_path is not None:
+        conditions.append("{} IS NULL".format(col_path))
+    if len(conditions) > 0:
+        sql_str += " WHERE " + " AND ".join(conditions)
+    if symmetric:
+        sql_str += " ORDER by LEAST(node_orig, node_dest), GREATEST(node_orig, node_dest), routeid;"
+    else:
+        sql_str += " ORDER by routeid;"
+
+    dtype = [('routeid', numpy.int64), ('node_orig', numpy.int64), ('node_dest', numpy.int64)]
+
+    # connect to database
+    with db_raw_connection(dbparams) as conn:
+        try:
+            # named cursor -> rows stay on the server until fetched
+            cur = conn.cursor(name='stream_{}_{}'.format(routes_schema, routes_table))
+            cur.itersize = batch_size
+            cur.execute(sql_str)
+
+            def fetch():
+                while True:
+                    with METRICS.timer('db_read'):
+                        rows = cur.fetchmany(batch_size)
+                    if len(rows) == 0:
+                        return
+                    METRICS.count('rows_fetched', len(rows))
+                    yield numpy.array(rows, dtype=dtype)
+
+            yield from whole_pair_batches(fetch()) if symmetric else fetch()
+            cur.close()
+        finally:
+            # end the read-only transaction holding the cursor
+            conn.rollback()
+
+
+def whole_pair_batches(batches):
+    """
+    Regroup O-D batches ordered by unordered node pair (stream_od_routes(symmetric=True)) so no pair is split between
+    two batches: the rows of the last pair of a batch are held back and lead the next batch
+    :param batches: Iterable of numpy record arrays with node_orig and node_dest fields
+    :return: Generator of numpy record arrays
+    """
+    pending = None
+    for batch in batches:
+        if pending is not None:
+            batch = numpy.concatenate([pending, batch])
+        lo = numpy.minimum(batch['node_orig'], batch['node_dest'])
+        hi = numpy.maximum(batch['node_orig'], batch['node_dest'])
+        # rows of one pair are consecutive, so the last pair is a suffix of the batch
+        other = numpy.flatnonzero((lo != lo[-1]) | (hi != hi[-1]))
+        cut = other[-1] + 1 if len(other) > 0 else 0
+        pending = batch[cut:]
+        if cut > 0:
+            yield batch[:cut]
+    if pending is not None and len(pending) > 0:
+        yield pending
+
+
+def od_node_index(df, node_index, cols=('node_orig', 'node_dest')):
+    """
+    Map the node ID columns of an O-D dataframe to dense node indices in place, once per batch with one vectorized
+    lookup (NodeIndex.index()): {col}_idx int32 columns (-1 for nodes not in the index) are added and the node IDs
+    become int64. Routing functions use the index columns directly (find_shortest_route()).
+    :param df: Pandas dataframe with node_orig and node_dest columns
+    :param node_index: NodeIndex object (node_index.py)
+    :param cols: (optional) Names of the node ID columns
+    :return: Pandas dataframe
+    """
+    for col in cols:
+        ids = df[col].to_numpy().astype(numpy.int64)
+        df[col] = ids
+        df[index_column(col)] = node_index.index(ids)
+
+    return df
+
+
+def index_column(col):
+    """
+    Name of the dense node index column of a node ID column (od_node_index())
+    :param col: String containing name of node ID column ('node_orig')
+    :return: String ('node_orig_idx')
+    """
+    return '{}_idx'.format(col)
+
+
+def od_records2df(records, node_index=None):
+    """
+    Convert an O-D record batch (stream_od_routes()) to the dataframe expected by find_shortest_route().
+    Node IDs become Python integers, which compare equal to the Decimal node IDs of a NetworkX graph object.
+    :param records: Numpy record array with routeid, node_orig, and node_dest fields
+    :param node_index: (optional) NodeIndex object, node IDs stay int64 and their dense indices are added (od_node_index())
+    :return: Pandas dataframe containing routeid, node_orig, and node_dest columns
+    """
+    df = pd.DataFrame(records)
+    if node_index is not None:
+        return od_node_index(df, node_index)
+    df['node_orig'] = df['node_orig'].astype(object)
+    df['node_dest'] = df['node_dest'].astype(object)
 
     return df
 
 
-def find_shortest_route(graph, routes_df, col_id, col_orig, col_dest, col_cost, walk=False):
+def find_shortest_route(graph, routes_df, col_id, col_orig, col_dest, col_cost, walk=False, by_origin=False, path_format='text', max_cost=None, symmetric=False, stats=None):
     """
     Find the shortest routes for the O-D nodes provided in a Pandas dataframe (get_od_routes()).
     Uses a NetworkX graph object (create_networkx_object()) and Dijkstra's algorithm
-    :param graph: NetworkX DiGraph object
+    :param graph: NetworkX DiGraph object or CSRGraph object (create_csr_graph())
     :param routes_df: Pandas dataframe with routeid, node_orig, and node_dest columns
     :param col_id: String containing name of O-D route ID column ('routeid')
     :param col_orig: String containing name of source node column ('node_orig')
     :param col_dest: String containing name of target node column ('node_dest')
     :param col_cost: String containing name of weight column ('time_drive_sec' or 'time_walk_sec')
     :param walk: Boolean, True if walking routes and False for driving routes
+    :param by_origin: (optional) Boolean, if True - run one single-source search per origin node (find_shortest_routes_by_origin())
+    :param path_format: (optional) Path storage format: 'text' (str(list)), 'bytea' (delta-encoded varints), 'array'
+        (list of integers for a BIGINT[] column), or None (travel times only), see path_codec.format_path()
+    :param max_cost: (optional) Search budget in col_cost units (e.g. 6000 seconds), searches stop once the frontier
+        passes it. Routes beyond the budget get an empty path and a None travel time instead of an error; pairs in
+        different connected components still fail with NetworkXNoPath. Uses one-to-many searches (by_origin) on
+        NetworkX graphs.
+    :param symmetric: (optional) Boolean, if True - route each unordered O-D pair once and copy the result (reversed
+        path) to the opposite direction, see route_symmetric_pairs(). 'canonical': also route every pair from its
+        smaller node ID (batches ordered by stream_od_routes(symmetric=True)). Undirected graphs only.
+    :param stats: (optional) RouteStats object (route_stats.py) updated with the travel times of the batch
     :return: 2 list objects: p (path nodes and travel time for each route) and e (error messages for failed routes)
     """
+    # streaming travel time statistics
+    if stats is not None:
+        p, e = find_shortest_route(graph, routes_df, col_id, col_orig, col_dest, col_cost, walk, by_origin, path_format, max_cost, symmetric)
+        stats.add_routes(p, 'walk_time_sec' if walk else 'drive_time_sec')
+        return p, e
+    # one search per unordered O-D pair
+    if symmetric:
+        if graph.is_directed():
+            raise ValueError('Symmetric O-D pairs can only be shared on an undirected graph')
+        route_batch = partial(find_shortest_route, graph, by_origin=by_origin, max_cost=max_cost)
+        return route_symmetric_pairs(route_batch, routes_df, col_id, col_orig, col_dest, col_cost, walk, path_format, symmetric == 'canonical')
+    # array-backed graph (always searches one origin node at a time)
+    if isinstance(graph, CSRGraph):
+        return find_shortest_routes_csr(graph, routes_df, col_id, col_orig, col_dest, col_cost, walk, path_format, max_cost)
+    # one-to-many searches grouped by origin node
+    if by_origin or max_cost is not None:
+        return find_shortest_routes_by_origin(graph, routes_df, col_id, col_orig, col_dest, col_cost, walk, path_format, max_cost)
+
     p = []  # store paths
     e = []  # store errors
+    search_sec = 0  # time spent in Dijkstra searches
+
+    # graph nodes to search from/to (node indices for a graph labeled by node index)
+    routes_df, col_src, col_tgt, node_ids = graph_node_columns(graph, routes_df, col_orig, col_dest)
 
     if walk:
         # for each O-D pair
         for i, row in routes_df.iterrows():
             try:
-                # find the shortest path
-                path = nx.shortest_path(G=graph, source=routes_df[col_orig][i], target=routes_df[col_dest][i], weight=col_cost, method='dijkstra')
-
-                # calculate the travel time
-                time = 0
-                for j in range(len(path) - 1):
-                    temp_time = graph.get_edge_data(path[j], path[j + 1])
-                    time += temp_time['time_walk_sec']
+                # find the shortest path and its travel time
+                start = time.perf_counter()
+                time_sec, path = nx.single_source_dijkstra(G=graph, source=routes_df[col_src][i], target=routes_df[col_tgt][i], weight=col_cost)
+                search_sec += time.perf_counter() - start
+                if node_ids is not None:
+                    path = node_ids[path].tolist()
 
                 # append path and time info to list
-                p.append({'b_routeid': routes_df[col_id][i], 'walk_path': str(path), 'walk_time_sec': int(round(time, 0))})
+                p.append({'b_routeid': routes_df[col_id][i], 'walk_path': format_path(path, path_format), 'walk_time_sec': int(round(time_sec, 0))})
             except Exception as e_message:
                 # append error info to list
                 e.append({'routeid':routes_df[col_id][i], 'od_pair': [routes_df[col_orig][i], routes_df[col_dest][i]], 'exception': e_message})
@@ -116,55 +541,377 @@ def find_shortest_route(graph, routes_df, col_id, col_orig, col_dest, col_cost,
         # for each O-D pair
         for i, row in routes_df.iterrows():
             try:
-                # find the shortest path
-                path = nx.shortest_path(G=graph, source=routes_df[col_orig][i], target=routes_df[col_dest][i], weight=col_cost, method='dijkstra')
-
-                # calculate the travel time
-                time = 0
-                for j in range(len(path) - 1):
-                    temp_time = graph.get_edge_data(path[j], path[j + 1])
-                    time += temp_time['time_drive_sec']
+                # find the shortest path and its travel time
+                start = time.perf_counter()
+                time_sec, path = nx.single_source_dijkstra(G=graph, source=routes_df[col_src][i], target=routes_df[col_tgt][i], weight=col_cost)
+                search_sec += time.perf_counter() - start
+                if node_ids is not None:
+                    path = node_ids[path].tolist()
 
                 # append path and time info to list
-                p.append({'b_routeid': routes_df[col_id][i], 'drive_path': str(path), 'drive_time_sec': int(round(time, 0))})
+                p.append({'b_routeid': routes_df[col_id][i], 'drive_path': format_path(path, path_format), 'drive_time_sec': int(round(time_sec, 0))})
             except Exception as e_message:
                 # append error info to list
                 e.append({'routeid':routes_df[col_id][i], 'od_pair': [routes_df[col_orig][i], routes_df[col_dest][i]], 'exception': e_message})
 
+    METRICS.add_time('search', search_sec, len(routes_df))
+    METRICS.count('searches', len(routes_df))
+    METRICS.count_errors(e)
+
+    return p, e
+
+
+def route_symmetric_pairs(route_batch, routes_df, col_id, col_orig, col_dest, col_cost, walk=False, path_format='text', canonical=False):
+    """
+    Route the O-D pairs of a batch that appear in both directions only once (undirected graphs: the path from B to A is
+    the reversed path from A to B) and fan the results back out to every routeid. By default, pairs without their
+    opposite direction in the batch keep their orientation, so origins (and one-to-many searches) of batches in routeid
+    order are unchanged. With canonical, every pair is routed from its smaller node ID, which keeps one search per node
+    for batches ordered by LEAST(node_orig, node_dest) (stream_od_routes(symmetric=True)).
+    :param route_batch: Routing function with the find_shortest_route() arguments after the graph (e.g.
+        partial(find_shortest_route, graph) or ParallelRouter.find_shortest_route)
+    :param routes_df: Pandas dataframe with routeid, node_orig, and node_dest columns
+    :param col_id: String containing name of O-D route ID column ('routeid')
+    :param col_orig: String containing name of source node column ('node_orig')
+    :param col_dest: String containing name of target node column ('node_dest')
+    :param col_cost: String containing name of weight column ('time_drive_sec' or 'time_walk_sec')
+    :param walk: Boolean, True if walking routes and False for driving routes
+    :param path_format: (optional) Path storage format: 'text', 'bytea', 'array', or None (see find_shortest_route())
+    :param canonical: (optional) Boolean, if True - route every pair in (min, max) node ID orientation
+    :return: 2 list objects: p (path nodes and travel time for each route) and e (error messages for failed routes)
+    """
+    # output column names
+    if walk:
+        col_path, col_time = 'walk_path', 'walk_time_sec'
+    else:
+        col_path, col_time = 'drive_path', 'drive_time_sec'
+
+    routeids = routes_df[col_id].tolist()
+    origs = routes_df[col_orig].tolist()
+    dests = routes_df[col_dest].tolist()
+
+    # key of each route: (min, max) if canonical or both directions are in the batch, else the pair as is
+    if canonical:
+        keys = [(dest, orig) if orig > dest else (orig, dest) for orig, dest in zip(origs, dests)]
+    else:
+        pairs = set(zip(origs, dests))
+        keys = [(dest, orig) if orig > dest and (dest, orig) in pairs else (orig, dest) for orig, dest in zip(origs, dests)]
+
+    # one representative route per key (first route of the key, routed in the key's orientation)
+    rep_routeid = {}
+    rep_rows = []
+    rep_flip = []
+    for k, (routeid, orig, dest, key) in enumerate(zip(routeids, origs, dests, keys)):
+        if key not in rep_routeid:
+            rep_routeid[key] = routeid
+            rep_rows.append(k)
+            rep_flip.append(key != (orig, dest))
+    rep_df = routes_df.iloc[rep_rows].reset_index(drop=True)
+    # swap the node columns (and their node index columns) of representatives in the opposite orientation
+    flip = numpy.array(rep_flip, dtype=bool)
+    swap = [(col_orig, col_dest)]
+    if index_column(col_orig) in rep_df:
+        swap.append((index_column(col_orig), index_column(col_dest)))
+    for col_a, col_b in swap:
+        values_a, values_b = rep_df[col_a].to_numpy(), rep_df[col_b].to_numpy()
+        rep_df[col_a] = numpy.where(flip, values_b, values_a)
+        rep_df[col_b] = numpy.where(flip, values_a, values_b)
+
+    # route the representatives, keeping the raw paths
+    p_rep, e_rep = route_batch(rep_df, col_id, col_orig, col_dest, col_cost, walk=walk, path_format='list')
+    paths = {row['b_routeid']: row for row in p_rep}
+    errors = {err['routeid']: err['exception'] for err in e_rep}
+    METRICS.count('symmetric_routes_shared', len(routes_df) - len(rep_df))
+
+    p = []  # store paths
+    e = []  # store errors
+    for routeid, orig, dest, key in zip(routeids, origs, dests, keys):
+        rep = rep_routeid[key]
+        if rep in paths:
+            path = paths[rep][col_path]
+            # opposite direction of the representative
+            if key != (orig, dest):
+                path = path[::-1]
+            p.append({'b_routeid': routeid, col_path: format_path(path, path_format), col_time: paths[rep][col_time]})
+        else:
+            e.append({'routeid': routeid, 'od_pair': [orig, dest], 'exception': errors[rep]})
+
     return p, e
 
 
-def routes2dbtable(dbparams, routes_schema, routes_table, col_path, col_cost, paths_list, walk=False):
+def graph_node_columns(graph, routes_df, col_orig, col_dest):
+    """
+    Columns of an O-D batch holding the graph's node labels: the node index columns (od_node_index()) for a NetworkX
+    graph labeled by node index (create_networkx_object(node_index=...)), added to a copy of the batch if missing,
+    else the node ID columns
+    :param graph: NetworkX graph object
+    :param routes_df: Pandas dataframe with node_orig and node_dest columns
+    :param col_orig: String containing name of source node column ('node_orig')
+    :param col_dest: String containing name of target node column ('node_dest')
+    :return: Pandas dataframe, source and target column names, and numpy array of node IDs by graph node (None if the
+        graph is labeled by node ID)
+    """
+    node_ids = graph.graph.get('node_ids')
+    if node_ids is None:
+        return routes_df, col_orig, col_dest, None
+    if index_column(col_orig) not in routes_df or index_column(col_dest) not in routes_df:
+        routes_df = od_node_index(routes_df.copy(), NodeIndex(node_ids), (col_orig, col_dest))
+    return routes_df, index_column(col_orig), index_column(col_dest), node_ids
+
+
+def graph_components(graph):
+    """
+    Connected component label of every node of a NetworkX graph (weakly connected components for a directed graph),
+    computed once per graph and kept in graph.graph['components']. Nodes with different labels are never connected.
+    :param graph: NetworkX graph object
+    :return: Dictionary {node: component label}
+    """
+    if 'components' not in graph.graph:
+        parts = nx.weakly_connected_components(graph) if graph.is_directed() else nx.connected_components(graph)
+        graph.graph['components'] = {node: label for label, nodes in enumerate(parts) for node in nodes}
+    return graph.graph['components']
+
+
+def find_shortest_routes_by_origin(graph, routes_df, col_id, col_orig, col_dest, col_cost, walk=False, path_format='text', max_cost=None):
+    """
+    Find the shortest routes for the O-D nodes provided in a Pandas dataframe (get_od_routes()), running one
+    single-source Dijkstra search per distinct origin node and reading every destination's time and path from that tree
+    :param graph: NetworkX DiGraph object
+    :param routes_df: Pandas dataframe with routeid, node_orig, and node_dest columns
+    :param col_id: String containing name of O-D route ID column ('routeid')
+    :param col_orig: String containing name of source node column ('node_orig')
+    :param col_dest: String containing name of target node column ('node_dest')
+    :param col_cost: String containing name of weight column ('time_drive_sec' or 'time_walk_sec')
+    :param walk: Boolean, True if walking routes and False for driving routes
+    :param path_format: (optional) Path storage format: 'text', 'bytea', 'array', or None (see find_shortest_route())
+    :param max_cost: (optional) Search budget in col_cost units (see find_shortest_route())
+    :return: 2 list objects: p (path nodes and travel time for each route) and e (error messages for failed routes)
+    """
+    p = []  # store paths
+    e = []  # store errors
+
+    # output column names
+    if walk:
+        col_path, col_time = 'walk_path', 'walk_time_sec'
+    else:
+        col_path, col_time = 'drive_path', 'drive_time_sec'
+
+    searches = 0
+    settled = 0
+    search_sec = 0
+
+    # graph nodes to search from/to (node indices for a graph labeled by node index)
+    routes_df, col_src, col_tgt, node_ids = graph_node_columns(graph, routes_df, col_orig, col_dest)
+
+    # component labels tell disconnected pairs (no path) from pairs beyond the search budget
+    components = graph_components(graph) if max_cost is not None else None
+
+    # for each origin node in the batch
+    for source, group in routes_df.groupby(col_src, sort=False):
+        orig = group[col_orig].iloc[0]
+        try:
+            # build the shortest path tree from the origin node (predecessors and travel times to all reachable nodes)
+            start = time.perf_counter()
+            pred, dist = nx.dijkstra_predecessor_and_distance(G=graph, source=source, cutoff=max_cost, weight=col_cost)
+            search_sec += time.perf_counter() - start
+            searches += 1
+            settled += len(dist)
+        except Exception as e_message:
+            # origin not in graph, every route from this origin fails
+            for routeid, dest in zip(group[col_id], group[col_dest]):
+                e.append({'routeid': routeid, 'od_pair': [orig, dest], 'exception': e_message})
+            continue
+
+        # for each destination of this origin
+        for routeid, dest, target in zip(group[col_id], group[col_dest], group[col_tgt]):
+            if target not in dist:
+                # beyond the search budget (same component as the origin)
+                if max_cost is not None and target in components and components[target] == components[source]:
+                    p.append({'b_routeid': routeid, col_path: format_path([], path_format), col_time: None})
+                    continue
+                e.append({'routeid': routeid, 'od_pair': [orig, dest], 'exception': nx.NetworkXNoPath('No path between {} and {}.'.format(orig, dest))})
+                continue
+
+            # walk the predecessor tree back to the origin (skipped if paths are not stored)
+            path = None
+            if path_format is not None:
+                path = [target]
+                while path[-1] != source:
+                    path.append(pred[path[-1]][0])
+                path.reverse()
+                if node_ids is not None:
+                    path = node_ids[path].tolist()
+                path = format_path(path, path_format)
+
+            # append path and time info to list
+            p.append({'b_routeid': routeid, col_path: path, col_time: int(round(dist[target], 0))})
+
+    METRICS.add_time('search', search_sec, searches)
+    METRICS.count('searches', searches)
+    METRICS.count('settled_nodes', settled)
+    METRICS.count_errors(e)
+
+    return p, e
+
+
+def find_shortest_routes_csr(graph, routes_df, col_id, col_orig, col_dest, col_cost, walk=False, path_format='text', max_cost=None, chunk_size=256, col_acc=None):
+    """
+    Find the shortest routes for the O-D nodes provided in a Pandas dataframe (get_od_routes()) on a CSRGraph object
+    (create_csr_graph()). Uses scipy.sparse.csgraph's compiled Dijkstra for up to chunk_size origin nodes per call
+    :param graph: CSRGraph object
+    :param routes_df: Pandas dataframe with routeid, node_orig, and node_dest columns
+    :param col_id: String containing name of O-D route ID column ('routeid')
+    :param col_orig: String containing name of source node column ('node_orig')
+    :param col_dest: String containing name of target node column ('node_dest')
+    :param col_cost: String containing name of weight column ('time_drive_sec' or 'time_walk_sec')
+    :param walk: Boolean, True if walking routes and False for driving routes
+    :param path_format: (optional) Path storage format: 'text', 'bytea', 'array', or None (see find_shortest_route())
+    :param max_cost: (optional) Search budget in col_cost units (see find_shortest_route())
+    :param chunk_size: (optional) Number of origin nodes searched per csgraph call (bounds the distance matrix size)
+    :param col_acc: (optional) String containing name of a graph cost column summed along each path from the same
+        search (CSRGraph.accumulate()), added to the output under the same name (e.g. 'walk_dist_meters')
+    :return: 2 list objects: p (path nodes and travel time for each route) and e (error messages for failed routes)
+    """
+    p = []  # store paths
+    e = []  # store errors
+
+    # output column names
+    if walk:
+        col_path, col_time = 'walk_path', 'walk_time_sec'
+    else:
+        col_path, col_time = 'drive_path', 'drive_time_sec'
+
+    routeids = routes_df[col_id].to_numpy()
+    origs = routes_df[col_orig].to_numpy()
+    dests = routes_df[col_dest].to_numpy()
+    # node indices of the batch (od_node_index(), the graph shares the node index) or looked up in the graph
+    if index_column(col_orig) in routes_df and index_column(col_dest) in routes_df:
+        orig_idx = routes_df[index_column(col_orig)].to_numpy()
+        dest_idx = routes_df[index_column(col_dest)].to_numpy()
+        known = (orig_idx >= 0) & (orig_idx < len(graph.node_ids)) & (dest_idx >= 0) & (dest_idx < len(graph.node_ids))
+        if not (numpy.array_equal(graph.node_ids[orig_idx[known]], origs[known].astype(numpy.int64))
+                and numpy.array_equal(graph.node_ids[dest_idx[known]], dests[known].astype(numpy.int64))):
+            raise ValueError('O-D node indices do not match the graph (build the graph with the same node index)')
+        orig_idx = numpy.where(known, orig_idx, -1)
+        dest_idx = numpy.where(known, dest_idx, -1)
+    else:
+        orig_idx = graph.index(origs)
+        dest_idx = graph.index(dests)
+
+    # routes with a node that is not in the graph
+    for k in numpy.flatnonzero((orig_idx < 0) | (dest_idx < 0)):
+        missing = origs[k] if orig_idx[k] < 0 else dests[k]
+        e.append({'routeid': routeids[k], 'od_pair': [origs[k], dests[k]], 'exception': nx.NodeNotFound('Node {} not found in graph'.format(missing))})
+
+    # component labels tell disconnected pairs (no path) from pairs beyond the search budget
+    components = graph.components(col_cost) if max_cost is not None else None
+
+    # search each chunk of distinct origin nodes
+    sources = numpy.unique(orig_idx[orig_idx >= 0])
+    matrix = graph.matrix(col_cost)
+    for c in range(0, len(sources), chunk_size):
+        chunk = sources[c:c + chunk_size]
+        with METRICS.timer('search'):
+            if max_cost is None:
+                dist, pred = dijkstra(matrix, directed=True, indices=chunk, return_predecessors=True)
+            else:
+                dist, pred = dijkstra(matrix, directed=True, indices=chunk, return_predecessors=True, limit=max_cost)
+        METRICS.count('searches', len(chunk))
+        METRICS.count('settled_nodes', int(numpy.isfinite(dist).sum()))
+
+        # accumulated column per searched origin (computed on first use)
+        acc = {}
+
+        # routes whose origin is in this chunk
+        rows = numpy.flatnonzero(numpy.isin(orig_idx, chunk) & (dest_idx >= 0))
+        chunk_row = numpy.searchsorted(chunk, orig_idx[rows])
+        for k, r in zip(rows, chunk_row):
+            time_sec = dist[r, dest_idx[k]]
+            if numpy.isinf(time_sec):
+                # beyond the search budget (same component as the origin)
+                if max_cost is not None and components[orig_idx[k]] == components[dest_idx[k]]:
+                    row = {'b_routeid': routeids[k], col_path: format_path([], path_format), col_time: None}
+                    if col_acc is not None:
+                        row[col_acc] = None
+                    p.append(row)
+                    continue
+                e.append({'routeid': routeids[k], 'od_pair': [origs[k], dests[k]], 'exception': nx.NetworkXNoPath('No path between {} and {}.'.format(origs[k], dests[k]))})
+                continue
+            # rebuild the path from the predecessor row (skipped if paths are not stored)
+            path = None
+            if path_format is not None:
+                path = format_path(graph.path(pred[r], dest_idx[k]), path_format)
+            # append path and time info to list
+            row = {'b_routeid': routeids[k], col_path: path, col_time: int(round(time_sec, 0))}
+            if col_acc is not None:
+                if r not in acc:
+                    acc[r] = graph.accumulate(col_acc, pred[r])
+                row[col_acc] = int(round(acc[r][dest_idx[k]], 0))
+            p.append(row)
+
+    METRICS.count_errors(e)
+
+    return p, e
+
+
+def find_shortest_route_modes(graph, routes_df, col_id, col_orig, col_dest, path_format='text', walk_max_cost=None, col_walk='walk', stats=None):
+    """
+    Find the walking and driving routes of one O-D batch on one multi-mode CSRGraph object (create_csr_graph(multi_mode=True)),
+    so both modes share one graph load, one O-D read, and one write (routes2dbtable_copy_modes()). Route lengths in
+    meters come from the same searches (find_shortest_routes_csr(col_acc=...)).
+    :param graph: CSRGraph object with time_walk_sec, time_drive_sec, walk_dist_meters, and drive_dist_meters columns
+    :param routes_df: Pandas dataframe with routeid, node_orig, node_dest, and walk columns (get_od_routes(walk=False))
+    :param col_id: String containing name of O-D route ID column ('routeid')
+    :param col_orig: String containing name of source node column ('node_orig')
+    :param col_dest: String containing name of target node column ('node_dest')
+    :param path_format: (optional) Path storage format: 'text', 'bytea', 'array', or None (see find_shortest_route())
+    :param walk_max_cost: (optional) Search budget in seconds for walking routes (see find_shortest_route())
+    :param col_walk: (optional) String containing name of the O-D column flagging walking routes (1 = walk)
+    :param stats: (optional) Dictionary {'walk': RouteStats, 'drive': RouteStats} updated with the travel times of the batch
+    :return: 2 list objects: p (one row per route with the ROUTE_MODE_COLUMNS values, None where a mode does not
+        apply or failed) and e (error messages for failed routes)
+    """
+    if not isinstance(graph, CSRGraph) or 'walk_dist_meters' not in graph.costs:
+        raise ValueError('Multi-mode routing needs a CSRGraph loaded with create_csr_graph(multi_mode=True)')
+
+    # walking routes (flagged O-D pairs only) and driving routes (every O-D pair)
+    walk_df = routes_df[routes_df[col_walk] == 1]
+    p_walk, e_walk = find_shortest_routes_csr(graph, walk_df, col_id, col_orig, col_dest, 'time_walk_sec', True, path_format, walk_max_cost, col_acc='walk_dist_meters')
+    p_drive, e_drive = find_shortest_routes_csr(graph, routes_df, col_id, col_orig, col_dest, 'time_drive_sec', False, path_format, col_acc='drive_dist_meters')
+    if stats is not None:
+        stats['walk'].add_routes(p_walk, 'walk_time_sec')
+        stats['drive'].add_routes(p_drive, 'drive_time_sec')
+
+    # one output row per route with the columns of both modes
+    rows = {routeid: dict({col: None for col in ROUTE_MODE_COLUMNS}, b_routeid=routeid) for routeid in routes_df[col_id]}
+    for row in p_walk + p_drive:
+        rows[row['b_routeid']].update(row)
+
+    return list(rows.values()), e_walk + e_drive
+
+
+def routes2dbtable(dbparams, routes_schema, routes_table, col_path, col_cost, paths_list, walk=False, path_format='text'):
     """
     Update the Postgres O-D routes table with path and travel time columns.
     reference: https://docs.sqlalchemy.org/en/14/tutorial/data_update.html#updating-and-deleting-rows-with-core
-    :param dbparams: dictionary containing database log in information (user, password, host, port, dbname)
+    :param dbparams: dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
     :param routes_schema: String containing database schema name
     :param routes_table: String containing database table name
     :param col_path: Name of new column to store route path (drive_path, walk_path)
     :param col_cost: Name of new column to store route cost (drive_time_sec, walk_time_sec)
     :param paths_list: List with routeids, paths, and travel times (find_shortest_route())
     :param walk: Boolean, True if walking routes and False for driving routes
+    :param path_format: (optional) Path storage format used by find_shortest_route(): 'text', 'bytea', 'array', or None
     :return: None
     """
     # SQL to add path and time columns
-    sql_add_col1 = "ALTER TABLE {}.{} ADD COLUMN IF NOT EXISTS {} TEXT DEFAULT NULL;".format(routes_schema, routes_table, col_path)
+    sql_add_col1 = "ALTER TABLE {}.{} ADD COLUMN IF NOT EXISTS {} {} DEFAULT NULL;".format(routes_schema, routes_table, col_path, PATH_TYPES[path_format])
     sql_add_col2 = "ALTER TABLE {}.{} ADD COLUMN IF NOT EXISTS {} INT DEFAULT NULL;".format(routes_schema, routes_table, col_cost)
     # SQL to set schema search path
     sql_set_schema = "SET SEARCH_PATH = public, {};".format(routes_schema)
 
-    # fixes numpy int64 values so they work with psycopg2
-    def addapt_numpy_float64(numpy_float64):
-        return AsIs(numpy_float64)
-    def addapt_numpy_int64(numpy_int64):
-        return AsIs(numpy_int64)
-    register_adapter(numpy.float64, addapt_numpy_float64)
-    register_adapter(numpy.int64, addapt_numpy_int64)
-
     # connect to the database
-    engine = sqlalchemy_engine(dbparams)
-
-    with engine.connect() as conn:
+    with db_connection(dbparams) as conn:
         # add path and time columns to db table
         conn.execute(sql_add_col1)
         conn.execute(sql_add_col2)
@@ -172,15 +919,23 @@ def routes2dbtable(dbparams, routes_schema, routes_table, col_path, col_cost, pa
         # set schema search path
         conn.execute(sql_set_schema)
 
+        # path column type
+        if path_format == 'bytea':
+            path_type = LargeBinary
+        elif path_format == 'array':
+            path_type = ARRAY(BigInteger)
+        else:
+            path_type = String
+
         # create a SQLAlchemy Table object
-        meta = MetaData(bind=engine)
+        meta = MetaData()
         # walking routes
         if walk:
             routes = Table('{}'.format(routes_table), meta,
                            Column('routeid', Integer, primary_key=True),
                            Column('node_orig', String),
                            Column('node_dest', String),
-                           Column('walk_path', String),
+                           Column('walk_path', path_type),
                            Column('walk_time_sec', Integer))
             # update columns
             stmt = (update(routes).
@@ -192,12 +947,238 @@ def routes2dbtable(dbparams, routes_schema, routes_table, col_path, col_cost, pa
                            Column('routeid', Integer, primary_key=True),
                            Column('node_orig', String),
                            Column('node_dest', String),
-                           Column('drive_path', String),
+                           Column('drive_path', path_type),
                            Column('drive_time_sec', Integer))
             # update columns
             stmt = (update(routes).
                     where(routes.c.routeid == bindparam('b_routeid')).
                     values(drive_path=bindparam('drive_path'), drive_time_sec=bindparam('drive_time_sec')))
-        conn.execute(stmt, paths_list)
+        with METRICS.timer('db_write'):
+            conn.execute(stmt, paths_list)
+    METRICS.count('rows_written', len(paths_list))
+
+    return
+
+
+def add_route_columns(dbparams, routes_schema, routes_table, col_path, col_cost, path_format='text', col_dist=None):
+    """
+    Add path and travel time columns to the Postgres O-D routes table (run once before routes2dbtable_copy())
+    :param dbparams: dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param routes_schema: String containing database schema name
+    :param routes_table: String containing database table name
+    :param col_path: Name of new column to store route path (drive_path, walk_path)
+    :param col_cost: Name of new column to store route cost (drive_time_sec, walk_time_sec)
+    :param path_format: (optional) Path storage format used by find_shortest_route(): 'text', 'bytea', 'array', or None
+    :param col_dist: (optional) Name of new column to store route length in meters (drive_dist_meters, walk_dist_meters)
+    :return: None
+    """
+    # SQL to add path and time columns
+    sql_add_col1 = "ALTER TABLE {}.{} ADD COLUMN IF NOT EXISTS {} {} DEFAULT NULL;".format(routes_schema, routes_table, col_path, PATH_TYPES[path_format])
+    sql_add_col2 = "ALTER TABLE {}.{} ADD COLUMN IF NOT EXISTS {} INT DEFAULT NULL;".format(routes_schema, routes_table, col_cost)
+
+    # connect to the database
+    with db_connection(dbparams) as conn:
+        # add path and time columns to db table
+        conn.execute(sql_add_col1)
+        conn.execute(sql_add_col2)
+        if col_dist is not None:
+            conn.execute("ALTER TABLE {}.{} ADD COLUMN IF NOT EXISTS {} INT DEFAULT NULL;".format(routes_schema, routes_table, col_dist))
+
+    return
+
+
+def routes2dbtable_copy(dbparams, routes_schema, routes_table, col_path, col_cost, paths_list, results_table=None, path_format='text', post_sql=None):
+    """
+    Bulk write path and travel time columns: stream the batch into a staging table with COPY and apply it to the
+    Postgres O-D routes table with one set-based UPDATE ... FROM. The staging table is a session TEMP table (never
+    WAL-logged and private to the connection, so concurrent writers don't collide).
+    The path and time columns must already exist (add_route_columns()).
+    :param dbparams: dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param routes_schema: String containing database schema name
+    :param routes_table: String containing database table name
+    :param col_path: Name of column to store route path (drive_path, walk_path)
+    :param col_cost: Name of column to store route cost (drive_time_sec, walk_time_sec)
+    :param paths_list: List with routeids, paths, and travel times (find_shortest_route())
+    :param results_table: (optional) String containing name of a results table (in routes_schema), if given - skip the
+        UPDATE and append (routeid, path, time) rows to this table instead
+    :param path_format: (optional) Path storage format used by find_shortest_route(): 'text', 'bytea', 'array', or None
+    :param post_sql: (optional) SQL statement executed in the same transaction as the write (e.g. util.finish_batch_sql()),
+        the write is rolled back (util.LeaseLostError) if it updates no rows
+    :return: None
+    """
+    path_type = PATH_TYPES[path_format]
+
+    # write the batch as CSV into an in-memory buffer (None -> NULL)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in paths_list:
+        writer.writerow([row['b_routeid'], copy_value(row[col_path]), row[col_cost]])
+    n_bytes = buffer.tell()
+    buffer.seek(0)
+
+    # connect to the database
+    with METRICS.timer('db_write'), db_raw_connection(dbparams) as conn:
+        cur = conn.cursor()
+        # append to results table
+        if results_table is not None:
+            cur.execute("CREATE TABLE IF NOT EXISTS {}.{} (routeid INT, {} {}, {} INT);".format(routes_schema, results_table, col_path, path_type, col_cost))
+            cur.copy_expert("COPY {}.{} (routeid, {}, {}) FROM STDIN WITH (FORMAT csv);".format(routes_schema, results_table, col_path, col_cost), buffer)
+        # update routes table from staging table
+        else:
+            staging = "{}_{}_staging".format(routes_table, col_path)
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS {} (routeid INT, path {}, time_sec INT) ON COMMIT DELETE ROWS;".format(staging, path_type))
+            cur.copy_expert("COPY {} (routeid, path, time_sec) FROM STDIN WITH (FORMAT csv);".format(staging), buffer)
+            cur.execute("UPDATE {}.{} AS t SET {} = s.path, {} = s.time_sec FROM {} AS s WHERE t.routeid = s.routeid;".format(
+                routes_schema, routes_table, col_path, col_cost, staging))
+        # e.g. mark the batch done in the batch ledger (committed together with the results)
+        if post_sql is not None:
+            cur.execute(post_sql)
+            # e.g. the worker lost the batch's lease (util.finish_batch_sql(worker=...)): the new owner writes the batch
+            if cur.rowcount == 0:
+                conn.rollback()
+                raise LeaseLostError('post_sql updated no rows, batch write rolled back')
+        conn.commit()
+        cur.close()
+    METRICS.count('rows_written', len(paths_list))
+    METRICS.count('bytes_written', n_bytes)
+
+    return
+
+
+def routes2dbtable_copy_modes(dbparams, routes_schema, routes_table, paths_list, path_format='text', post_sql=None):
+    """
+    Bulk write the walking and driving columns of a multi-mode batch (find_shortest_route_modes()) with one COPY into a
+    staging table and one UPDATE ... FROM (see routes2dbtable_copy()). The columns must already exist (add_route_columns()).
+    :param dbparams: dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param routes_schema: String containing database schema name
+    :param routes_table: String containing database table name
+    :param paths_list: List with routeids and the ROUTE_MODE_COLUMNS values (find_shortest_route_modes())
+    :param path_format: (optional) Path storage format used by find_shortest_route_modes(): 'text', 'bytea', 'array', or None
+    :param post_sql: (optional) SQL statement executed in the same transaction as the write (e.g. util.finish_batch_sql()),
+        the write is rolled back (util.LeaseLostError) if it updates no rows
+    :return: None
+    """
+    # staging column types (paths in the storage format, times and lengths as integers)
+    col_types = ['{} {}'.format(col, PATH_TYPES[path_format] if col.endswith('_path') else 'INT') for col in ROUTE_MODE_COLUMNS]
+
+    # write the batch as CSV into an in-memory buffer (None -> NULL)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in paths_list:
+        writer.writerow([row['b_routeid']] + [copy_value(row[col]) for col in ROUTE_MODE_COLUMNS])
+    n_bytes = buffer.tell()
+    buffer.seek(0)
+
+    # connect to the database
+    with METRICS.timer('db_write'), db_raw_connection(dbparams) as conn:
+        cur = conn.cursor()
+        staging = "{}_modes_staging".format(routes_table)
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS {} (routeid INT, {}) ON COMMIT DELETE ROWS;".format(staging, ', '.join(col_types)))
+        cur.copy_expert("COPY {} (routeid, {}) FROM STDIN WITH (FORMAT csv);".format(staging, ', '.join(ROUTE_MODE_COLUMNS)), buffer)
+        cur.execute("UPDATE {}.{} AS t SET {} FROM {} AS s WHERE t.routeid = s.routeid;".format(
+            routes_schema, routes_table, ', '.join('{} = s.{}'.format(col, col) for col in ROUTE_MODE_COLUMNS), staging))
+        # e.g. mark the batch done in the batch ledger (committed together with the results)
+        if post_sql is not None:
+            cur.execute(post_sql)
+            # e.g. the worker lost the batch's lease (util.finish_batch_sql(worker=...)): the new owner writes the batch
+            if cur.rowcount == 0:
+                conn.rollback()
+                raise LeaseLostError('post_sql updated no rows, batch write rolled back')
+        conn.commit()
+        cur.close()
+    METRICS.count('rows_written', len(paths_list))
+    METRICS.count('bytes_written', n_bytes)
+
+    return
+
+
+def copy_value(value):
+    """
+    Convert a value to its text representation for COPY ... WITH (FORMAT csv)
+    :param value: bytes (BYTEA), list (ARRAY), None (NULL), or any other value (str())
+    :return: String or None
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return '\\x' + value.hex()
+    if isinstance(value, list):
+        return '{' + ','.join(str(v) for v in value) + '}'
+    return value
+
+
+def find_origin_trees(graph, origins, col_cost, chunk_size=256):
+    """
+    Find the full shortest path tree of each origin node, encoded as compact bytes (path_codec.encode_tree()).
+    Storing one tree per origin (trees2dbtable()) replaces storing every O-D path, paths are rebuilt on demand with
+    path_codec.path_from_tree().
+    :param graph: NetworkX graph object (create_networkx_object()) or CSRGraph object (create_csr_graph())
+    :param origins: List of origin node IDs
+    :param col_cost: String containing name of weight column ('time_drive_sec' or 'time_walk_sec')
+    :param chunk_size: (optional) Number of origin nodes searched per csgraph call (CSRGraph only)
+    :return: 2 list objects: t (origin node and encoded tree) and e (error messages for failed origins)
+    """
+    t = []  # store trees
+    e = []  # store errors
+
+    # array-backed graph
+    if isinstance(graph, CSRGraph):
+        origins = numpy.asarray(origins)
+        orig_idx = graph.index(origins)
+        for k in numpy.flatnonzero(orig_idx < 0):
+            e.append({'node_orig': origins[k], 'exception': nx.NodeNotFound('Node {} not found in graph'.format(origins[k]))})
+        found = numpy.flatnonzero(orig_idx >= 0)
+        matrix = graph.matrix(col_cost)
+        for c in range(0, len(found), chunk_size):
+            chunk = found[c:c + chunk_size]
+            dist, pred = dijkstra(matrix, directed=True, indices=orig_idx[chunk], return_predecessors=True)
+            for r, k in enumerate(chunk):
+                reached = numpy.flatnonzero(pred[r] >= 0)
+                tree = encode_tree(graph.node_ids[reached], graph.node_ids[pred[r][reached]])
+                t.append({'node_orig': origins[k], 'tree': tree})
+    # NetworkX graph
+    else:
+        for orig in origins:
+            try:
+                pred, dist = nx.dijkstra_predecessor_and_distance(G=graph, source=orig, weight=col_cost)
+            except Exception as e_message:
+                e.append({'node_orig': orig, 'exception': e_message})
+                continue
+            nodes = [node for node in pred if len(pred[node]) > 0]
+            tree = encode_tree(nodes, [pred[node][0] for node in nodes])
+            t.append({'node_orig': orig, 'tree': tree})
+
+    return t, e
+
+
+def trees2dbtable(dbparams, trees_schema, trees_table, col_tree, trees_list):
+    """
+    Insert or replace shortest path trees (find_origin_trees()) in a Postgres table with one row per origin node:
+        node_orig, walk_tree, drive_tree
+    :param dbparams: dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param trees_schema: String containing database schema name
+    :param trees_table: String containing database table name (created if it does not exist)
+    :param col_tree: Name of column to store the trees (walk_tree, drive_tree)
+    :param trees_list: List with origin nodes and encoded trees (find_origin_trees())
+    :return: None
+    """
+    # write the batch as CSV into an in-memory buffer
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in trees_list:
+        writer.writerow([row['node_orig'], copy_value(row['tree'])])
+    n_bytes = buffer.tell()
+    buffer.seek(0)
+
+    # connect to the database
+    with METRICS.timer('db_write'), db_raw_connection(dbparams) as conn:
+        cur = conn.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS {}.{} (node_orig NUMERIC PRIMARY KEY, walk_tree BYTEA, drive_tree BYTEA);".format(trees_schema, trees_table))
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS {}_staging (node_orig NUMERIC, tree BYTEA) ON COMMIT DELETE ROWS;".format(trees_table))
+        cur.copy_expert("COPY {}_staging (node_orig, tree) FROM STDIN WITH (FORMAT csv);".format(trees_table), buffer)
+        cur.execute("INSERT INTO {}.{} AS t (node_orig, {}) SELECT node_orig, tree FROM {}_staging ON CONFLICT (node_orig) DO UPDATE SET {} = EXCLUDED.{};".format(
+            trees_schema, trees_table, col_tree, trees_table, col_tree, col_tree))
+        conn.commit()
+        cur.close()
+    METRICS.count('rows_written', len(trees_list))
+    METRICS.count('bytes_written', n_bytes)
 
     return
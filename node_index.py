@@ -0,0 +1,148 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Functions related to the node index: dense integer indices for the NUMERIC node IDs of esco.nodes, persisted in the
+# database (nodes.nodeidx) and as a numpy file, so array-backed graphs and outputs share one node numbering
+
+# IMPORTS
+import json
+import logging
+import os
+import numpy as np
+from util import db_connection
+
+logger = logging.getLogger(__name__)
+
+
+# CLASSES
+class NodeIndex:
+    """
+    Mapping between node IDs (esco.nodes.nodeid, integral NUMERIC values) and dense indices 0 .. n-1 in node ID order
+    (index i = node_ids[i]). Lookups are vectorized binary searches on one sorted int64 array.
+    """
+    def __init__(self, node_ids, fingerprint=None):
+        """
+        :param node_ids: Sorted numpy int64 array of node IDs
+        :param fingerprint: (optional) String fingerprint of the nodes table the index was built from (get_nodes_fingerprint())
+        """
+        self.node_ids = node_ids
+        self.fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def index(self, nodes):
+        """
+        Dense indices of node IDs
+        :param nodes: Node ID or array of node IDs (integers or Decimals)
+        :return: Integer index or numpy int32 array of indices (-1 for nodes not in the index)
+        """
+        nodes_arr = np.asarray(nodes).astype(np.int64)
+        if len(self.node_ids) == 0:
+            return np.full(nodes_arr.shape, -1, dtype=np.int32) if nodes_arr.ndim else -1
+        pos = np.minimum(np.searchsorted(self.node_ids, nodes_arr), len(self.node_ids) - 1)
+        idx = np.where(self.node_ids[pos] == nodes_arr, pos, -1).astype(np.int32)
+        if idx.ndim == 0:
+            return int(idx)
+        return idx
+
+    def ids(self, idx):
+        """
+        Node IDs of dense indices
+        :param idx: Integer index or array of indices
+        :return: Numpy int64 node ID(s)
+        """
+        return self.node_ids[idx]
+
+    def save(self, path):
+        """
+        Save the node IDs to a numpy .npy file (and the fingerprint to {path}.json)
+        :param path: String containing path to the output file
+        :return: None
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        np.save(path, self.node_ids)
+        with open('{}.json'.format(path), 'w') as f:
+            json.dump({'fingerprint': self.fingerprint}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """
+        Load a node index saved with save()
+        :param path: String containing path to the .npy file
+        :param mmap_mode: (optional) numpy memory-map mode (e.g. 'r')
+        :return: NodeIndex
+        """
+        fingerprint = None
+        if os.path.exists('{}.json'.format(path)):
+            with open('{}.json'.format(path)) as f:
+                fingerprint = json.load(f).get('fingerprint')
+        return cls(np.load(path, mmap_mode=mmap_mode), fingerprint)
+
+
+# FUNCTIONS
+def build_node_index(dbparams, nodes_schema, nodes_table):
+    """
+    Create the node index of a Postgres nodes table (nodeid column) and store each node's index in its nodeidx column,
+    so SQL can join on the same numbering (e.g. SELECT nodeid FROM esco.nodes WHERE nodeidx = 42)
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param nodes_schema: String containing database schema name
+    :param nodes_table: String containing database table name
+    :return: NodeIndex
+    """
+    # SQL to read the node IDs as integers in index order
+    sql_read = "SELECT nodeid::BIGINT FROM {}.{} ORDER BY nodeid;".format(nodes_schema, nodes_table)
+    # SQL to store the index (position in nodeid order, same as NodeIndex.index())
+    sql_add_col = "ALTER TABLE {}.{} ADD COLUMN IF NOT EXISTS nodeidx INT;".format(nodes_schema, nodes_table)
+    sql_update = "UPDATE {}.{} AS t SET nodeidx = s.nodeidx FROM (SELECT nodeid, (ROW_NUMBER() OVER (ORDER BY nodeid) - 1)::INT AS nodeidx FROM {}.{}) AS s " \
+                 "WHERE t.nodeid = s.nodeid AND t.nodeidx IS DISTINCT FROM s.nodeidx;".format(nodes_schema, nodes_table, nodes_schema, nodes_table)
+    sql_index = "CREATE UNIQUE INDEX IF NOT EXISTS {}_nodeidx_idx ON {}.{} (nodeidx);".format(nodes_table, nodes_schema, nodes_table)
+
+    # connect to database (one transaction, so the column and the fingerprint always match the node IDs read)
+    with db_connection(dbparams) as conn, conn.begin():
+        node_ids = np.array([row[0] for row in conn.execute(sql_read)], dtype=np.int64)
+        conn.execute(sql_add_col)
+        conn.execute(sql_update)
+        conn.execute(sql_index)
+        fingerprint = get_nodes_fingerprint(conn, nodes_schema, nodes_table)
+
+    return NodeIndex(node_ids, fingerprint)
+
+
+def get_nodes_fingerprint(dbparams, nodes_schema, nodes_table):
+    """
+    Fingerprint of the node IDs of a Postgres nodes table (row count and an order-independent checksum of the node
+    IDs), used to detect changes to the node set since a node index was saved (see get_edges_fingerprint())
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param nodes_schema: String containing database schema name
+    :param nodes_table: String containing database table name
+    :return: String '{row count}:{checksum}'
+    """
+    # SQL to count and checksum the node IDs
+    sql_str = "SELECT count(*) AS n, coalesce(sum(hashtext(nodeid::text)::BIGINT), 0) AS checksum FROM {}.{};".format(nodes_schema, nodes_table)
+
+    # connect to database
+    with db_connection(dbparams) as conn:
+        n, checksum = conn.execute(sql_str).fetchone()
+
+    return '{}:{}'.format(n, checksum)
+
+
+def load_node_index(dbparams, nodes_schema, nodes_table, path):
+    """
+    Load the node index from a .npy file, or build it (build_node_index()) and save it if the file is missing or no
+    longer matches the nodes table (get_nodes_fingerprint())
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param nodes_schema: String containing database schema name
+    :param nodes_table: String containing database table name
+    :param path: String containing path to the .npy file
+    :return: NodeIndex
+    """
+    if os.path.exists(path):
+        node_index = NodeIndex.load(path)
+        if node_index.fingerprint is not None and node_index.fingerprint == get_nodes_fingerprint(dbparams, nodes_schema, nodes_table):
+            return node_index
+
+    node_index = build_node_index(dbparams, nodes_schema, nodes_table)
+    node_index.save(path)
+    logger.info('Node index saved: %s (%s nodes)', path, len(node_index))
+
+    return node_index
@@ -1,4 +1,5 @@
 -- Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+-- (the same statistics are computed while routing by route_stats.py, see STATS_DIR in main.py)
 
 -----------------------------
 -- ESCO SCHEMA DRIVE TIMES --
@@ -0,0 +1,126 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Functions related to multi-core routing with a process pool sharing one read-only graph
+
+# IMPORTS
+from functools import partial
+import multiprocessing
+import pandas as pd
+from csr_graph import CSRGraph
+from instrumentation import METRICS
+from network_analysis import find_shortest_route, route_symmetric_pairs
+
+# graph object inherited (copy-on-write, never pickled) by forked worker processes
+_GRAPH = None
+
+
+# FUNCTIONS
+def _route_chunk(args):
+    """
+    Worker task: find the shortest routes for one chunk of the O-D batch using the fork-inherited graph
+    :param args: Tuple (routes_df, col_id, col_orig, col_dest, col_cost, walk, by_origin, path_format, max_cost, stats)
+    :return: 2 list objects: p (paths) and e (errors), see find_shortest_route(), the chunk's metrics snapshot, and the
+        chunk's RouteStats object (or None)
+    """
+    routes_df, col_id, col_orig, col_dest, col_cost, walk, by_origin, path_format, max_cost, stats = args
+    # the worker's registry only holds this chunk's metrics (merged by the parent process)
+    METRICS.reset()
+    p, e = find_shortest_route(_GRAPH, routes_df, col_id, col_orig, col_dest, col_cost, walk, by_origin, path_format, max_cost, stats=stats)
+    return p, e, METRICS.snapshot(), stats
+
+
+def split_by_origin(routes_df, col_orig, n_chunks):
+    """
+    Split an O-D dataframe into contiguous chunks without splitting any origin node across chunks
+    :param routes_df: Pandas dataframe with routeid, node_orig, and node_dest columns
+    :param col_orig: String containing name of source node column ('node_orig')
+    :param n_chunks: Maximum number of chunks
+    :return: List of Pandas dataframes
+    """
+    # origin codes in order of first appearance
+    codes, uniques = pd.factorize(routes_df[col_orig])
+    n_origins = len(uniques)
+    if n_origins == 0:
+        return []
+    n_chunks = min(n_chunks, n_origins)
+    chunk_ids = codes * n_chunks // n_origins
+    return [routes_df[chunk_ids == c] for c in range(n_chunks)]
+
+
+# CLASSES
+class ParallelRouter:
+    """
+    Fan O-D batches out to a pool of worker processes that share one read-only graph.
+    The graph is built once in the parent process and inherited by the workers through fork() (copy-on-write), so it is
+    never pickled or copied up front. Results are gathered in chunk order, so the output lists are deterministic.
+    Requires the 'fork' start method (Linux).
+    """
+    def __init__(self, graph, processes=None, chunks_per_process=4):
+        """
+        :param graph: NetworkX graph object (create_networkx_object()) or CSRGraph object (create_csr_graph())
+        :param processes: (optional) Number of worker processes (default: number of CPUs)
+        :param chunks_per_process: (optional) Number of chunks each batch is split into per worker process
+        """
+        global _GRAPH
+        _GRAPH = graph
+
+        # build the scipy matrices before forking so every worker shares them
+        if isinstance(graph, CSRGraph):
+            for col in graph.costs:
+                graph.matrix(col)
+
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunks_per_process = chunks_per_process
+        self.pool = multiprocessing.get_context('fork').Pool(self.processes)
+
+    def find_shortest_route(self, routes_df, col_id, col_orig, col_dest, col_cost, walk=False, by_origin=True, path_format='text', max_cost=None, symmetric=False, stats=None):
+        """
+        Parallel version of find_shortest_route() for one O-D batch (same arguments and return values)
+        :param routes_df: Pandas dataframe with routeid, node_orig, and node_dest columns
+        :param col_id: String containing name of O-D route ID column ('routeid')
+        :param col_orig: String containing name of source node column ('node_orig')
+        :param col_dest: String containing name of target node column ('node_dest')
+        :param col_cost: String containing name of weight column ('time_drive_sec' or 'time_walk_sec')
+        :param walk: Boolean, True if walking routes and False for driving routes
+        :param by_origin: (optional) Boolean, if True - run one single-source search per origin node
+        :param path_format: (optional) Path storage format: 'text', 'bytea', 'array', or None (see find_shortest_route())
+        :param max_cost: (optional) Search budget in col_cost units (see find_shortest_route())
+        :param symmetric: (optional) Boolean or 'canonical', route each unordered O-D pair once (see find_shortest_route())
+        :param stats: (optional) RouteStats object (route_stats.py), updated with the aggregates of every chunk
+        :return: 2 list objects: p (path nodes and travel time for each route) and e (error messages for failed routes)
+        """
+        # deduplicate in the parent process, so both directions of a pair never land in different chunks
+        if symmetric:
+            if _GRAPH.is_directed():
+                raise ValueError('Symmetric O-D pairs can only be shared on an undirected graph')
+            route_batch = partial(self.find_shortest_route, by_origin=by_origin, max_cost=max_cost)
+            p, e = route_symmetric_pairs(route_batch, routes_df, col_id, col_orig, col_dest, col_cost, walk, path_format, symmetric == 'canonical')
+            if stats is not None:
+                stats.add_routes(p, 'walk_time_sec' if walk else 'drive_time_sec')
+            return p, e
+
+        # every chunk fills its own empty RouteStats object in the worker process
+        chunk_stats = stats.empty() if stats is not None else None
+        chunks = split_by_origin(routes_df, col_orig, self.processes * self.chunks_per_process)
+        tasks = [(chunk, col_id, col_orig, col_dest, col_cost, walk, by_origin, path_format, max_cost, chunk_stats) for chunk in chunks]
+
+        p = []  # store paths
+        e = []  # store errors
+        # map() returns results in task order
+        for chunk_p, chunk_e, chunk_metrics, chunk_stats in self.pool.map(_route_chunk, tasks):
+            p.extend(chunk_p)
+            e.extend(chunk_e)
+            METRICS.merge(chunk_metrics)
+            if stats is not None:
+                stats.merge(chunk_stats)
+
+        return p, e
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
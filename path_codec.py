@@ -0,0 +1,156 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Functions related to compact route path storage (delta-encoded varints, Postgres BYTEA or BIGINT[] columns)
+
+# IMPORTS
+import re
+
+# path storage formats: Postgres column type used for each format
+PATH_TYPES = {'text': 'TEXT', 'bytea': 'BYTEA', 'array': 'BIGINT[]', None: 'TEXT'}
+
+
+# FUNCTIONS
+def _write_varint(out, value):
+    """
+    Append a zigzag-encoded varint to a bytearray
+    :param out: bytearray
+    :param value: Integer (may be negative)
+    :return: None
+    """
+    value = (value << 1) ^ (value >> 63)  # zigzag: small negative numbers -> small positive numbers
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varints(blob):
+    """
+    Decode all zigzag-encoded varints in a bytes object
+    :param blob: bytes, bytearray, or memoryview
+    :return: List of integers
+    """
+    values = []
+    value = 0
+    shift = 0
+    for byte in bytes(blob):
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append((value >> 1) ^ -(value & 1))
+        value = 0
+        shift = 0
+    return values
+
+
+def encode_path(path):
+    """
+    Encode a path (list of integer node IDs) as delta-encoded zigzag varints
+    :param path: List of node IDs
+    :return: bytes
+    """
+    out = bytearray()
+    prev = 0
+    for node in path:
+        node = int(node)
+        _write_varint(out, node - prev)
+        prev = node
+    return bytes(out)
+
+
+def decode_path(blob):
+    """
+    Decode a path encoded with encode_path()
+    :param blob: bytes (or memoryview from a Postgres BYTEA column)
+    :return: List of node IDs
+    """
+    path = []
+    prev = 0
+    for delta in _read_varints(blob):
+        prev += delta
+        path.append(prev)
+    return path
+
+
+def decode_path_text(path_str):
+    """
+    Decode a path stored as text by find_shortest_route(), e.g. "[Decimal('1'), Decimal('2')]" or "[1, 2]"
+    :param path_str: String containing the path
+    :return: List of node IDs
+    """
+    return [int(node) for node in re.findall(r'-?\d+', path_str)]
+
+
+def format_path(path, path_format='text'):
+    """
+    Convert a path (list of node IDs) to its storage format
+    :param path: List of node IDs
+    :param path_format: 'text' (str(list)), 'bytea' (encode_path()), 'array' (list of integers for a BIGINT[] column),
+        'list' (the node list as is, not stored), or None (path is not stored)
+    :return: String, bytes, list, or None
+    """
+    if path_format == 'text':
+        return str(path)
+    if path_format == 'bytea':
+        return encode_path(path)
+    if path_format == 'array':
+        return [int(node) for node in path]
+    if path_format == 'list':
+        return list(path)
+    if path_format is None:
+        return None
+    raise ValueError("Unknown path format '{}'".format(path_format))
+
+
+def encode_tree(nodes, preds):
+    """
+    Encode a shortest path tree (predecessor of every reached node). Nodes are sorted and delta-encoded, each
+    predecessor is stored as the difference to its node.
+    :param nodes: List of node IDs reached by the search (excluding the origin node)
+    :param preds: List of predecessor node IDs aligned with nodes
+    :return: bytes
+    """
+    out = bytearray()
+    prev = 0
+    for node, pred in sorted(zip((int(n) for n in nodes), (int(p) for p in preds))):
+        _write_varint(out, node - prev)
+        _write_varint(out, pred - node)
+        prev = node
+    return bytes(out)
+
+
+def decode_tree(blob):
+    """
+    Decode a shortest path tree encoded with encode_tree()
+    :param blob: bytes (or memoryview from a Postgres BYTEA column)
+    :return: Dictionary {node: predecessor node}
+    """
+    values = _read_varints(blob)
+    tree = {}
+    prev = 0
+    for k in range(0, len(values), 2):
+        node = prev + values[k]
+        tree[node] = node + values[k + 1]
+        prev = node
+    return tree
+
+
+def path_from_tree(tree, orig, dest):
+    """
+    Reconstruct one path from a shortest path tree
+    :param tree: Dictionary {node: predecessor node} (decode_tree()) or encoded tree bytes
+    :param orig: Origin node ID (root of the tree)
+    :param dest: Destination node ID
+    :return: List of node IDs from origin to destination, or None if the destination is not in the tree
+    """
+    if not isinstance(tree, dict):
+        tree = decode_tree(tree)
+    orig, dest = int(orig), int(dest)
+
+    path = [dest]
+    while path[-1] != orig:
+        if path[-1] not in tree:
+            return None
+        path.append(tree[path[-1]])
+    path.reverse()
+    return path
@@ -0,0 +1,164 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Functions related to the pipelined (fetch/route/write) network analysis driver
+
+# IMPORTS
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# marks the end of the batch stream in a stage queue
+_DONE = object()
+
+
+# FUNCTIONS
+def _new_stage():
+    """
+    Empty per-stage statistics
+    :return: Dictionary with batches, rows, busy seconds, and wait seconds
+    """
+    return {'batches': 0, 'rows': 0, 'busy_sec': 0.0, 'wait_sec': 0.0}
+
+
+def _put(q, item, stop, stats):
+    """
+    Put an item into a bounded queue, blocking while the queue is full (back-pressure) until another stage fails
+    :param q: queue.Queue object
+    :param item: Item to put into the queue
+    :param stop: threading.Event object, set when any stage fails
+    :param stats: Dictionary of stage statistics (wait time is added)
+    :return: Boolean, False if the pipeline was stopped before the item was queued
+    """
+    st = time.time()
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            stats['wait_sec'] += time.time() - st
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop, stats):
+    """
+    Get an item from a queue, blocking while the queue is empty until another stage fails
+    :param q: queue.Queue object
+    :param stop: threading.Event object, set when any stage fails
+    :param stats: Dictionary of stage statistics (wait time is added)
+    :return: Next item, or _DONE if the pipeline was stopped
+    """
+    st = time.time()
+    while not stop.is_set():
+        try:
+            item = q.get(timeout=0.1)
+            stats['wait_sec'] += time.time() - st
+            return item
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def run_pipeline(batches, route_batch, write_batch, queue_size=2):
+    """
+    Run the reader, routing, and writer stages concurrently with bounded queues between them, so batch N+1 is fetched
+    and batch N-1 is written while batch N is being routed. The reader and writer run in threads (database I/O releases
+    the GIL), routing runs in the calling thread.
+    :param batches: Iterable of O-D Pandas dataframes (iter_od_batches()), consumed by the reader stage
+    :param route_batch: Function called with one O-D dataframe, returns (paths, errors) (find_shortest_route())
+    :param write_batch: Function called with one paths list (routes2dbtable(), routes2dbtable_copy())
+    :param queue_size: (optional) Maximum number of batches waiting between two stages (back-pressure)
+    :return: Dictionary of per-stage statistics {'read': {...}, 'route': {...}, 'write': {...}, 'errors': int}
+    """
+    stats = {'read': _new_stage(), 'route': _new_stage(), 'write': _new_stage(), 'errors': 0}
+    read_q = queue.Queue(maxsize=queue_size)
+    write_q = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    failures = []
+
+    def reader():
+        try:
+            it = iter(batches)
+            while True:
+                st = time.time()
+                od = next(it, _DONE)
+                stats['read']['busy_sec'] += time.time() - st
+                if od is _DONE:
+                    break
+                stats['read']['batches'] += 1
+                stats['read']['rows'] += len(od)
+                if not _put(read_q, od, stop, stats['read']):
+                    return
+            _put(read_q, _DONE, stop, stats['read'])
+        except Exception as e_message:
+            failures.append(e_message)
+            stop.set()
+
+    def writer():
+        try:
+            while True:
+                paths = _get(write_q, stop, stats['write'])
+                if paths is _DONE:
+                    break
+                st = time.time()
+                write_batch(paths)
+                stats['write']['busy_sec'] += time.time() - st
+                stats['write']['batches'] += 1
+                stats['write']['rows'] += len(paths)
+        except Exception as e_message:
+            failures.append(e_message)
+            stop.set()
+
+    threads = [threading.Thread(target=reader, daemon=True), threading.Thread(target=writer, daemon=True)]
+    for t in threads:
+        t.start()
+
+    # routing stage
+    pipeline_st = time.time()
+    try:
+        while True:
+            od = _get(read_q, stop, stats['route'])
+            if od is _DONE:
+                break
+            st = time.time()
+            paths, errors = route_batch(od)
+            stats['route']['busy_sec'] += time.time() - st
+            stats['route']['batches'] += 1
+            stats['route']['rows'] += len(od)
+            stats['errors'] += len(errors)
+            if not _put(write_q, paths, stop, stats['route']):
+                break
+        _put(write_q, _DONE, stop, stats['route'])
+    except Exception:
+        stop.set()
+        raise
+    finally:
+        for t in threads:
+            t.join()
+    stats['total_sec'] = time.time() - pipeline_st
+
+    # re-raise the first failure from the reader or writer stage
+    if len(failures) > 0:
+        raise failures[0]
+
+    print_pipeline_report(stats)
+
+    return stats
+
+
+def print_pipeline_report(stats):
+    """
+    Log per-stage throughput from run_pipeline() statistics
+    :param stats: Dictionary of per-stage statistics (run_pipeline())
+    :return: None
+    """
+    logger.info('Pipeline finished in %.1f seconds with %s shortest path errors.', stats['total_sec'], stats['errors'])
+    for stage in ['read', 'route', 'write']:
+        s = stats[stage]
+        rate = s['rows'] / s['busy_sec'] if s['busy_sec'] > 0 else 0
+        logger.info('  %-6s %6d batches %10d rows  busy %8.1f s  waiting %8.1f s  %10.0f rows/s',
+                    stage, s['batches'], s['rows'], s['busy_sec'], s['wait_sec'], rate)
+
+    return
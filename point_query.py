@@ -0,0 +1,185 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Functions related to ad-hoc point-to-point routes: goal-directed A* searches using the node coordinates of esco.nodes,
+# for sparse O-D lookups between full matrix builds
+
+# IMPORTS
+import heapq
+import logging
+import math
+import numpy as np
+import networkx as nx
+from csr_graph import CSRGraph
+from instrumentation import METRICS
+from path_codec import format_path
+
+logger = logging.getLogger(__name__)
+
+
+# FUNCTIONS
+def max_speed(graph, col_cost):
+    """
+    Fastest straight-line speed over any edge: max(edge endpoint distance / edge cost). Dividing the straight-line
+    distance to the target by this speed never overestimates the remaining cost, and the heuristic is consistent
+    (along every edge it drops by at most the edge cost).
+    :param graph: NetworkX graph object or CSRGraph object with node coordinates (nodes_table argument of the loaders)
+    :param col_cost: String containing name of weight column ('time_drive_sec' or 'time_walk_sec')
+    :return: Float speed in coordinate units (feet) per cost unit (seconds), inf if an edge has no cost
+    """
+    if isinstance(graph, CSRGraph):
+        src = np.repeat(np.arange(len(graph.node_ids)), np.diff(graph.indptr))
+        delta = graph.coords[src] - graph.coords[graph.indices]
+        cost = np.asarray(graph.costs[col_cost], dtype=np.float64)
+    else:
+        edges = list(graph.edges(data=col_cost))
+        delta = np.array([[graph.nodes[u]['x'] - graph.nodes[v]['x'], graph.nodes[u]['y'] - graph.nodes[v]['y']] for u, v, c in edges]).reshape(-1, 2)
+        cost = np.array([float(c) for u, v, c in edges], dtype=np.float64)
+    length = np.hypot(delta[:, 0], delta[:, 1])
+
+    # edges of unknown length or impassable (multi-mode walk costs) say nothing about the speed
+    valid = np.isfinite(cost) & (length > 0)
+    if not valid.any():
+        return math.inf
+    with np.errstate(divide='ignore'):
+        return float((length[valid] / cost[valid]).max())
+
+
+def find_shortest_route_astar(router, routes_df, col_id, col_orig, col_dest, walk=False, path_format='text'):
+    """
+    Find the shortest routes for the O-D nodes provided in a Pandas dataframe with one A* search per O-D pair. Same
+    output as find_shortest_route(), for small ad-hoc O-D sets (many pairs per origin: find_shortest_route(by_origin=True))
+    :param router: PointRouter object
+    :param routes_df: Pandas dataframe with routeid, node_orig, and node_dest columns
+    :param col_id: String containing name of O-D route ID column ('routeid')
+    :param col_orig: String containing name of source node column ('node_orig')
+    :param col_dest: String containing name of target node column ('node_dest')
+    :param walk: Boolean, True if walking routes and False for driving routes
+    :param path_format: (optional) Path storage format, see path_codec.format_path()
+    :return: 2 list objects: p (path nodes and travel time for each route) and e (error messages for failed routes)
+    """
+    col_path, col_time = ('walk_path', 'walk_time_sec') if walk else ('drive_path', 'drive_time_sec')
+    p = []  # store paths
+    e = []  # store errors
+
+    # for each O-D pair
+    for routeid, orig, dest in zip(routes_df[col_id], routes_df[col_orig], routes_df[col_dest]):
+        try:
+            path, time_sec, settled = router.route(orig, dest)
+            p.append({'b_routeid': routeid, col_path: format_path(path, path_format), col_time: int(round(time_sec, 0))})
+        except Exception as e_message:
+            e.append({'routeid': routeid, 'od_pair': [orig, dest], 'exception': e_message})
+
+    METRICS.count_errors(e)
+
+    return p, e
+
+
+# CLASSES
+class PointRouter:
+    """
+    A* point-to-point searches on a NetworkX graph or CSRGraph with node coordinates. The heuristic is the straight-line
+    distance to the target divided by the fastest edge speed of the graph (max_speed()), so routes are exact shortest
+    paths while the search settles mostly the nodes between origin and target instead of a disk around the origin.
+    """
+    def __init__(self, graph, col_cost):
+        """
+        :param graph: NetworkX graph object (create_networkx_object(nodes_table='nodes')) or CSRGraph object
+            (create_csr_graph(nodes_table='nodes'))
+        :param col_cost: String containing name of weight column ('time_drive_sec' or 'time_walk_sec')
+        """
+        self.graph = graph
+        self.col_cost = col_cost
+        self.csr = isinstance(graph, CSRGraph)
+
+        # node coordinates as Python lists/dicts (fast scalar access in the search loop)
+        if self.csr:
+            if graph.coords is None:
+                raise ValueError('CSRGraph has no node coordinates (create_csr_graph(nodes_table=...))')
+            coords = np.asarray(graph.coords, dtype=np.float64)
+            self.indptr = graph.indptr.tolist()
+            self.indices = graph.indices.tolist()
+            self.costs = np.asarray(graph.costs[col_cost], dtype=np.float64).tolist()
+        else:
+            if any('x' not in attrs for attrs in graph.nodes.values()):
+                raise ValueError('Graph has no node coordinates (create_networkx_object(nodes_table=...))')
+            coords = np.array([[attrs['x'], attrs['y']] for attrs in graph.nodes.values()], dtype=np.float64).reshape(-1, 2)
+
+        # a heuristic of 0 (plain Dijkstra) if any node has no coordinates, a partial heuristic is not consistent
+        self.speed = max_speed(graph, col_cost)
+        if np.isnan(coords).any():
+            logger.warning('%s nodes have no coordinates, A* searches fall back to Dijkstra', int(np.isnan(coords).any(axis=1).sum()))
+            self.speed = math.inf
+        coords = np.nan_to_num(coords)
+        if self.csr:
+            self.x, self.y = coords[:, 0].tolist(), coords[:, 1].tolist()
+        else:
+            self.x = dict(zip(graph.nodes, coords[:, 0].tolist()))
+            self.y = dict(zip(graph.nodes, coords[:, 1].tolist()))
+
+    def route(self, orig, dest):
+        """
+        Shortest path between two nodes
+        :param orig: Origin node ID
+        :param dest: Destination node ID
+        :return: path (list of node IDs), travel time in col_cost units, and number of settled nodes
+        """
+        if self.csr:
+            source, target = self.graph.index(orig), self.graph.index(dest)
+            if source < 0 or target < 0:
+                raise nx.NodeNotFound('Node {} not in graph'.format(orig if source < 0 else dest))
+        else:
+            if orig not in self.graph or dest not in self.graph:
+                raise nx.NodeNotFound('Node {} not in graph'.format(orig if orig not in self.graph else dest))
+            source, target = orig, dest
+
+        with METRICS.timer('search'):
+            pred, cost, settled = self._astar(source, target)
+        METRICS.count('searches')
+        METRICS.count('settled_nodes', settled)
+        if pred is None:
+            raise nx.NetworkXNoPath('Node {} not reachable from {}'.format(dest, orig))
+
+        # walk the predecessors back to the origin
+        path = [target]
+        while path[-1] != source:
+            path.append(pred[path[-1]])
+        path.reverse()
+        if self.csr:
+            path = self.graph.node_ids[path].tolist()
+
+        return path, cost, settled
+
+    def _neighbors(self, u):
+        if self.csr:
+            start, end = self.indptr[u], self.indptr[u + 1]
+            return zip(self.indices[start:end], self.costs[start:end])
+        return ((v, float(attrs[self.col_cost])) for v, attrs in self.graph.adj[u].items())
+
+    def _astar(self, source, target):
+        """
+        A* search (consistent heuristic: every node is settled once)
+        :return: predecessor dictionary (None if the target is unreachable), cost of the target, number of settled nodes
+        """
+        x, y, speed = self.x, self.y, self.speed
+        xt, yt = x[target], y[target]
+        dist = {source: 0.0}
+        pred = {}
+        settled = set()
+        heap = [(math.hypot(x[source] - xt, y[source] - yt) / speed, 0.0, 0, source)]
+        counter = 1  # tie breaker, node IDs are not always comparable
+
+        while heap:
+            _, cost_u, _, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            settled.add(u)
+            if u == target:
+                return pred, cost_u, len(settled)
+            for v, cost_uv in self._neighbors(u):
+                cost_v = cost_u + cost_uv
+                if v not in settled and cost_v < dist.get(v, math.inf):
+                    dist[v] = cost_v
+                    pred[v] = u
+                    heapq.heappush(heap, (cost_v + math.hypot(x[v] - xt, y[v] - yt) / speed, cost_v, counter, v))
+                    counter += 1
+
+        return None, math.inf, len(settled)
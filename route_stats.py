@@ -0,0 +1,200 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Functions related to streaming travel time statistics: mergeable per-mode aggregates (count, mean, variance, min, max,
+# histogram, quantile sketch) updated as routes are found, replacing the full-table scans of od_routes_stats.sql
+
+# IMPORTS
+import csv
+import logging
+import math
+import os
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# CLASSES
+class RouteStats:
+    """
+    Online travel time aggregates for one travel mode. Batches are folded in with Welford/Chan updates (count, mean,
+    sum of squared deviations), so two RouteStats objects (e.g. from parallel workers) merge exactly with merge().
+    The histogram uses fixed-width bins plus one overflow bin (like od_routes_stats.sql: 5 minute bins up to one hour).
+    Quantiles come from a log-bucket sketch: every value is counted in bucket ceil(log_gamma(value)), so a quantile is
+    within relative error alpha of the exact value and sketches merge by adding bucket counts.
+    """
+    def __init__(self, bin_width=300, n_bins=12, alpha=0.01):
+        """
+        :param bin_width: (optional) Histogram bin width in seconds
+        :param n_bins: (optional) Number of histogram bins before the overflow bin (values > bin_width * n_bins)
+        :param alpha: (optional) Relative error of the quantile sketch
+        """
+        self.bin_width = bin_width
+        self.n_bins = n_bins
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.histogram = np.zeros(n_bins + 1, dtype=np.int64)
+        self.zero_count = 0
+        self.buckets = {}
+
+    def empty(self):
+        """
+        New empty RouteStats object with the same settings (e.g. for a worker process, see merge())
+        :return: RouteStats
+        """
+        return RouteStats(self.bin_width, self.n_bins, self.alpha)
+
+    def add(self, values):
+        """
+        Add a batch of travel times
+        :param values: Array or list of travel times in seconds
+        :return: None
+        """
+        values = np.asarray(values, dtype=np.float64)
+        n = len(values)
+        if n == 0:
+            return
+
+        # Chan et al. combination of the running and the batch aggregates
+        mean = float(values.mean())
+        m2 = float(((values - mean) ** 2).sum())
+        self._combine(n, mean, m2)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        # histogram bins: (0, w], (w, 2w], ..., (n_bins * w, inf), 0 counts in the first bin
+        bins = np.clip(np.ceil(values / self.bin_width).astype(np.int64) - 1, 0, self.n_bins)
+        self.histogram += np.bincount(bins, minlength=self.n_bins + 1)
+
+        # quantile sketch buckets
+        positive = values[values > 0]
+        self.zero_count += n - len(positive)
+        keys, counts = np.unique(np.ceil(np.log(positive) / math.log(self.gamma)).astype(np.int64), return_counts=True)
+        for key, c in zip(keys.tolist(), counts.tolist()):
+            self.buckets[key] = self.buckets.get(key, 0) + c
+
+    def add_routes(self, paths_list, col_time):
+        """
+        Add the travel times of routed O-D pairs (routes beyond the search budget have no time and are skipped)
+        :param paths_list: List with routeids, paths, and travel times (find_shortest_route())
+        :param col_time: String containing name of travel time key ('walk_time_sec' or 'drive_time_sec')
+        :return: None
+        """
+        self.add([row[col_time] for row in paths_list if row[col_time] is not None])
+
+    def _combine(self, n, mean, m2):
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.count * n / total
+        self.count = total
+
+    def merge(self, other):
+        """
+        Add the aggregates of another RouteStats object with the same settings
+        :param other: RouteStats
+        :return: None
+        """
+        if (other.bin_width, other.n_bins, other.alpha) != (self.bin_width, self.n_bins, self.alpha):
+            raise ValueError('RouteStats objects with different settings cannot be merged')
+        if other.count == 0:
+            return
+        self._combine(other.count, other.mean, other.m2)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.histogram += other.histogram
+        self.zero_count += other.zero_count
+        for key, c in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + c
+
+    def std(self):
+        """
+        Sample standard deviation (as Postgres stddev())
+        :return: Float, or None for fewer than 2 values
+        """
+        if self.count < 2:
+            return None
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def quantile(self, q):
+        """
+        Approximate quantile from the sketch (relative error alpha)
+        :param q: Quantile between 0 and 1 (e.g. 0.5 for the median)
+        :return: Float travel time in seconds, or None if no values were added
+        """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        seen = self.zero_count
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                # bucket midpoint, (gamma^(key-1), gamma^key]
+                value = 2 * self.gamma ** key / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        """
+        Summary statistics
+        :return: Dictionary with count, mean, std, min, max, p50, p90, and p99
+        """
+        if self.count == 0:
+            return {'count': 0, 'mean': None, 'std': None, 'min': None, 'max': None, 'p50': None, 'p90': None, 'p99': None}
+        return {'count': self.count, 'mean': self.mean, 'std': self.std(), 'min': self.min, 'max': self.max,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99)}
+
+    def histogram_rows(self):
+        """
+        Histogram as a frequency table
+        :return: List of (range label, count) tuples, e.g. ('0-5 min', 120), ..., ('60+ min', 7)
+        """
+        def minutes(sec):
+            return '{:g}'.format(sec / 60)
+        rows = []
+        for k in range(self.n_bins):
+            rows.append(('{}-{} min'.format(minutes(k * self.bin_width), minutes((k + 1) * self.bin_width)), int(self.histogram[k])))
+        rows.append(('{}+ min'.format(minutes(self.n_bins * self.bin_width)), int(self.histogram[self.n_bins])))
+        return rows
+
+
+# FUNCTIONS
+def report_route_stats(stats_by_mode, out_dir=None):
+    """
+    Emit the summary and frequency tables of a run (logged, and written as CSV files if out_dir is given):
+        route_stats_summary.csv (mode, count, mean, std, min, max, p50, p90, p99)
+        route_stats_histogram.csv (mode, range, count)
+    :param stats_by_mode: Dictionary {mode: RouteStats}, e.g. {'walk': RouteStats(), 'drive': RouteStats()}
+    :param out_dir: (optional) String containing path to the output directory
+    :return: None
+    """
+    stats_by_mode = {mode: stats for mode, stats in stats_by_mode.items() if stats.count > 0}
+    columns = ['count', 'mean', 'std', 'min', 'max', 'p50', 'p90', 'p99']
+
+    for mode, stats in stats_by_mode.items():
+        summary = stats.summary()
+        logger.info('%s travel times: %s', mode, ' '.join('{}={}'.format(col, round(summary[col], 1) if summary[col] is not None else None) for col in columns))
+        logger.info('%s frequency table: %s', mode, ', '.join('{}: {}'.format(label, n) for label, n in stats.histogram_rows()))
+
+    if out_dir is None:
+        return
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, 'route_stats_summary.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['mode'] + columns)
+        for mode, stats in stats_by_mode.items():
+            summary = stats.summary()
+            writer.writerow([mode] + [summary[col] for col in columns])
+    with open(os.path.join(out_dir, 'route_stats_histogram.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['mode', 'range', 'count'])
+        for mode, stats in stats_by_mode.items():
+            for label, n in stats.histogram_rows():
+                writer.writerow([mode, label, n])
+
+    return
@@ -0,0 +1,122 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Shared fixtures for the tests: a synthetic network and O-D batch (no SANDAG data or Postgres needed)
+
+# IMPORTS
+import os
+import random
+import sys
+from decimal import Decimal
+import networkx as nx
+import numpy as np
+import pandas as pd
+import pytest
+
+# the modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from csr_graph import CSRGraph  # noqa: E402
+from network_analysis import find_shortest_route  # noqa: E402
+from path_codec import decode_path_text  # noqa: E402
+
+# first synthetic node ID, an isolated edge (not connected to the grid), and a node ID that is not in the graph
+FIRST_NODE = 1000
+ISOLATED = (5000, 5001)
+MISSING_NODE = 77
+
+
+# FUNCTIONS
+def make_edges(size=20, seed=1):
+    """
+    Grid network with random walk/drive times, one parallel edge, and one isolated edge
+    :param size: (optional) Grid side
+    :param seed: (optional) Random seed
+    :return: 3 numpy arrays: fnode, tnode, and a dictionary of cost arrays
+    """
+    rng = random.Random(seed)
+    grid = nx.convert_node_labels_to_integers(nx.grid_2d_graph(size, size))
+    fnode, tnode, walk, drive = [], [], [], []
+    for u, v in grid.edges():
+        fnode.append(u + FIRST_NODE)
+        tnode.append(v + FIRST_NODE)
+        walk.append(rng.random() * 100)
+        drive.append(rng.randint(1, 50) / 3)
+    # parallel edge (the cheaper one is used)
+    fnode.append(FIRST_NODE)
+    tnode.append(FIRST_NODE + 1)
+    walk.append(0.5)
+    drive.append(100.0)
+    # isolated edge
+    fnode.append(ISOLATED[0])
+    tnode.append(ISOLATED[1])
+    walk.append(1.0)
+    drive.append(1.0)
+    costs = {'time_walk_sec': np.array(walk), 'time_drive_sec': np.array(drive)}
+    return np.array(fnode), np.array(tnode), costs
+
+
+def make_od(n_routes=600, size=20, seed=2):
+    """
+    O-D batch with Decimal node IDs (as read from NUMERIC columns): grid pairs, repeated origins, pairs in both
+    directions, a node that is not in the graph, and pairs into the isolated edge
+    :return: Pandas dataframe with routeid, node_orig, and node_dest columns
+    """
+    rng = random.Random(seed)
+    grid_nodes = list(range(FIRST_NODE, FIRST_NODE + size * size))
+    origins = rng.sample(grid_nodes, 8) + [ISOLATED[0], MISSING_NODE]
+    rows = []
+    for routeid in range(1, n_routes + 1):
+        orig = rng.choice(origins)
+        dest = rng.choice(grid_nodes) if rng.random() < 0.95 else ISOLATED[1]
+        rows.append((routeid, orig, dest))
+    # both directions of some pairs
+    for orig, dest in [(r[1], r[2]) for r in rows[:50]]:
+        rows.append((len(rows) + 1, dest, orig))
+    df = pd.DataFrame(rows, columns=['routeid', 'node_orig', 'node_dest'])
+    df['node_orig'] = [Decimal(n) for n in df['node_orig']]
+    df['node_dest'] = [Decimal(n) for n in df['node_dest']]
+    return df
+
+
+def route(graph, od_df, **kwargs):
+    """
+    Route a walk batch and key the results by routeid
+    :return: 2 dictionaries: {routeid: output row} and {routeid: exception}
+    """
+    p, e = find_shortest_route(graph, od_df, 'routeid', 'node_orig', 'node_dest', 'time_walk_sec', walk=True, **kwargs)
+    return {row['b_routeid']: row for row in p}, {row['routeid']: row['exception'] for row in e}
+
+
+def assert_same_routes(a, b, paths=True):
+    assert set(a) == set(b)
+    for routeid, row in a.items():
+        assert row['walk_time_sec'] == b[routeid]['walk_time_sec'], routeid
+        if paths:
+            assert decode_path_text(row['walk_path']) == decode_path_text(b[routeid]['walk_path']), routeid
+
+
+def make_networkx(fnode, tnode, costs):
+    """
+    NetworkX graph object like create_networkx_object() builds it (parallel edges collapsed to the cheaper walk edge)
+    :return: NetworkX Graph
+    """
+    graph = nx.Graph()
+    for k, (u, v) in enumerate(zip(fnode.tolist(), tnode.tolist())):
+        attrs = {col: float(arr[k]) for col, arr in costs.items()}
+        if not graph.has_edge(u, v) or attrs['time_walk_sec'] < graph[u][v]['time_walk_sec']:
+            graph.add_edge(u, v, **attrs)
+    return graph
+
+
+@pytest.fixture(scope='session')
+def csr_graph():
+    return CSRGraph.from_edges(*make_edges())
+
+
+@pytest.fixture(scope='session')
+def nx_graph():
+    return make_networkx(*make_edges())
+
+
+@pytest.fixture
+def od_df():
+    return make_od()
@@ -0,0 +1,36 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of the accessibility measures: threshold binning, CSRGraph vs NetworkX, brute force counts
+
+# IMPORTS
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+from accessibility import _bin_counts, compute_accessibility
+from conftest import MISSING_NODE
+
+
+# FUNCTIONS
+def test_bin_counts():
+    times = np.array([[0, 300, 301, 900, np.inf],
+                      [np.inf, np.inf, 50, 2000, 599]])
+    weights = np.array([1.0, 2.0, 3.0, 4.0, 5.0])
+    counts = _bin_counts(times, weights, np.array([300, 600, 900]))
+    # thresholds are inclusive, unreachable POIs count nowhere
+    assert counts.tolist() == [[3, 6, 10], [3, 8, 8]]
+
+
+def test_csr_matches_networkx_and_brute_force(csr_graph, nx_graph):
+    origins = np.append(csr_graph.node_ids[::17], MISSING_NODE)
+    pois = csr_graph.node_ids[::5]
+    weights = np.arange(1, len(pois) + 1, dtype=np.float64)
+    thresholds = (100, 250, 400)
+
+    csr_counts = compute_accessibility(csr_graph, origins, pois, 'time_walk_sec', thresholds, weights, chunk_size=4)
+    nx_counts = compute_accessibility(nx_graph, origins, pois, 'time_walk_sec', thresholds, weights, chunk_size=4)
+    assert np.allclose(csr_counts, nx_counts)
+
+    # brute force: full searches, then sum the weights within each threshold
+    dist = dijkstra(csr_graph.matrix('time_walk_sec'), indices=csr_graph.index(origins[:-1]))[:, csr_graph.index(pois)]
+    expected = np.stack([(np.where(dist <= t, weights, 0)).sum(axis=1) for t in thresholds], axis=1)
+    assert np.allclose(csr_counts[:-1], expected)
+    # origins that are not in the graph reach nothing
+    assert csr_counts[-1].tolist() == [0, 0, 0]
@@ -0,0 +1,35 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Smoke tests of the benchmark harness on a small synthetic network (SQLite stand-in database)
+
+# IMPORTS
+import json
+import os
+import subprocess
+import sys
+import pytest
+from benchmark import run_benchmarks
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# FUNCTIONS
+@pytest.mark.parametrize('network', ['grid', 'geometric'])
+def test_run_benchmarks(network):
+    report = run_benchmarks(network, size=5, n_origins=4, n_dests=6, methods=('pairwise', 'by_origin', 'csr', 'ch'), memory=False)
+    steps = {entry['step']: entry for entry in report['results']}
+    assert list(steps) == ['build_networkx', 'build_csr', 'read_od', 'route_pairwise', 'route_by_origin', 'route_csr',
+                           'build_ch', 'route_ch', 'write_update', 'write_staging']
+    assert steps['read_od']['routes'] == report['routes'] > 0
+    # all methods route the same O-D pairs
+    assert steps['route_pairwise']['errors'] == steps['route_by_origin']['errors'] == steps['route_csr']['errors']
+    assert steps['write_update']['routes'] == report['routes'] - steps['route_csr']['errors']
+
+
+def test_command_line(tmp_path):
+    output = tmp_path / 'report.json'
+    subprocess.run([sys.executable, os.path.join(ROOT, 'benchmark.py'), '--size', '5', '--origins', '3', '--dests', '3',
+                    '--no-memory', '--output', str(output)], check=True, cwd=str(tmp_path))
+    with open(output) as f:
+        report = json.load(f)
+    assert report['size'] == 5
+    assert [entry['step'] for entry in report['results']][-1] == 'write_staging'
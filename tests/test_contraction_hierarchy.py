@@ -0,0 +1,106 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of the contraction hierarchy: travel times equal Dijkstra on the original graph
+
+# IMPORTS
+import numpy as np
+import pytest
+from scipy.sparse.csgraph import dijkstra
+from contraction_hierarchy import ContractionHierarchy, build_contraction_hierarchy
+from csr_graph import CSRGraph
+from travel_matrix import write_travel_matrix
+from conftest import MISSING_NODE, make_edges
+
+
+# FUNCTIONS
+def dijkstra_matrix(graph, origs, dests):
+    dist = dijkstra(graph.matrix('time_walk_sec'), directed=True, indices=graph.index(origs))
+    return dist[:, graph.index(dests)]
+
+
+@pytest.fixture(scope='module')
+def small_graph():
+    fnode, tnode, costs = make_edges(size=12)
+    return CSRGraph.from_edges(fnode, tnode, costs)
+
+
+@pytest.fixture(scope='module')
+def hierarchy(small_graph):
+    return build_contraction_hierarchy(small_graph, 'time_walk_sec')
+
+
+def test_many_to_many_matches_dijkstra(small_graph, hierarchy):
+    origs, dests = small_graph.node_ids[::3], small_graph.node_ids[::5]
+    expected = dijkstra_matrix(small_graph, origs, dests)
+    times = hierarchy.many_to_many(origs, dests)
+    # isolated nodes are unreachable (inf) in both
+    assert np.isinf(expected).any()
+    assert np.array_equal(np.isinf(times), np.isinf(expected))
+    assert np.allclose(times[np.isfinite(expected)], expected[np.isfinite(expected)])
+
+
+def test_small_join_blocks(small_graph, hierarchy):
+    origs, dests = small_graph.node_ids[:20], small_graph.node_ids[-20:]
+    assert np.array_equal(hierarchy.many_to_many(origs, dests, max_entries=7), hierarchy.many_to_many(origs, dests))
+
+
+def test_reused_buckets(small_graph, hierarchy):
+    origs, dests = small_graph.node_ids[::2], small_graph.node_ids[::7]
+    buckets = hierarchy.buckets(dests)
+    times = np.vstack([hierarchy.many_to_many(origs[c:c + 9], dests, buckets=buckets) for c in range(0, len(origs), 9)])
+    assert np.array_equal(times, hierarchy.many_to_many(origs, dests))
+
+
+def test_directed_graph():
+    fnode, tnode, costs = make_edges(size=8, seed=3)
+    # one-way edges in both orientations with different costs
+    graph = CSRGraph.from_edges(np.concatenate([fnode, tnode]), np.concatenate([tnode, fnode]),
+                                {col: np.concatenate([arr, arr[::-1] + 1]) for col, arr in costs.items()}, directed=True)
+    ch = build_contraction_hierarchy(graph, 'time_walk_sec')
+    expected = dijkstra_matrix(graph, graph.node_ids, graph.node_ids)
+    times = ch.many_to_many(graph.node_ids, graph.node_ids)
+    assert np.array_equal(np.isinf(times), np.isinf(expected))
+    assert np.allclose(times[np.isfinite(expected)], expected[np.isfinite(expected)])
+    # bidirectional point queries
+    pairs = [(graph.node_ids[i], graph.node_ids[j]) for i in range(0, len(graph.node_ids), 5) for j in range(0, len(graph.node_ids), 3)]
+    assert np.allclose([ch.time(orig, dest) for orig, dest in pairs], [times[graph.index(orig), graph.index(dest)] for orig, dest in pairs])
+
+
+def test_networkx_input(small_graph, hierarchy):
+    ch = build_contraction_hierarchy(small_graph.to_networkx(), 'time_walk_sec')
+    nodes = small_graph.node_ids[::4]
+    assert np.allclose(ch.many_to_many(nodes, nodes), hierarchy.many_to_many(nodes, nodes))
+
+
+def test_time_and_save_load(small_graph, hierarchy, tmp_path):
+    orig, dest = small_graph.node_ids[1], small_graph.node_ids[-3]
+    assert np.isclose(hierarchy.time(orig, dest), dijkstra_matrix(small_graph, [orig], [dest])[0, 0])
+    # point queries equal the bucket queries, unreachable (isolated) pairs included
+    nodes = small_graph.node_ids[::6]
+    assert np.allclose([[hierarchy.time(o, d) for d in nodes] for o in nodes], hierarchy.many_to_many(nodes, nodes))
+    hierarchy.save(str(tmp_path / 'ch.npz'))
+    loaded = ContractionHierarchy.load(str(tmp_path / 'ch.npz'))
+    assert loaded.time(orig, dest) == hierarchy.time(orig, dest)
+    assert loaded.fingerprint is None
+
+    # the edges fingerprint is stored with the index
+    ContractionHierarchy(hierarchy.node_ids, hierarchy.rank, hierarchy.fwd, hierarchy.bwd, '312:-4242').save(str(tmp_path / 'ch_fp.npz'))
+    assert ContractionHierarchy.load(str(tmp_path / 'ch_fp.npz')).fingerprint == '312:-4242'
+
+
+def test_unknown_nodes(small_graph, hierarchy, tmp_path):
+    # nodes not in the hierarchy get inf rows/columns, as in the CSRGraph travel matrix
+    nodes = small_graph.node_ids[::5]
+    origs = np.insert(nodes, 2, MISSING_NODE)
+    dests = np.append(nodes, MISSING_NODE + 1)
+    times = hierarchy.many_to_many(origs, dests)
+    assert np.isinf(times[2]).all() and np.isinf(times[:, -1]).all()
+    assert np.allclose(np.delete(times, 2, axis=0)[:, :-1], hierarchy.many_to_many(nodes, nodes))
+    assert hierarchy.time(nodes[0], MISSING_NODE) == np.inf
+    assert hierarchy.index(MISSING_NODE) == -1
+    assert hierarchy.index(nodes).tolist() == small_graph.index(nodes).tolist()
+
+    # same matrix as the CSRGraph branch of write_travel_matrix()
+    origs, dests = np.sort(origs), np.sort(dests)
+    write_travel_matrix(hierarchy, origs, dests, None, str(tmp_path / 'ch'), 'walk', chunk_size=3)
+    write_travel_matrix(small_graph, origs, dests, 'time_walk_sec', str(tmp_path / 'csr'), 'walk', chunk_size=3)
+    assert np.allclose(np.load(str(tmp_path / 'ch' / 'walk.npy')), np.load(str(tmp_path / 'csr' / 'walk.npy')))
@@ -0,0 +1,38 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of the array-backed CSRGraph: node lookups, parallel edges, and route parity with the NetworkX graph object
+
+# IMPORTS
+import numpy as np
+import pytest
+from conftest import FIRST_NODE, MISSING_NODE, assert_same_routes, route
+
+
+# FUNCTIONS
+def test_index(csr_graph):
+    assert csr_graph.index(csr_graph.node_ids[5]) == 5
+    assert csr_graph.index(MISSING_NODE) == -1
+    assert csr_graph.index(np.array([FIRST_NODE, MISSING_NODE])).tolist() == [0, -1]
+    assert csr_graph.has_node(FIRST_NODE) and not csr_graph.has_node(MISSING_NODE)
+
+
+def test_parallel_edges_keep_minimum(csr_graph):
+    u, v = csr_graph.index(np.array([FIRST_NODE, FIRST_NODE + 1]))
+    matrix = csr_graph.matrix('time_walk_sec')
+    assert matrix[u, v] == 0.5 and matrix[v, u] == 0.5
+
+
+def test_to_networkx(csr_graph, nx_graph):
+    graph = csr_graph.to_networkx()
+    assert graph.number_of_nodes() == nx_graph.number_of_nodes()
+    assert graph.number_of_edges() == nx_graph.number_of_edges()
+    assert graph[FIRST_NODE][FIRST_NODE + 1]['time_walk_sec'] == 0.5
+
+
+@pytest.mark.parametrize('by_origin', [False, True])
+def test_csr_matches_networkx(csr_graph, nx_graph, od_df, by_origin):
+    nx_paths, nx_errors = route(nx_graph, od_df, by_origin=by_origin)
+    csr_paths, csr_errors = route(csr_graph, od_df)
+
+    assert_same_routes(nx_paths, csr_paths)
+    assert set(nx_errors) == set(csr_errors)
+    assert {type(e) for e in csr_errors.values()} == {type(e) for e in nx_errors.values()}
@@ -0,0 +1,72 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of the chunked table loads: table DDL from the first chunk, table creation and COPY in one transaction
+
+# IMPORTS
+from contextlib import contextmanager
+import pandas as pd
+import pytest
+
+# db_implementation needs the GIS packages (shapefile ingestion)
+pytest.importorskip('geopandas')
+pytest.importorskip('fiona')
+import db_implementation  # noqa: E402
+from db_implementation import _copy_chunks, _create_table_sql  # noqa: E402
+
+
+# CLASSES
+class RecordingConnection:
+    """
+    DBAPI connection recording the statements of one load (commit/rollback included), failing on a chosen COPY
+    """
+    def __init__(self, fail_on_copy=None):
+        self.statements = []
+        self.fail_on_copy = fail_on_copy
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql_str):
+        self.statements.append(sql_str)
+
+    def copy_expert(self, sql_str, buffer):
+        self.statements.append(sql_str)
+        if sum(s.startswith('COPY') for s in self.statements) == self.fail_on_copy:
+            raise RuntimeError('COPY failed')
+
+    def commit(self):
+        self.statements.append('COMMIT')
+
+    def rollback(self):
+        self.statements.append('ROLLBACK')
+
+    def close(self):
+        pass
+
+
+# FUNCTIONS
+def test_create_table_sql():
+    df = pd.DataFrame({'SRA': [1, 2], 'area': [1.5, None], 'name': ['a', 'b'], 'flag': [True, False]})
+    sql_str = _create_table_sql('raw', 'sandag_sra_2010', df, ['"geometry" geometry(Geometry, 2230)'])
+    assert sql_str == ('DROP TABLE IF EXISTS raw.sandag_sra_2010; CREATE TABLE raw.sandag_sra_2010 ("SRA" BIGINT, '
+                       '"area" DOUBLE PRECISION, "name" TEXT, "flag" BOOLEAN, "geometry" geometry(Geometry, 2230));')
+
+
+@pytest.mark.parametrize('fail_on_copy', [None, 2])
+def test_create_and_copy_in_one_transaction(monkeypatch, fail_on_copy):
+    conn = RecordingConnection(fail_on_copy)
+
+    @contextmanager
+    def db_raw_connection(dbparams):
+        yield dbparams
+
+    monkeypatch.setattr(db_implementation, 'db_raw_connection', db_raw_connection)
+    chunks = [pd.DataFrame({'id': [1, 2]}), pd.DataFrame({'id': [3]})]
+    if fail_on_copy is None:
+        assert _copy_chunks(conn, 'raw', 't', chunks, 'CREATE TABLE raw.t (id BIGINT);') == 3
+    else:
+        with pytest.raises(RuntimeError):
+            _copy_chunks(conn, 'raw', 't', chunks, 'CREATE TABLE raw.t (id BIGINT);')
+    # the table is created on the COPY connection, committed or rolled back together with the rows
+    assert conn.statements[0] == 'CREATE TABLE raw.t (id BIGINT);'
+    assert conn.statements[-1] == ('COMMIT' if fail_on_copy is None else 'ROLLBACK')
+    assert conn.statements.count('COMMIT') == (1 if fail_on_copy is None else 0)
@@ -0,0 +1,40 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of find_shortest_route(): one search per origin (by_origin) vs one search per O-D pair
+
+# IMPORTS
+import networkx as nx
+from path_codec import decode_path_text
+from conftest import ISOLATED, MISSING_NODE, assert_same_routes, route
+
+
+# FUNCTIONS
+def test_by_origin_matches_pairwise(nx_graph, od_df):
+    pairwise, pairwise_errors = route(nx_graph, od_df)
+    by_origin, by_origin_errors = route(nx_graph, od_df, by_origin=True)
+
+    assert_same_routes(pairwise, by_origin)
+    assert set(pairwise_errors) == set(by_origin_errors)
+    assert len(pairwise) + len(pairwise_errors) == len(od_df)
+
+
+def test_errors(nx_graph, od_df):
+    _, errors = route(nx_graph, od_df, by_origin=True)
+    # the missing node and the isolated edge are errors, not routes
+    missing = set(od_df.loc[(od_df['node_orig'] == MISSING_NODE) | (od_df['node_dest'] == MISSING_NODE), 'routeid'])
+    assert missing and missing <= set(errors)
+    isolated = od_df.loc[(od_df['node_dest'] == ISOLATED[1]) & (od_df['node_orig'] != ISOLATED[0]) & (od_df['node_orig'] != MISSING_NODE)]
+    assert len(isolated) > 0
+    assert all(isinstance(errors[r], nx.NetworkXNoPath) for r in isolated['routeid'])
+
+
+def test_paths_are_shortest(nx_graph, od_df):
+    paths, _ = route(nx_graph, od_df, by_origin=True)
+    origins = {}
+    for row in od_df.itertuples():
+        if row.routeid not in paths:
+            continue
+        if row.node_orig not in origins:
+            origins[row.node_orig] = nx.single_source_dijkstra_path_length(nx_graph, int(row.node_orig), weight='time_walk_sec')
+        path = decode_path_text(paths[row.routeid]['walk_path'])
+        assert path[0] == row.node_orig and path[-1] == row.node_dest
+        assert paths[row.routeid]['walk_time_sec'] == int(round(origins[row.node_orig][int(row.node_dest)], 0))
@@ -0,0 +1,39 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of the graph snapshot: save/load round trip, memory-mapped routing, incomplete snapshots
+
+# IMPORTS
+import os
+import numpy as np
+import pytest
+from csr_graph import CSRGraph
+from conftest import route
+
+
+# FUNCTIONS
+@pytest.mark.parametrize('mmap_mode', ['r', None])
+def test_save_load(csr_graph, od_df, tmp_path, mmap_mode):
+    graph_dir = str(tmp_path / 'graph')
+    csr_graph.save(graph_dir, meta={'fingerprint': 'abc'})
+    assert CSRGraph.read_meta(graph_dir)['fingerprint'] == 'abc'
+
+    loaded = CSRGraph.load(graph_dir, mmap_mode=mmap_mode)
+    assert np.array_equal(loaded.node_ids, csr_graph.node_ids)
+    assert np.array_equal(loaded.indptr, csr_graph.indptr)
+    assert np.array_equal(loaded.indices, csr_graph.indices)
+    for col in csr_graph.costs:
+        assert np.array_equal(loaded.costs[col], csr_graph.costs[col])
+    assert loaded.is_directed() == csr_graph.is_directed()
+    loaded_paths, loaded_errors = route(loaded, od_df)
+    paths, errors = route(csr_graph, od_df)
+    assert loaded_paths == paths
+    assert set(loaded_errors) == set(errors)
+
+
+def test_incomplete_snapshot(csr_graph, tmp_path):
+    graph_dir = str(tmp_path / 'graph')
+    csr_graph.save(graph_dir)
+    # graph.json is written last, without it the snapshot is incomplete
+    os.remove(os.path.join(graph_dir, 'graph.json'))
+    assert CSRGraph.read_meta(graph_dir) is None
+    with pytest.raises(FileNotFoundError):
+        CSRGraph.load(graph_dir)
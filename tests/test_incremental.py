@@ -0,0 +1,77 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of the incremental updates: edge -> route reverse index, deleted edge diff, and improvable routes
+
+# IMPORTS
+import networkx as nx
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse.csgraph import dijkstra
+from csr_graph import CSRGraph
+from incremental import EdgeRouteIndex, deleted_edges, find_improvable_routes
+from conftest import make_edges
+
+
+# FUNCTIONS
+@pytest.fixture
+def index():
+    return EdgeRouteIndex.build([(10, [1, 2, 3]), (11, [3, 4]), (12, [4, 1, 2]), (13, [5])])
+
+
+def test_routes(index):
+    assert index.routes([(1, 2)]).tolist() == [10, 12]
+    # undirected: (2, 1) is the same edge
+    assert index.routes([(2, 1), (4, 3)]).tolist() == [10, 11, 12]
+    assert index.routes([(1, 3), (7, 8)]).tolist() == []
+
+
+def test_directed_routes():
+    index = EdgeRouteIndex.build([(10, [1, 2, 3]), (11, [3, 2])], directed=True)
+    assert index.routes([(2, 3)]).tolist() == [10]
+    assert index.routes([(3, 2)]).tolist() == [11]
+
+
+def test_replace_and_save(index, tmp_path):
+    index.replace([10], [(10, [1, 4, 3])])
+    assert index.routes([(1, 2)]).tolist() == [12]
+    assert index.routes([(1, 4)]).tolist() == [10, 12]
+    index.save(str(tmp_path / 'edges.npz'))
+    loaded = EdgeRouteIndex.load(str(tmp_path / 'edges.npz'))
+    assert loaded.routes([(3, 4)]).tolist() == [10, 11]
+
+
+@pytest.mark.parametrize('kind', ['csr', 'networkx'])
+def test_deleted_edges(index, kind):
+    # edge (3, 4) was deleted from the network
+    fnode, tnode = np.array([1, 2, 4]), np.array([2, 3, 1])
+    graph = CSRGraph.from_edges(fnode, tnode, {'time_walk_sec': np.ones(3)})
+    if kind == 'networkx':
+        graph = graph.to_networkx()
+    deleted = deleted_edges(graph, index)
+    assert deleted == [(3, 4)]
+    assert index.routes(deleted).tolist() == [11]
+
+
+def test_no_deleted_edges(index):
+    graph = nx.Graph([(2, 1), (3, 2), (3, 4), (1, 4)])
+    assert deleted_edges(graph, index) == []
+
+
+def test_improvable_routes(csr_graph):
+    # stored times on the old network, then one grid edge gets much faster
+    rng = np.random.default_rng(0)
+    origs = rng.choice(csr_graph.node_ids[:-2], 30)
+    dests = rng.choice(csr_graph.node_ids[:-2], 30)
+    old = dijkstra(csr_graph.matrix('time_walk_sec'), indices=csr_graph.index(origs))
+    stored = np.round(old[np.arange(30), csr_graph.index(dests)])
+    route_times = pd.DataFrame({'routeid': np.arange(30), 'node_orig': origs, 'node_dest': dests, 'time': stored})
+
+    fnode, tnode, costs = make_edges()
+    costs['time_walk_sec'][100] = 0.0
+    graph = CSRGraph.from_edges(fnode, tnode, costs)
+    new = dijkstra(graph.matrix('time_walk_sec'), indices=graph.index(origs))
+    faster = np.flatnonzero(np.round(new[np.arange(30), graph.index(dests)]) < stored)
+    assert len(faster) > 0
+
+    improvable = find_improvable_routes(graph, route_times, [(fnode[100], tnode[100])], 'time_walk_sec')
+    assert set(improvable.tolist()) == set(faster.tolist())
@@ -0,0 +1,95 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of the run instrumentation: counters and timers, merged worker metrics, and the metrics sinks
+
+# IMPORTS
+import csv
+import logging
+import pytest
+from instrumentation import METRICS, Metrics, make_sink, report_metrics
+from parallel_routing import ParallelRouter
+from conftest import route
+
+
+# FUNCTIONS
+@pytest.fixture
+def metrics():
+    registry = Metrics()
+    registry.count('searches', 3)
+    registry.count('searches')
+    registry.count_errors([{'exception': KeyError('a')}, {'exception': KeyError('b')}, {'exception': ValueError('c')}])
+    registry.add_time('search', 0.5)
+    registry.add_time('search', 1.5, calls=3)
+    return registry
+
+
+def test_counters_and_timers(metrics):
+    snapshot = metrics.snapshot()
+    assert snapshot['counters'] == {'searches': 4, 'errors.KeyError': 2, 'errors.ValueError': 1}
+    # the max of a multi-call add_time() is the mean per call
+    assert snapshot['timers'] == {'search': (4, 2.0, 0.5)}
+    with metrics.timer('db_read'):
+        pass
+    assert metrics.snapshot()['timers']['db_read'][0] == 1
+
+
+def test_merge(metrics):
+    total = Metrics()
+    total.merge(metrics.snapshot())
+    total.merge(metrics.snapshot())
+    assert total.snapshot()['counters']['searches'] == 8
+    assert total.snapshot()['timers']['search'] == (8, 4.0, 0.5)
+    total.reset()
+    assert total.snapshot() == {'counters': {}, 'timers': {}}
+
+
+def test_parallel_metrics_match_serial(csr_graph, od_df):
+    METRICS.reset()
+    _, errors = route(csr_graph, od_df, by_origin=True)
+    serial = METRICS.snapshot()['counters']
+    METRICS.reset()
+    with ParallelRouter(csr_graph, processes=2) as router:
+        router.find_shortest_route(od_df, 'routeid', 'node_orig', 'node_dest', 'time_walk_sec', walk=True, by_origin=True)
+    merged = METRICS.snapshot()['counters']
+    METRICS.reset()
+
+    # worker metrics are merged into the parent registry
+    assert sum(v for k, v in merged.items() if k.startswith('errors.')) == len(errors)
+    assert {k: v for k, v in merged.items() if k.startswith('errors.')} == {k: v for k, v in serial.items() if k.startswith('errors.')}
+    assert merged['searches'] == serial['searches']
+
+
+def test_log_sink(metrics, caplog):
+    with caplog.at_level(logging.INFO, logger='instrumentation'):
+        report_metrics(make_sink('log'), metrics, batch=7, rows=100)
+    line = caplog.records[-1].getMessage()
+    assert line.startswith('metrics batch=7 rows=100 ')
+    assert 'searches=4' in line and 'search.calls=4' in line
+
+
+def test_csv_sink(metrics, tmp_path):
+    path = str(tmp_path / 'metrics.csv')
+    report_metrics([make_sink('csv', path)], metrics, batch=7)
+    report_metrics([make_sink('csv', path)], metrics)
+    with open(path) as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ['timestamp', 'metric', 'value']
+    values = [(metric, value) for _, metric, value in rows[1:]]
+    assert values[0] == ('batch', '7')
+    assert values.count(('searches', '4')) == 2
+
+
+def test_prometheus_sink(metrics, tmp_path):
+    path = str(tmp_path / 'metrics.prom')
+    report_metrics(make_sink('prometheus', path), metrics, batch=7, note='text values are skipped')
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert 'abm_last_batch 7' in lines
+    assert 'abm_searches_total 4' in lines
+    assert 'abm_errors_total{type="KeyError"} 2' in lines
+    assert 'abm_search_seconds_total 2.0' in lines
+    assert not any('note' in line for line in lines)
+
+
+def test_unknown_sink():
+    with pytest.raises(ValueError):
+        make_sink('statsd')
@@ -0,0 +1,12 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of the batch ledger SQL (statements only, the ledger itself needs Postgres)
+
+# IMPORTS
+from util import finish_batch_sql
+
+
+# FUNCTIONS
+def test_finish_batch_sql():
+    sql_str = finish_batch_sql('esco', 'od_batches', 7, 3)
+    assert sql_str.startswith("UPDATE esco.od_batches SET status = 'done', n_errors = 3")
+    assert sql_str.endswith("WHERE batchid = 7;")
@@ -0,0 +1,44 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of cutoff-bounded searches (max_cost): same errors with any budget, no times beyond the budget
+
+# IMPORTS
+import numpy as np
+import pytest
+from network_analysis import graph_components
+from conftest import FIRST_NODE, ISOLATED, route
+
+
+# FUNCTIONS
+@pytest.mark.parametrize('graph_name', ['csr_graph', 'nx_graph'])
+def test_max_cost(graph_name, od_df, request):
+    graph = request.getfixturevalue(graph_name)
+    full, full_errors = route(graph, od_df, by_origin=True)
+    budget = sorted(row['walk_time_sec'] for row in full.values())[len(full) // 2]
+    bounded, bounded_errors = route(graph, od_df, by_origin=True, max_cost=budget)
+
+    # same errors with any budget, routes beyond the budget have an empty path and no time
+    assert set(bounded_errors) == set(full_errors)
+    assert set(bounded) == set(full)
+    for routeid, row in bounded.items():
+        # stored times are rounded, a time equal to the budget may be just beyond it
+        if full[routeid]['walk_time_sec'] < budget:
+            assert row['walk_time_sec'] == full[routeid]['walk_time_sec']
+            assert row['walk_path'] == full[routeid]['walk_path']
+        elif row['walk_time_sec'] is None:
+            assert row['walk_path'] == '[]'
+        else:
+            assert full[routeid]['walk_time_sec'] <= budget + 1
+    assert route(graph, od_df, by_origin=True, max_cost=1e9)[0] == full
+
+
+def test_csr_components(csr_graph):
+    labels = csr_graph.components('time_walk_sec')
+    grid, isolated = csr_graph.index(np.array([FIRST_NODE, ISOLATED[0]]))
+    assert labels[grid] != labels[isolated]
+    assert labels[csr_graph.index(ISOLATED[1])] == labels[isolated]
+
+
+def test_networkx_components(nx_graph):
+    labels = graph_components(nx_graph)
+    assert labels[FIRST_NODE] != labels[ISOLATED[0]]
+    assert labels[ISOLATED[1]] == labels[ISOLATED[0]]
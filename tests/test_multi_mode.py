@@ -0,0 +1,72 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of multi-mode routing: walking and driving routes with route lengths from one CSRGraph
+
+# IMPORTS
+import numpy as np
+import pytest
+from scipy.sparse.csgraph import dijkstra
+from csr_graph import CSRGraph
+from network_analysis import find_shortest_route, find_shortest_route_modes
+from path_codec import decode_path_text
+from conftest import FIRST_NODE, make_edges, route
+
+
+# FUNCTIONS
+@pytest.fixture(scope='module')
+def modes_graph():
+    fnode, tnode, costs = make_edges()
+    rng = np.random.default_rng(3)
+    costs['walk_dist_meters'] = costs['time_walk_sec'] * 1.4
+    costs['drive_dist_meters'] = rng.uniform(10, 500, len(fnode))
+    return CSRGraph.from_edges(fnode, tnode, costs, aligned={'walk_dist_meters': 'time_walk_sec', 'drive_dist_meters': 'time_drive_sec'})
+
+
+def test_accumulate_matches_path_sums(csr_graph):
+    # distance in drive time along the walk-time shortest path tree, by pointer jumping and by walking each path
+    source = csr_graph.index(FIRST_NODE + 42)
+    _, pred = dijkstra(csr_graph.matrix('time_walk_sec'), indices=source, return_predecessors=True)
+    acc = csr_graph.accumulate('time_drive_sec', pred)
+    for node in range(0, len(pred), 7):
+        if pred[node] < 0:
+            assert acc[node] == 0
+            continue
+        path = csr_graph.index(np.array(csr_graph.path(pred, node)))
+        expected = csr_graph.arc_values('time_drive_sec', path[:-1], path[1:]).sum()
+        assert np.isclose(acc[node], expected)
+
+
+def test_has_arcs(csr_graph):
+    first = csr_graph.index(np.array([FIRST_NODE, FIRST_NODE, FIRST_NODE + 1]))
+    second = csr_graph.index(np.array([FIRST_NODE + 1, FIRST_NODE + 2, FIRST_NODE]))
+    assert csr_graph.has_arcs(first, second).tolist() == [True, False, True]
+    assert not csr_graph.has_arcs(np.array([-1]), first[:1])[0]
+    # the parallel edge collapses to the cheaper walking edge
+    assert csr_graph.arc_values('time_walk_sec', first[:1], second[:1])[0] == 0.5
+
+
+def test_modes_match_single_mode(modes_graph, od_df):
+    od_df['walk'] = (od_df.index % 3 == 0).astype(int)
+    paths, errors = find_shortest_route_modes(modes_graph, od_df, 'routeid', 'node_orig', 'node_dest')
+    rows = {row['b_routeid']: row for row in paths}
+    assert set(rows) == set(od_df['routeid'])
+
+    walk, _ = route(modes_graph, od_df[od_df['walk'] == 1], by_origin=True)
+    p_drive, _ = find_shortest_route(modes_graph, od_df, 'routeid', 'node_orig', 'node_dest', 'time_drive_sec', by_origin=True)
+    drive = {row['b_routeid']: row for row in p_drive}
+    for routeid, row in rows.items():
+        for mode, single in [('walk', walk), ('drive', drive)]:
+            if routeid not in single:
+                assert row['{}_time_sec'.format(mode)] is None
+                continue
+            assert row['{}_time_sec'.format(mode)] == single[routeid]['{}_time_sec'.format(mode)]
+            # route length summed along the routed path
+            path = modes_graph.index(np.array(decode_path_text(row['{}_path'.format(mode)]), dtype=np.int64))
+            length = modes_graph.arc_values('{}_dist_meters'.format(mode), path[:-1], path[1:]).sum()
+            assert row['{}_dist_meters'.format(mode)] == int(round(length, 0))
+    assert len(errors) > 0
+
+
+def test_modes_need_distance_columns(csr_graph, od_df):
+    od_df['walk'] = 1
+    with pytest.raises(ValueError):
+        find_shortest_route_modes(csr_graph, od_df, 'routeid', 'node_orig', 'node_dest')
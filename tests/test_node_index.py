@@ -0,0 +1,76 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of the dense node index and O-D index columns
+
+# IMPORTS
+from decimal import Decimal
+import networkx as nx
+import numpy as np
+import pandas as pd
+import pytest
+from network_analysis import index_column, od_node_index, od_records2df
+from node_index import NodeIndex
+from conftest import assert_same_routes, route
+
+
+# FUNCTIONS
+def test_index_round_trip():
+    node_index = NodeIndex(np.array([100003, 100010, 100500, 200000], dtype=np.int64))
+    assert node_index.index(100010) == 1
+    assert node_index.index(Decimal('200000')) == 3
+    assert node_index.index(5) == -1
+    idx = node_index.index(np.array([100500, 100003, 7, 300000]))
+    assert idx.dtype == np.int32
+    assert idx.tolist() == [2, 0, -1, -1]
+    assert node_index.ids(idx[:2]).tolist() == [100500, 100003]
+
+
+def test_empty_index():
+    node_index = NodeIndex(np.array([], dtype=np.int64))
+    assert node_index.index(1) == -1
+    assert node_index.index(np.array([1, 2])).tolist() == [-1, -1]
+
+
+def test_save_load(tmp_path):
+    path = str(tmp_path / 'nodes.npy')
+    NodeIndex(np.array([1, 5, 9], dtype=np.int64), fingerprint='3:12345').save(path)
+    loaded = NodeIndex.load(path)
+    assert loaded.node_ids.tolist() == [1, 5, 9]
+    assert loaded.fingerprint == '3:12345'
+
+
+def test_od_index_columns():
+    node_index = NodeIndex(np.array([10, 20, 30], dtype=np.int64))
+    df = pd.DataFrame({'routeid': [1, 2], 'node_orig': [Decimal(30), Decimal(10)], 'node_dest': [Decimal(20), Decimal(40)]})
+    df = od_node_index(df, node_index)
+    assert df['node_orig'].dtype == np.int64
+    assert df[index_column('node_orig')].tolist() == [2, 0]
+    assert df[index_column('node_dest')].tolist() == [1, -1]
+
+
+def test_od_records():
+    records = np.array([(1, 30, 20), (2, 10, 40)], dtype=[('routeid', 'i8'), ('node_orig', 'i8'), ('node_dest', 'i8')])
+    assert od_records2df(records)['node_orig'].tolist() == [30, 10]
+    df = od_records2df(records, NodeIndex(np.array([10, 20, 30], dtype=np.int64)))
+    assert df['node_dest_idx'].tolist() == [1, -1]
+
+
+def test_node_index_columns(csr_graph, od_df):
+    node_index = NodeIndex(csr_graph.node_ids)
+    indexed = od_node_index(od_df.copy(), node_index)
+    assert_same_routes(route(csr_graph, od_df)[0], route(csr_graph, indexed)[0])
+
+
+def test_node_index_labeled_networkx(csr_graph, nx_graph, od_df):
+    # NetworkX graph labeled by dense node index (create_networkx_object(node_index=...))
+    node_index = NodeIndex(csr_graph.node_ids)
+    labeled = nx.relabel_nodes(nx_graph, {node: int(node_index.index(node)) for node in nx_graph.nodes})
+    labeled.graph['node_ids'] = node_index.node_ids
+    for by_origin in (False, True):
+        assert_same_routes(route(nx_graph, od_df, by_origin=by_origin)[0], route(labeled, od_node_index(od_df.copy(), node_index), by_origin=by_origin)[0])
+
+
+def test_node_index_mismatch(csr_graph, od_df):
+    # index columns from a different node index are rejected
+    shifted = NodeIndex(csr_graph.node_ids[1:])
+    with pytest.raises(ValueError):
+        route(csr_graph, od_node_index(od_df.copy(), shifted))
@@ -0,0 +1,35 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of multi-core routing: the process pool returns the serial results in the same order
+
+# IMPORTS
+import pytest
+from parallel_routing import ParallelRouter, split_by_origin
+from conftest import route
+
+
+# FUNCTIONS
+def test_split_by_origin(od_df):
+    chunks = split_by_origin(od_df, 'node_orig', 4)
+    assert 1 < len(chunks) <= 4
+    assert sum(len(chunk) for chunk in chunks) == len(od_df)
+    # no origin is split across chunks
+    origins = [set(chunk['node_orig']) for chunk in chunks]
+    assert all(origins[i].isdisjoint(origins[j]) for i in range(len(origins)) for j in range(i + 1, len(origins)))
+    assert split_by_origin(od_df.iloc[:0], 'node_orig', 4) == []
+
+
+@pytest.mark.parametrize('graph_name', ['csr_graph', 'nx_graph'])
+def test_parallel_matches_serial(graph_name, od_df, request):
+    graph = request.getfixturevalue(graph_name)
+    serial, serial_errors = route(graph, od_df, by_origin=True)
+
+    with ParallelRouter(graph, processes=2, chunks_per_process=2) as router:
+        p, e = router.find_shortest_route(od_df, 'routeid', 'node_orig', 'node_dest', 'time_walk_sec', walk=True, by_origin=True)
+        # results are gathered in chunk order, so repeated runs return the same lists
+        p_again, e_again = router.find_shortest_route(od_df, 'routeid', 'node_orig', 'node_dest', 'time_walk_sec', walk=True, by_origin=True)
+
+    assert {row['b_routeid']: row for row in p} == serial
+    assert len(p) == len(serial)
+    assert {row['routeid'] for row in e} == set(serial_errors)
+    assert p == p_again
+    assert [row['routeid'] for row in e] == [row['routeid'] for row in e_again]
@@ -0,0 +1,73 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of the path storage formats: varint path and tree encodings, text decoding, routed path formats
+
+# IMPORTS
+from decimal import Decimal
+import numpy as np
+import pytest
+from path_codec import decode_path, decode_path_text, decode_tree, encode_path, encode_tree, format_path, path_from_tree
+from conftest import route
+
+
+# FUNCTIONS
+@pytest.mark.parametrize('path', [
+    [],
+    [100001],
+    [100001, 100002, 100001, 99999, 100500],
+    [0, -5, 2 ** 40, 3],
+    list(np.random.default_rng(0).integers(100000, 999999, 200)),
+])
+def test_path_round_trip(path):
+    blob = encode_path(path)
+    assert isinstance(blob, bytes)
+    assert decode_path(blob) == [int(node) for node in path]
+    assert decode_path(memoryview(blob)) == [int(node) for node in path]
+
+
+def test_path_is_compact():
+    path = list(range(500000, 500100))
+    assert len(encode_path(path)) < len(str(path)) / 4
+
+
+def test_text_round_trip():
+    path = [Decimal('100001'), Decimal('100002'), Decimal('99999')]
+    assert decode_path_text(format_path(path, 'text')) == [100001, 100002, 99999]
+    assert decode_path_text(str([1, -2, 3])) == [1, -2, 3]
+
+
+def test_format_path():
+    path = [Decimal('5'), Decimal('3')]
+    assert format_path(path, 'array') == [5, 3]
+    assert format_path(path, 'list') == path
+    assert format_path(path, None) is None
+    assert decode_path(format_path(path, 'bytea')) == [5, 3]
+    with pytest.raises(ValueError):
+        format_path(path, 'json')
+
+
+def test_tree_round_trip():
+    # tree rooted at 10: 10 <- 12 <- 11, 10 <- 7 <- 30
+    tree = {12: 10, 11: 12, 7: 10, 30: 7}
+    blob = encode_tree(list(tree), list(tree.values()))
+    assert decode_tree(blob) == tree
+    assert path_from_tree(blob, 10, 11) == [10, 12, 11]
+    assert path_from_tree(tree, 10, 30) == [10, 7, 30]
+    assert path_from_tree(tree, 10, 10) == [10]
+    assert path_from_tree(tree, 10, 99) is None
+
+
+@pytest.mark.parametrize('by_origin', [False, True])
+def test_route_path_formats(csr_graph, nx_graph, od_df, by_origin):
+    for graph in (csr_graph, nx_graph):
+        text, _ = route(graph, od_df, by_origin=by_origin)
+        for path_format in ('bytea', 'array', None):
+            other, _ = route(graph, od_df, by_origin=by_origin, path_format=path_format)
+            assert {r: row['walk_time_sec'] for r, row in other.items()} == {r: row['walk_time_sec'] for r, row in text.items()}
+            for routeid, row in other.items():
+                expected = decode_path_text(text[routeid]['walk_path'])
+                if path_format == 'bytea':
+                    assert decode_path(row['walk_path']) == expected
+                elif path_format == 'array':
+                    assert row['walk_path'] == expected
+                else:
+                    assert row['walk_path'] is None
@@ -0,0 +1,56 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of the pipelined fetch/route/write driver: same results as the serial loop, failures of any stage re-raised
+
+# IMPORTS
+from functools import partial
+import pytest
+from network_analysis import find_shortest_route
+from pipeline import run_pipeline
+
+
+# FUNCTIONS
+def batches_of(od_df, size):
+    return [od_df.iloc[k:k + size] for k in range(0, len(od_df), size)]
+
+
+def test_pipeline_matches_serial(csr_graph, od_df):
+    route = partial(find_shortest_route, csr_graph, col_id='routeid', col_orig='node_orig', col_dest='node_dest', col_cost='time_walk_sec', walk=True, by_origin=True)
+    serial = []
+    for od in batches_of(od_df, 100):
+        serial.append(route(od)[0])
+
+    written = []
+    stats = run_pipeline(iter(batches_of(od_df, 100)), route, written.append, queue_size=1)
+
+    # batches are written in order, each with the serial results
+    assert written == serial
+    assert stats['read']['batches'] == stats['route']['batches'] == stats['write']['batches'] == len(serial)
+    assert stats['read']['rows'] == len(od_df)
+    assert stats['errors'] == len(od_df) - sum(len(p) for p in serial)
+
+
+def test_reader_failure():
+    def batches():
+        yield [1, 2]
+        raise RuntimeError('read failed')
+
+    written = []
+    with pytest.raises(RuntimeError, match='read failed'):
+        run_pipeline(batches(), lambda od: (od, []), written.append)
+
+
+def test_writer_failure():
+    def write(paths):
+        raise RuntimeError('write failed')
+
+    # the routing stage stops instead of blocking on the full write queue
+    with pytest.raises(RuntimeError, match='write failed'):
+        run_pipeline(iter([[k] for k in range(20)]), lambda od: (od, []), write, queue_size=1)
+
+
+def test_route_failure():
+    def route(od):
+        raise ValueError('route failed')
+
+    with pytest.raises(ValueError, match='route failed'):
+        run_pipeline(iter([[k] for k in range(20)]), route, lambda paths: None, queue_size=1)
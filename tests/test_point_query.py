@@ -0,0 +1,76 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of the A* point-to-point routes: same travel times as Dijkstra (find_shortest_route()), fewer settled nodes
+
+# IMPORTS
+import math
+import networkx as nx
+import numpy as np
+import pytest
+from csr_graph import CSRGraph
+from point_query import PointRouter, find_shortest_route_astar, max_speed
+from conftest import FIRST_NODE, ISOLATED, MISSING_NODE, make_edges, route
+
+
+# FUNCTIONS
+@pytest.fixture(scope='module')
+def coords_graph():
+    # grid coordinates with some jitter (grid node u is FIRST_NODE + u, row by row)
+    fnode, tnode, costs = make_edges()
+    graph = CSRGraph.from_edges(fnode, tnode, costs)
+    rng = np.random.default_rng(4)
+    u = graph.node_ids - FIRST_NODE
+    graph.coords = np.stack([u // 20 * 100.0, u % 20 * 100.0], axis=1) + rng.uniform(-20, 20, (len(u), 2))
+    return graph
+
+
+@pytest.mark.parametrize('networkx', [False, True])
+def test_astar_matches_dijkstra(coords_graph, od_df, networkx):
+    graph = coords_graph.to_networkx() if networkx else coords_graph
+    router = PointRouter(graph, 'time_walk_sec')
+    p, e = find_shortest_route_astar(router, od_df, 'routeid', 'node_orig', 'node_dest', walk=True)
+    astar = {row['b_routeid']: row for row in p}
+    dijkstra, dijkstra_errors = route(graph, od_df, by_origin=True)
+
+    assert set(astar) == set(dijkstra)
+    assert {err['routeid'] for err in e} == set(dijkstra_errors)
+    for routeid, row in astar.items():
+        assert row['walk_time_sec'] == dijkstra[routeid]['walk_time_sec']
+
+
+def test_astar_settles_fewer_nodes(coords_graph, od_df):
+    router = PointRouter(coords_graph, 'time_walk_sec')
+    plain = PointRouter(coords_graph, 'time_walk_sec')
+    # a heuristic of 0 makes the search plain Dijkstra
+    plain.speed = math.inf
+    settled = [0, 0]
+    for orig, dest in zip(od_df['node_orig'][:100], od_df['node_dest'][:100]):
+        try:
+            path, cost, n = router.route(orig, dest)
+        except (nx.NodeNotFound, nx.NetworkXNoPath):
+            continue
+        plain_path, plain_cost, plain_n = plain.route(orig, dest)
+        assert math.isclose(cost, plain_cost)
+        assert path[0] == orig and path[-1] == dest
+        settled[0] += n
+        settled[1] += plain_n
+    assert settled[0] < settled[1]
+
+
+def test_errors(coords_graph):
+    router = PointRouter(coords_graph, 'time_walk_sec')
+    with pytest.raises(nx.NodeNotFound):
+        router.route(MISSING_NODE, FIRST_NODE)
+    with pytest.raises(nx.NetworkXNoPath):
+        router.route(FIRST_NODE, ISOLATED[0])
+    # graphs without coordinates are rejected
+    with pytest.raises(ValueError):
+        PointRouter(CSRGraph.from_edges(*make_edges(size=3)), 'time_walk_sec')
+
+
+def test_max_speed(coords_graph):
+    speed = max_speed(coords_graph, 'time_walk_sec')
+    assert speed == pytest.approx(max_speed(coords_graph.to_networkx(), 'time_walk_sec'))
+    # no edge is faster than the maximum speed
+    src = np.repeat(np.arange(len(coords_graph.node_ids)), np.diff(coords_graph.indptr))
+    length = np.hypot(*(coords_graph.coords[src] - coords_graph.coords[coords_graph.indices]).T)
+    assert np.all(length <= speed * coords_graph.costs['time_walk_sec'] + 1e-9)
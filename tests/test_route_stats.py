@@ -0,0 +1,103 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of the streaming travel time statistics: merged aggregates vs a single pass, quantile sketch vs numpy
+
+# IMPORTS
+import csv
+import numpy as np
+import pytest
+from network_analysis import find_shortest_route
+from parallel_routing import ParallelRouter
+from route_stats import RouteStats, report_route_stats
+
+
+# FUNCTIONS
+@pytest.fixture
+def values():
+    rng = np.random.default_rng(5)
+    # travel times in seconds, with zeros (origin == destination) and values beyond the last histogram bin
+    return np.concatenate([np.zeros(20), rng.gamma(2.0, 600.0, 5000), [4000.0, 9000.0]])
+
+
+def test_single_pass_matches_numpy(values):
+    stats = RouteStats()
+    for batch in np.array_split(values, 17):
+        stats.add(batch)
+
+    assert stats.count == len(values)
+    assert np.isclose(stats.mean, values.mean())
+    assert np.isclose(stats.std(), values.std(ddof=1))
+    assert stats.min == values.min() and stats.max == values.max()
+    # bins (0, 300], ..., (3300, 3600], 3600+ with 0 in the first bin
+    expected = np.bincount(np.clip(np.ceil(values / 300).astype(int) - 1, 0, 12), minlength=13)
+    assert stats.histogram.tolist() == expected.tolist()
+    assert sum(n for _, n in stats.histogram_rows()) == len(values)
+
+
+def test_merge_matches_single_pass(values):
+    single = RouteStats()
+    single.add(values)
+    merged = RouteStats()
+    for part in np.array_split(values, 5):
+        part_stats = merged.empty()
+        part_stats.add(part)
+        merged.merge(part_stats)
+    merged.merge(merged.empty())
+
+    assert merged.count == single.count
+    assert np.isclose(merged.mean, single.mean)
+    assert np.isclose(merged.m2, single.m2)
+    assert (merged.min, merged.max) == (single.min, single.max)
+    assert merged.histogram.tolist() == single.histogram.tolist()
+    assert (merged.zero_count, merged.buckets) == (single.zero_count, single.buckets)
+    assert merged.summary() == pytest.approx(single.summary())
+
+
+@pytest.mark.parametrize('q', [0.0, 0.01, 0.25, 0.5, 0.9, 0.99, 1.0])
+def test_quantile_relative_error(values, q):
+    stats = RouteStats(alpha=0.01)
+    stats.add(values)
+    # the sketch returns the bucket of the value at rank floor(q * (n - 1))
+    exact = np.quantile(values, q, method='lower')
+    assert abs(stats.quantile(q) - exact) <= 0.01 * exact + 1e-9
+
+
+def test_parallel_chunks_match_serial(csr_graph, od_df):
+    serial = RouteStats()
+    find_shortest_route(csr_graph, od_df, 'routeid', 'node_orig', 'node_dest', 'time_walk_sec', walk=True, stats=serial)
+    parallel = RouteStats()
+    with ParallelRouter(csr_graph, processes=2, chunks_per_process=2) as router:
+        router.find_shortest_route(od_df, 'routeid', 'node_orig', 'node_dest', 'time_walk_sec', walk=True, stats=parallel)
+
+    assert parallel.count == serial.count > 0
+    assert np.isclose(parallel.mean, serial.mean) and np.isclose(parallel.m2, serial.m2)
+    assert parallel.histogram.tolist() == serial.histogram.tolist()
+    assert parallel.buckets == serial.buckets
+
+
+def test_empty_and_settings():
+    stats = RouteStats()
+    stats.add([])
+    assert stats.quantile(0.5) is None and stats.std() is None
+    assert stats.summary()['count'] == 0
+    with pytest.raises(ValueError):
+        stats.merge(RouteStats(bin_width=60))
+
+
+def test_add_routes_skips_budget_misses():
+    stats = RouteStats()
+    stats.add_routes([{'walk_time_sec': 120}, {'walk_time_sec': None}, {'walk_time_sec': 60}], 'walk_time_sec')
+    assert stats.count == 2 and stats.mean == 90
+
+
+def test_report_route_stats(values, tmp_path):
+    walk = RouteStats()
+    walk.add(values)
+    report_route_stats({'walk': walk, 'drive': RouteStats()}, str(tmp_path))
+
+    with open(tmp_path / 'route_stats_summary.csv') as f:
+        rows = list(csv.DictReader(f))
+    # modes without routes are left out
+    assert [row['mode'] for row in rows] == ['walk']
+    assert int(rows[0]['count']) == len(values)
+    with open(tmp_path / 'route_stats_histogram.csv') as f:
+        assert sum(int(row['count']) for row in csv.DictReader(f)) == len(values)
@@ -0,0 +1,66 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of the k-d tree snapping of points to network nodes against a brute force nearest node search
+
+# IMPORTS
+import numpy as np
+import pytest
+
+# db_implementation needs the GIS packages (shapefile ingestion)
+pytest.importorskip('geopandas')
+pytest.importorskip('fiona')
+from db_implementation import nearest_nodes  # noqa: E402
+
+
+# FUNCTIONS
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(0)
+    node_ids = np.arange(100000, 100300)
+    node_xy = rng.uniform(0, 5000, (300, 2))
+    point_xy = rng.uniform(-100, 5100, (200, 2))
+    return node_ids, node_xy, point_xy
+
+
+def brute_force(node_xy, point_xy):
+    dist = np.hypot(point_xy[:, None, 0] - node_xy[None, :, 0], point_xy[:, None, 1] - node_xy[None, :, 1])
+    return dist, np.argsort(dist, axis=1)
+
+
+def test_nearest_matches_brute_force(points):
+    node_ids, node_xy, point_xy = points
+    dist, order = brute_force(node_xy, point_xy)
+    nearest, nearest_dist, cand_ids, cand_dist = nearest_nodes(node_ids, node_xy, point_xy, k=4)
+
+    assert np.array_equal(nearest, node_ids[order[:, 0]])
+    assert np.allclose(nearest_dist, dist[np.arange(len(point_xy)), order[:, 0]])
+    assert cand_ids.shape == (len(point_xy), 4)
+    assert np.array_equal(cand_ids, node_ids[order[:, :4]])
+    assert np.allclose(cand_dist, np.sort(dist, axis=1)[:, :4])
+
+
+def test_valid_nodes(points):
+    node_ids, node_xy, point_xy = points
+    valid = node_ids[::7]
+    dist, order = brute_force(node_xy, point_xy)
+    nearest, nearest_dist, _, _ = nearest_nodes(node_ids, node_xy, point_xy, k=3, valid_nodes=valid)
+
+    # nearest valid node, among the candidates or from the fallback search
+    dist_valid = np.where(np.isin(node_ids, valid)[None, :], dist, np.inf)
+    assert np.array_equal(nearest, node_ids[dist_valid.argmin(axis=1)])
+    assert np.allclose(nearest_dist, dist_valid.min(axis=1))
+
+
+def test_k_larger_than_nodes(points):
+    node_ids, node_xy, point_xy = points
+    nearest, _, cand_ids, cand_dist = nearest_nodes(node_ids[:2], node_xy[:2], point_xy, k=5, valid_nodes=node_ids[1:2])
+    assert cand_ids.shape == (len(point_xy), 2)
+    assert np.isfinite(cand_dist).all()
+    assert (nearest == node_ids[1]).all()
+
+
+def test_no_nodes(points):
+    node_ids, node_xy, point_xy = points
+    with pytest.raises(ValueError):
+        nearest_nodes(node_ids[:0], node_xy[:0], point_xy)
+    with pytest.raises(ValueError):
+        nearest_nodes(node_ids, node_xy, point_xy, valid_nodes=[1])
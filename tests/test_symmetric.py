@@ -0,0 +1,67 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of symmetric O-D pair routing: one search per unordered node pair, result copied to the opposite direction
+
+# IMPORTS
+import numpy as np
+import pytest
+from csr_graph import CSRGraph
+from network_analysis import find_shortest_route, route_symmetric_pairs, whole_pair_batches
+from path_codec import decode_path_text
+from conftest import make_edges, route
+
+
+# FUNCTIONS
+@pytest.mark.parametrize('symmetric', [True, 'canonical'])
+@pytest.mark.parametrize('graph_name', ['csr_graph', 'nx_graph'])
+def test_symmetric_matches_pairwise(graph_name, od_df, symmetric, request):
+    graph = request.getfixturevalue(graph_name)
+    plain, plain_errors = route(graph, od_df, by_origin=True)
+    shared, shared_errors = route(graph, od_df, by_origin=True, symmetric=symmetric)
+
+    assert set(shared) == set(plain)
+    assert set(shared_errors) == set(plain_errors)
+    for routeid, row in shared.items():
+        assert row['walk_time_sec'] == plain[routeid]['walk_time_sec']
+        path = decode_path_text(row['walk_path'])
+        orig, dest = od_df.loc[od_df['routeid'] == routeid, ['node_orig', 'node_dest']].iloc[0]
+        assert path[0] == orig and path[-1] == dest
+
+
+def test_symmetric_routes_each_pair_once(csr_graph, od_df):
+    calls = []
+
+    def route_batch(routes_df, *args, **kwargs):
+        calls.append(routes_df)
+        return find_shortest_route(csr_graph, routes_df, *args, **kwargs)
+
+    route_symmetric_pairs(route_batch, od_df, 'routeid', 'node_orig', 'node_dest', 'time_walk_sec', walk=True)
+    routed = calls[0]
+    pairs = {frozenset((int(o), int(d))) for o, d in zip(od_df['node_orig'], od_df['node_dest'])}
+    assert len(pairs) < len(od_df)
+    assert len(routed) == len(pairs)
+
+
+def test_symmetric_needs_undirected_graph(od_df):
+    fnode, tnode, costs = make_edges(size=5)
+    directed = CSRGraph.from_edges(fnode, tnode, costs, directed=True)
+    with pytest.raises(ValueError):
+        route(directed, od_df, symmetric=True)
+
+
+@pytest.mark.parametrize('batch_size', [1, 2, 3, 7, 50])
+def test_whole_pair_batches(od_df, batch_size):
+    # records ordered as stream_od_routes(symmetric=True), fetched in fixed-size batches
+    lo = np.minimum(od_df['node_orig'].astype(np.int64), od_df['node_dest'].astype(np.int64))
+    hi = np.maximum(od_df['node_orig'].astype(np.int64), od_df['node_dest'].astype(np.int64))
+    order = np.lexsort((od_df['routeid'], hi, lo))
+    records = np.array([(int(r), int(o), int(d)) for r, o, d in od_df[['routeid', 'node_orig', 'node_dest']].to_numpy()[order]],
+                       dtype=[('routeid', np.int64), ('node_orig', np.int64), ('node_dest', np.int64)])
+    batches = list(whole_pair_batches(records[c:c + batch_size] for c in range(0, len(records), batch_size)))
+
+    # same rows in the same order, every pair in exactly one batch
+    assert np.array_equal(np.concatenate(batches), records)
+    seen = set()
+    for batch in batches:
+        pairs = {frozenset((o, d)) for o, d in zip(batch['node_orig'].tolist(), batch['node_dest'].tolist())}
+        assert not pairs & seen
+        seen |= pairs
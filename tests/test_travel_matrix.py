@@ -0,0 +1,60 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of the dense on-disk travel time matrix: values equal Dijkstra, lookups by node ID
+
+# IMPORTS
+import numpy as np
+import pytest
+from scipy.sparse.csgraph import dijkstra
+from travel_matrix import TravelMatrix, write_travel_matrix
+from conftest import ISOLATED, MISSING_NODE
+
+
+# FUNCTIONS
+@pytest.fixture(scope='module')
+def nodes(csr_graph):
+    origins = np.sort(np.append(csr_graph.node_ids[::23], MISSING_NODE))
+    destinations = np.sort(np.append(csr_graph.node_ids[::31], ISOLATED[1]))
+    return origins, destinations
+
+
+def expected_times(csr_graph, origins, destinations):
+    found = csr_graph.index(origins) >= 0
+    expected = np.full((len(origins), len(destinations)), np.inf)
+    dist = dijkstra(csr_graph.matrix('time_walk_sec'), indices=csr_graph.index(origins[found]))
+    expected[found] = dist[:, csr_graph.index(destinations)]
+    return expected.astype(np.float32)
+
+
+@pytest.mark.parametrize('graph_name', ['csr_graph', 'nx_graph'])
+def test_matrix_matches_dijkstra(graph_name, csr_graph, nodes, tmp_path, request):
+    graph = request.getfixturevalue(graph_name)
+    origins, destinations = nodes
+    path = write_travel_matrix(graph, origins, destinations, 'time_walk_sec', str(tmp_path), 'walk', chunk_size=4)
+
+    matrix = np.load(path)
+    expected = expected_times(csr_graph, origins, destinations)
+    assert matrix.dtype == np.float32 and matrix.shape == expected.shape
+    # nodes not in the graph and unreachable pairs are inf
+    assert np.isinf(matrix[origins.tolist().index(MISSING_NODE)]).all()
+    assert np.isinf(matrix[:, -1]).all()
+    assert np.array_equal(np.isinf(matrix), np.isinf(expected))
+    assert np.allclose(matrix[np.isfinite(expected)], expected[np.isfinite(expected)])
+
+
+def test_lookups(csr_graph, nodes, tmp_path):
+    origins, destinations = nodes
+    write_travel_matrix(csr_graph, origins, destinations, 'time_walk_sec', str(tmp_path), 'walk')
+    tm = TravelMatrix(str(tmp_path), 'walk')
+    expected = expected_times(csr_graph, origins, destinations)
+
+    assert tm.time(origins[1], destinations[2]) == expected[1, 2]
+    with pytest.raises(KeyError):
+        tm.time(origins[1], 12345678)
+    times = tm.times([origins[3], origins[0], 12345678], [destinations[0], destinations[4], destinations[0]])
+    assert times[0] == expected[3, 0] and times[1] == expected[0, 4]
+    assert np.isnan(times[2])
+
+
+def test_unsorted_nodes(csr_graph, tmp_path):
+    with pytest.raises(ValueError):
+        write_travel_matrix(csr_graph, csr_graph.node_ids[[5, 1]], csr_graph.node_ids[:3], 'time_walk_sec', str(tmp_path), 'walk')
@@ -0,0 +1,101 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Tests of the distributed routing worker: batch ownership SQL, lease heartbeat, and the claim/route/write loop
+# (the ledger functions are replaced by an in-memory ledger, the ledger itself needs Postgres)
+
+# IMPORTS
+import time
+import pandas as pd
+import pytest
+import worker
+from util import LeaseLostError, finish_batch_sql, owner_sql
+
+
+# FUNCTIONS
+def test_owner_sql():
+    assert owner_sql(None) == ""
+    assert owner_sql('host-1:42') == " AND worker = 'host-1:42' AND status = 'running'"
+    # quotes in worker names are escaped
+    assert owner_sql("o'neil") == " AND worker = 'o''neil' AND status = 'running'"
+
+
+def test_finish_batch_sql_worker():
+    # a worker only finishes a batch it still holds
+    assert finish_batch_sql('esco', 'od_batches', 7, 3, 'host-1:42').endswith("WHERE batchid = 7 AND worker = 'host-1:42' AND status = 'running';")
+
+
+def test_heartbeat_renews_lease(monkeypatch):
+    calls = []
+    monkeypatch.setattr(worker, 'renew_lease', lambda *args: calls.append(args) or True)
+    heartbeat = worker.LeaseHeartbeat(None, 'esco', 'od_batches', 7, 'host-1:42', 0.03)
+    heartbeat.start()
+    time.sleep(0.1)
+    heartbeat.stop()
+    n_calls = len(calls)
+    assert n_calls >= 2
+    assert calls[0] == (None, 'esco', 'od_batches', 7, 'host-1:42', 0.03)
+    # no renewals after stop()
+    time.sleep(0.05)
+    assert len(calls) == n_calls
+
+
+@pytest.mark.parametrize('renewal', ['lost', 'error'])
+def test_heartbeat_lost_lease(monkeypatch, renewal):
+    calls = []
+
+    def renew_lease(*args):
+        calls.append(args)
+        if renewal == 'error':
+            raise RuntimeError('connection reset')
+        return False
+
+    monkeypatch.setattr(worker, 'renew_lease', renew_lease)
+    heartbeat = worker.LeaseHeartbeat(None, 'esco', 'od_batches', 7, 'host-1:42', 0.03)
+    heartbeat.start()
+    time.sleep(0.1)
+    heartbeat.stop()
+    # a lost lease stops the renewals, a failed renewal is retried
+    assert len(calls) == 1 if renewal == 'lost' else len(calls) >= 2
+
+
+@pytest.fixture
+def ledger(monkeypatch):
+    """
+    In-memory batch ledger: batch 1 is routed, batch 2 fails routing, batch 3 loses its lease while written
+    """
+    batches = [{'batchid': i, 'first_routeid': 10 * i, 'last_routeid': 10 * i + 9, 'attempts': 1} for i in (1, 2, 3)]
+    state = {'failed': [], 'written': []}
+    monkeypatch.setattr(worker, 'claim_batch', lambda *args: batches.pop(0) if batches else None)
+    monkeypatch.setattr(worker, 'count_batches', lambda *args: 0)
+    monkeypatch.setattr(worker, 'renew_lease', lambda *args: True)
+    monkeypatch.setattr(worker, 'get_od_batch', lambda dbparams, schema, table, first, last, walk, node_index:
+                        pd.DataFrame({'routeid': range(first, last + 1)}))
+
+    def fail_batch(dbparams, ledger_schema, ledger_table, batchid, message, worker_id):
+        state['failed'].append((batchid, str(message), worker_id))
+        return True
+
+    monkeypatch.setattr(worker, 'fail_batch', fail_batch)
+    return state
+
+
+def test_run_worker(ledger):
+    def route_batch(od):
+        if od['routeid'].iloc[0] == 20:
+            raise ValueError('bad batch')
+        return list(od['routeid']), []
+
+    def write_batch(paths, post_sql):
+        if paths[0] == 30:
+            raise LeaseLostError('batch 3')
+        ledger['written'].append((paths, post_sql))
+
+    n_batches = worker.run_worker(None, 'esco', 'od_batches', 'esco', 'od_routes', 'walk', route_batch, write_batch,
+                                  lease_seconds=60, worker='host-1:42')
+    assert n_batches == 3
+    # results and 'done' status of batch 1 in one write
+    assert len(ledger['written']) == 1
+    paths, post_sql = ledger['written'][0]
+    assert paths == list(range(10, 20))
+    assert post_sql == finish_batch_sql('esco', 'od_batches', 1, 0, 'host-1:42')
+    # the routing failure is recorded, the lost lease is not
+    assert ledger['failed'] == [(2, 'bad batch', 'host-1:42')]
@@ -0,0 +1,158 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Functions related to the dense on-disk travel time matrix (memory-mapped numpy arrays) and its lookup API
+
+# IMPORTS
+import os
+import numpy as np
+import networkx as nx
+from scipy.sparse.csgraph import dijkstra
+from csr_graph import CSRGraph
+from contraction_hierarchy import ContractionHierarchy
+from util import db_connection, read_sql
+
+
+# FUNCTIONS
+def get_matrix_nodes(dbparams, nodes_schema, nodes_table):
+    """
+    Return the origin (res or poi) and destination (poi) node IDs of the travel matrix from a Postgres nodes table with
+    the following columns:
+        nodeid, res, poi
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param nodes_schema: String containing database schema name
+    :param nodes_table: String containing database table name
+    :return: 2 sorted numpy int64 arrays: origin node IDs and destination node IDs
+    """
+    # SQL to return res and poi nodes
+    sql_str = "SELECT nodeid::BIGINT AS nodeid, res, poi from {}.{} WHERE res = 1 OR poi = 1 ORDER by nodeid;".format(nodes_schema, nodes_table)
+
+    # connect to database
+    with db_connection(dbparams) as conn:
+        df = read_sql(sql_str, conn)
+
+    origins = df['nodeid'].to_numpy(dtype=np.int64)
+    destinations = df.loc[df['poi'] == 1, 'nodeid'].to_numpy(dtype=np.int64)
+
+    return origins, destinations
+
+
+def write_travel_matrix(graph, origins, destinations, col_cost, matrix_dir, name, chunk_size=256):
+    """
+    Compute the origin x destination travel times and write them to a memory-mapped float32 numpy file
+    ({matrix_dir}/{name}.npy), with origins.npy and destinations.npy sidecar arrays mapping node IDs to rows/columns.
+    Unreachable pairs are stored as inf. Only chunk_size rows are held in memory at a time.
+    :param graph: NetworkX graph object (create_networkx_object()), CSRGraph object (create_csr_graph()), or
+        ContractionHierarchy (build_contraction_hierarchy(), col_cost is ignored)
+    :param origins: Array of origin node IDs (get_matrix_nodes())
+    :param destinations: Array of destination node IDs (get_matrix_nodes())
+    :param col_cost: String containing name of weight column ('time_drive_sec' or 'time_walk_sec')
+    :param matrix_dir: String containing path to the output directory
+    :param name: String containing name of the matrix ('walk', 'drive')
+    :param chunk_size: (optional) Number of origin rows computed per step
+    :return: String containing path to the matrix file
+    """
+    origins = np.asarray(origins, dtype=np.int64)
+    destinations = np.asarray(destinations, dtype=np.int64)
+
+    # node index sidecars (sorted, so lookups can use binary search)
+    os.makedirs(matrix_dir, exist_ok=True)
+    if np.any(np.diff(origins) < 0) or np.any(np.diff(destinations) < 0):
+        raise ValueError('Origin and destination node IDs must be sorted')
+    np.save(os.path.join(matrix_dir, 'origins.npy'), origins)
+    np.save(os.path.join(matrix_dir, 'destinations.npy'), destinations)
+
+    # memory-mapped output matrix
+    matrix_path = os.path.join(matrix_dir, '{}.npy'.format(name))
+    matrix = np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float32, shape=(len(origins), len(destinations)))
+
+    # contraction hierarchy: destination buckets built once, one bucket query per chunk of origins
+    if isinstance(graph, ContractionHierarchy):
+        buckets = graph.buckets(destinations)
+        for c in range(0, len(origins), chunk_size):
+            rows = np.arange(c, min(c + chunk_size, len(origins)))
+            matrix[rows] = graph.many_to_many(origins[rows], destinations, buckets=buckets)
+    # array-backed graph: one csgraph call per chunk of origins
+    elif isinstance(graph, CSRGraph):
+        orig_idx = graph.index(origins)
+        dest_idx = graph.index(destinations)
+        dest_found = dest_idx >= 0
+        weights = graph.matrix(col_cost)
+        for c in range(0, len(origins), chunk_size):
+            rows = np.arange(c, min(c + chunk_size, len(origins)))
+            block = np.full((len(rows), len(destinations)), np.inf, dtype=np.float32)
+            found = orig_idx[rows] >= 0
+            if np.any(found):
+                dist = dijkstra(weights, directed=True, indices=orig_idx[rows][found])
+                block[np.ix_(np.flatnonzero(found), np.flatnonzero(dest_found))] = dist[:, dest_idx[dest_found]]
+            matrix[rows] = block
+    # NetworkX graph: one single-source search per origin
+    else:
+        dest_col = {dest: k for k, dest in enumerate(destinations.tolist())}
+        for r, orig in enumerate(origins.tolist()):
+            row = np.full(len(destinations), np.inf, dtype=np.float32)
+            if graph.has_node(orig):
+                for node, time in nx.single_source_dijkstra_path_length(graph, orig, weight=col_cost).items():
+                    k = dest_col.get(int(node))
+                    if k is not None:
+                        row[k] = time
+            matrix[r] = row
+
+    matrix.flush()
+    del matrix
+
+    return matrix_path
+
+
+# CLASSES
+class TravelMatrix:
+    """
+    Read-only lookups in a travel time matrix written by write_travel_matrix().
+    The matrix is memory-mapped, so only the pages touched by a lookup are read from disk.
+    """
+    def __init__(self, matrix_dir, name):
+        """
+        :param matrix_dir: String containing path to the matrix directory
+        :param name: String containing name of the matrix ('walk', 'drive')
+        """
+        self.origins = np.load(os.path.join(matrix_dir, 'origins.npy'))
+        self.destinations = np.load(os.path.join(matrix_dir, 'destinations.npy'))
+        self.matrix = np.load(os.path.join(matrix_dir, '{}.npy'.format(name)), mmap_mode='r')
+        # node ID -> row/column (O(1) scalar lookups)
+        self.orig_row = {node: k for k, node in enumerate(self.origins.tolist())}
+        self.dest_col = {node: k for k, node in enumerate(self.destinations.tolist())}
+
+    def time(self, orig, dest):
+        """
+        Travel time between one origin and one destination node
+        :param orig: Origin node ID
+        :param dest: Destination node ID
+        :return: Float travel time in seconds (inf if unreachable), raises KeyError for nodes not in the matrix
+        """
+        return float(self.matrix[self.orig_row[int(orig)], self.dest_col[int(dest)]])
+
+    def times(self, origs, dests):
+        """
+        Vectorized travel times for aligned arrays of origin and destination node IDs
+        :param origs: Array of origin node IDs
+        :param dests: Array of destination node IDs (same length as origs)
+        :return: Numpy float32 array of travel times in seconds (inf if unreachable, nan if a node is not in the matrix)
+        """
+        rows = self._lookup(self.origins, origs)
+        cols = self._lookup(self.destinations, dests)
+        out = np.full(len(rows), np.nan, dtype=np.float32)
+        found = (rows >= 0) & (cols >= 0)
+        out[found] = self.matrix[rows[found], cols[found]]
+        return out
+
+    @staticmethod
+    def _lookup(sorted_ids, nodes):
+        """
+        Binary search of node IDs in a sorted sidecar array
+        :param sorted_ids: Sorted numpy array of node IDs
+        :param nodes: Array of node IDs
+        :return: Numpy array of positions (-1 if not found)
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        if len(sorted_ids) == 0:
+            return np.full(len(nodes), -1)
+        pos = np.minimum(np.searchsorted(sorted_ids, nodes), len(sorted_ids) - 1)
+        return np.where(sorted_ids[pos] == nodes, pos, -1)
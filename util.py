@@ -2,9 +2,24 @@
 # Functions related to Python package utility
 
 # IMPORTS
-from sqlalchemy import create_engine
+from contextlib import contextmanager
+import logging
+import warnings
+import pandas as pd
+import sqlalchemy
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Connection, Engine
 import psycopg2
 import sys
+from instrumentation import METRICS
+
+logger = logging.getLogger(__name__)
+
+# shared engines (connection pools), keyed by database connection parameters
+_ENGINES = {}
+
+# pandas >= 2.2 only recognizes SQLAlchemy 2 connections (see read_sql())
+_SQLALCHEMY_2 = int(sqlalchemy.__version__.split('.')[0]) >= 2
 
 
 # FUNCTIONS
@@ -18,33 +33,112 @@ def psycopg2_connect(dbparams):
     conn = None
     try:
         # connect to the PostgreSQL server
-        print('Connecting to the PostgreSQL database...')
+        logger.info('Connecting to the PostgreSQL database...')
         conn = psycopg2.connect(**dbparams)
 
     except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
+        logger.error(error)
         sys.exit(1)
     return conn
 
 
-def sqlalchemy_engine(dbparams):
+def sqlalchemy_engine(dbparams, pool_size=5, max_overflow=10, pool_pre_ping=True):
     """
-    Connect to a PostgreSQL database using SQLAlchemy
-    :param dbparams: dictionary containing database log in information (user, password, host, port, dbname)
+    Connect to a PostgreSQL database using SQLAlchemy. Engines are created lazily and shared process-wide, one per set
+    of connection parameters, so every helper reuses the same connection pool.
+    :param dbparams: dictionary containing database log in information (user, password, host, port, dbname), or a
+        SQLAlchemy engine/connection (returned as is)
+    :param pool_size: (optional) Number of connections kept open in the pool (used when the engine is created)
+    :param max_overflow: (optional) Number of extra connections allowed above pool_size (used when the engine is created)
+    :param pool_pre_ping: (optional) Boolean, if True - test each pooled connection before use (used when the engine is created)
     :return: SQLAlchemy engine
     """
-    # create enging for database connection
-    engine = create_engine(
-        "postgresql+psycopg2://{}:{}@{}:{}/{}".format(
-            dbparams['user'], dbparams['password'], dbparams['host'], dbparams['port'], dbparams['dbname']))
+    # already an engine or connection
+    if isinstance(dbparams, (Engine, Connection)):
+        return dbparams
+
+    key = tuple(sorted(dbparams.items()))
+    if key not in _ENGINES:
+        # create engine for database connection
+        _ENGINES[key] = create_engine(
+            "postgresql+psycopg2://{}:{}@{}:{}/{}".format(
+                dbparams['user'], dbparams['password'], dbparams['host'], dbparams['port'], dbparams['dbname']),
+            pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=pool_pre_ping)
+
+    return _ENGINES[key]
+
+
+def dispose_engines():
+    """
+    Close all pooled connections and forget the shared engines (e.g. in a forked child process)
+    :return: None
+    """
+    for engine in _ENGINES.values():
+        engine.dispose()
+    _ENGINES.clear()
+
+    return
+
+
+@contextmanager
+def db_connection(dbparams):
+    """
+    Context manager yielding a SQLAlchemy connection from the shared pool (sqlalchemy_engine()).
+    A connection passed in is yielded as is and left open.
+    :param dbparams: dictionary containing database log in information (user, password, host, port, dbname), or a
+        SQLAlchemy engine/connection
+    :return: SQLAlchemy connection
+    """
+    if isinstance(dbparams, Connection):
+        yield dbparams
+    else:
+        # time spent waiting for a pooled connection
+        with METRICS.timer('db_connect'):
+            conn = sqlalchemy_engine(dbparams).connect()
+        with conn:
+            yield conn
 
-    return engine
+
+@contextmanager
+def db_raw_connection(dbparams):
+    """
+    Context manager yielding a psycopg2 (DBAPI) connection from the shared pool, for COPY and server-side cursors.
+    The connection goes back to the pool on exit. A SQLAlchemy connection passed in lends its DBAPI connection.
+    :param dbparams: dictionary containing database log in information (user, password, host, port, dbname), or a
+        SQLAlchemy engine/connection
+    :return: psycopg2 connection
+    """
+    if isinstance(dbparams, Connection):
+        yield dbparams.connection
+    else:
+        with METRICS.timer('db_connect'):
+            conn = sqlalchemy_engine(dbparams).raw_connection()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+
+def read_sql(sql_str, conn):
+    """
+    pandas.read_sql() on a SQLAlchemy connection (db_connection()). With SQLAlchemy 1.4, which pandas >= 2.2 no longer
+    recognizes, the query runs on the DBAPI connection underneath (same connection and transaction)
+    :param sql_str: String containing SQL query
+    :param conn: SQLAlchemy connection
+    :return: Pandas dataframe
+    """
+    if _SQLALCHEMY_2 or not isinstance(conn, Connection):
+        return pd.read_sql(sql_str, conn)
+    with warnings.catch_warnings():
+        # pandas warns about DBAPI connections other than sqlite3
+        warnings.filterwarnings('ignore', message='pandas only supports SQLAlchemy', category=UserWarning)
+        return pd.read_sql(sql_str, conn.connection)
 
 
 def get_next_routeid(dbparams, dbschema, dbtable, walk=False):
     """
     Return the next routeid for shortest path analysis (first route id in dataframe from get_od_routes())
-    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname)
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
     :param dbschema: String containing database schema name
     :param dbtable: String containing database table name
     :param walk: Boolean, True if walking routes and False for driving routes
@@ -60,15 +154,228 @@ def get_next_routeid(dbparams, dbschema, dbtable, walk=False):
         sql_str2 = "SELECT routeid from {}.{} ORDER by routeid LIMIT 1;".format(dbschema, dbtable)
 
     # connect to database
-    engine = sqlalchemy_engine(dbparams)
-    with engine.connect() as conn:
+    with db_connection(dbparams) as conn:
         try:
             # get next null routeid
             result = conn.execute(sql_str)
             id = result.fetchall()[0][0]
         except Exception as e:
-            print(e)
+            logger.warning(e)
             # get first routeid
             result = conn.execute(sql_str2)
             id = result.fetchall()[0][0]
     return id
+
+
+def create_batch_ledger(dbparams, ledger_schema, ledger_table, routes_schema, routes_table, mode, batch_size):
+    """
+    Create a batch ledger table (if it does not exist) and split the O-D routes of one mode into batches of consecutive
+    routeids. Batches are only added if the ledger has none for this mode, so the function is safe to rerun on resume
+    and to call from several workers at once (the setup runs under a transaction-level advisory lock).
+    Ledger columns:
+        batchid, mode, first_routeid, last_routeid, n_routes, status (pending, running, done, failed), attempts,
+        n_errors, started_at, finished_at, seconds, message, worker, lease_expires
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param ledger_schema: String containing database schema name of the ledger table
+    :param ledger_table: String containing database table name of the ledger table
+    :param routes_schema: String containing database schema name of the O-D routes table
+    :param routes_table: String containing database table name of the O-D routes table
+    :param mode: String containing travel mode ('walk' or 'drive'), walk batches only include routes with walk = 1
+    :param batch_size: Number of routes per batch
+    :return: None
+    """
+    # SQL to create the ledger table and its index on (mode, status)
+    sql_create = "CREATE TABLE IF NOT EXISTS {}.{} (batchid SERIAL PRIMARY KEY, mode TEXT NOT NULL, first_routeid INT NOT NULL, last_routeid INT NOT NULL, n_routes INT, " \
+                 "status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'running', 'done', 'failed')), attempts INT NOT NULL DEFAULT 0, " \
+                 "n_errors INT, started_at TIMESTAMP, finished_at TIMESTAMP, seconds FLOAT8, message TEXT, worker TEXT, lease_expires TIMESTAMP);".format(ledger_schema, ledger_table)
+    # SQL to add the lease columns to a ledger created before leases existed
+    sql_lease = "ALTER TABLE {}.{} ADD COLUMN IF NOT EXISTS worker TEXT, ADD COLUMN IF NOT EXISTS lease_expires TIMESTAMP;".format(ledger_schema, ledger_table)
+    sql_index = "CREATE INDEX IF NOT EXISTS {}_mode_status_idx ON {}.{} (mode, status, batchid);".format(ledger_table, ledger_schema, ledger_table)
+
+    # SQL to split the routes into batches of batch_size consecutive routeids
+    where_str = "WHERE walk = 1" if mode == 'walk' else ""
+    sql_batches = "INSERT INTO {}.{} (mode, first_routeid, last_routeid, n_routes) " \
+                  "SELECT '{}', MIN(routeid), MAX(routeid), COUNT(*) FROM (SELECT routeid, (ROW_NUMBER() OVER (ORDER BY routeid) - 1) / {} AS b FROM {}.{} {}) AS t " \
+                  "WHERE NOT EXISTS (SELECT 1 FROM {}.{} WHERE mode = '{}') GROUP BY b ORDER BY b;".format(
+                      ledger_schema, ledger_table, mode, batch_size, routes_schema, routes_table, where_str, ledger_schema, ledger_table, mode)
+
+    # SQL to serialize concurrent setups (held until commit)
+    sql_lock = "SELECT pg_advisory_xact_lock(hashtext('{}.{}'));".format(ledger_schema, ledger_table)
+
+    # connect to database
+    with db_connection(dbparams) as conn, conn.begin():
+        conn.execute(sql_lock)
+        conn.execute(sql_create)
+        conn.execute(sql_lease)
+        conn.execute(sql_index)
+        conn.execute(sql_batches)
+
+    return
+
+
+def reset_running_batches(dbparams, ledger_schema, ledger_table, mode):
+    """
+    Return batches left 'running' by a crashed run to 'pending' (single-driver resume)
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param ledger_schema: String containing database schema name of the ledger table
+    :param ledger_table: String containing database table name of the ledger table
+    :param mode: String containing travel mode ('walk' or 'drive')
+    :return: None
+    """
+    sql_str = "UPDATE {}.{} SET status = 'pending' WHERE mode = '{}' AND status = 'running';".format(ledger_schema, ledger_table, mode)
+
+    # connect to database
+    with db_connection(dbparams) as conn:
+        conn.execute(sql_str)
+
+    return
+
+
+def claim_batch(dbparams, ledger_schema, ledger_table, mode, max_attempts=3, worker=None, lease_seconds=None):
+    """
+    Claim the next batch to route: the first pending batch, a failed batch with fewer than max_attempts attempts, or a
+    running batch whose lease has expired (crashed worker). Running batches whose lease expired on the last attempt are
+    marked failed. Uses the (mode, status) index, so resuming is a single index
+    lookup instead of a scan of the routes table. Rows locked by another worker's claim are skipped (SKIP LOCKED), so
+    any number of workers can claim batches concurrently without blocking each other or claiming the same batch.
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param ledger_schema: String containing database schema name of the ledger table
+    :param ledger_table: String containing database table name of the ledger table
+    :param mode: String containing travel mode ('walk' or 'drive')
+    :param max_attempts: (optional) Maximum number of attempts per batch (failed batches are retried automatically)
+    :param worker: (optional) String identifying the claiming worker (e.g. 'host:pid'), stored in the ledger
+    :param lease_seconds: (optional) Lease length in seconds, the batch can be reclaimed by another worker once the lease
+        expires without renewal (renew_lease()). None: no lease (single driver, see reset_running_batches())
+    :return: Dictionary with batchid, first_routeid, last_routeid, and attempts, or None if no batch is left
+    """
+    lease_str = "now() + INTERVAL '{} seconds'".format(lease_seconds) if lease_seconds is not None else "NULL"
+    # SQL to give up batches whose last attempt ended with an expired lease (never claimable again, see count_batches())
+    sql_expire = text("UPDATE {}.{} SET status = 'failed', finished_at = now(), message = 'lease expired after ' || attempts || ' attempts' " \
+                      "WHERE mode = :mode AND status = 'running' AND lease_expires < now() AND attempts >= :max_attempts;".format(ledger_schema, ledger_table))
+    sql_str = text("UPDATE {}.{} SET status = 'running', attempts = attempts + 1, started_at = now(), finished_at = NULL, message = NULL, " \
+                   "worker = :worker, lease_expires = {} " \
+                   "WHERE batchid = (SELECT batchid FROM {}.{} WHERE mode = :mode AND (status = 'pending' OR (status IN ('failed', 'running') AND attempts < :max_attempts " \
+                   "AND (status = 'failed' OR lease_expires < now()))) ORDER BY batchid LIMIT 1 FOR UPDATE SKIP LOCKED) " \
+                   "RETURNING batchid, first_routeid, last_routeid, attempts;".format(ledger_schema, ledger_table, lease_str, ledger_schema, ledger_table))
+
+    # connect to database
+    with db_connection(dbparams) as conn:
+        conn.execute(sql_expire, {'mode': mode, 'max_attempts': max_attempts})
+        row = conn.execute(sql_str, {'worker': worker, 'mode': mode, 'max_attempts': max_attempts}).fetchone()
+
+    if row is None:
+        return None
+    return {'batchid': row[0], 'first_routeid': row[1], 'last_routeid': row[2], 'attempts': row[3]}
+
+
+def renew_lease(dbparams, ledger_schema, ledger_table, batchid, worker, lease_seconds):
+    """
+    Extend the lease of a running batch (heartbeat of a worker, see claim_batch())
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param ledger_schema: String containing database schema name of the ledger table
+    :param ledger_table: String containing database table name of the ledger table
+    :param batchid: Integer ID of the batch (claim_batch())
+    :param worker: String identifying the worker holding the lease
+    :param lease_seconds: New lease length in seconds (from now)
+    :return: Boolean, False if the worker no longer holds the batch (lease expired and the batch was reclaimed)
+    """
+    sql_str = text("UPDATE {}.{} SET lease_expires = now() + INTERVAL '{} seconds' WHERE batchid = :batchid AND worker = :worker AND status = 'running' RETURNING batchid;".format(
+        ledger_schema, ledger_table, lease_seconds))
+
+    # connect to database
+    with db_connection(dbparams) as conn:
+        row = conn.execute(sql_str, {'batchid': batchid, 'worker': worker}).fetchone()
+
+    return row is not None
+
+
+def count_batches(dbparams, ledger_schema, ledger_table, mode, status):
+    """
+    Count the batches of one mode with a given status in the batch ledger
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param ledger_schema: String containing database schema name of the ledger table
+    :param ledger_table: String containing database table name of the ledger table
+    :param mode: String containing travel mode ('walk' or 'drive')
+    :param status: String containing batch status ('pending', 'running', 'done', or 'failed')
+    :return: Integer number of batches
+    """
+    sql_str = "SELECT count(*) FROM {}.{} WHERE mode = '{}' AND status = '{}';".format(ledger_schema, ledger_table, mode, status)
+
+    # connect to database
+    with db_connection(dbparams) as conn:
+        n = conn.execute(sql_str).fetchone()[0]
+
+    return n
+
+
+def owner_sql(worker):
+    """
+    SQL condition restricting a ledger update to the worker holding a running batch (None: no condition)
+    :param worker: String identifying the worker (claim_batch()), or None
+    :return: String containing SQL condition (starting with AND), or an empty string
+    """
+    if worker is None:
+        return ""
+    return " AND worker = '{}' AND status = 'running'".format(worker.replace("'", "''"))
+
+
+def finish_batch_sql(ledger_schema, ledger_table, batchid, n_errors=0, worker=None):
+    """
+    SQL to mark a batch done (run it in the same transaction as the batch's results, see routes2dbtable_copy()). With a
+    worker, the statement updates no row if the worker lost the batch's lease (routes2dbtable_copy() raises LeaseLostError).
+    :param ledger_schema: String containing database schema name of the ledger table
+    :param ledger_table: String containing database table name of the ledger table
+    :param batchid: Integer ID of the batch (claim_batch())
+    :param n_errors: (optional) Number of failed routes in the batch (find_shortest_route())
+    :param worker: (optional) String identifying the worker that must still hold the batch
+    :return: String containing SQL statement
+    """
+    return "UPDATE {}.{} SET status = 'done', n_errors = {}, finished_at = now(), seconds = EXTRACT(EPOCH FROM now() - started_at) WHERE batchid = {}{};".format(
+        ledger_schema, ledger_table, n_errors, batchid, owner_sql(worker))
+
+
+def finish_batch(dbparams, ledger_schema, ledger_table, batchid, n_errors=0, worker=None):
+    """
+    Mark a batch done in the batch ledger
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param ledger_schema: String containing database schema name of the ledger table
+    :param ledger_table: String containing database table name of the ledger table
+    :param batchid: Integer ID of the batch (claim_batch())
+    :param n_errors: (optional) Number of failed routes in the batch (find_shortest_route())
+    :param worker: (optional) String identifying the worker that must still hold the batch
+    :return: Boolean, False if the worker no longer holds the batch
+    """
+    # connect to database
+    with db_connection(dbparams) as conn:
+        result = conn.execute(finish_batch_sql(ledger_schema, ledger_table, batchid, n_errors, worker))
+
+    return result.rowcount > 0
+
+
+def fail_batch(dbparams, ledger_schema, ledger_table, batchid, message, worker=None):
+    """
+    Mark a batch failed in the batch ledger (it is retried by claim_batch() until max_attempts is reached)
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param ledger_schema: String containing database schema name of the ledger table
+    :param ledger_table: String containing database table name of the ledger table
+    :param batchid: Integer ID of the batch (claim_batch())
+    :param message: Error message
+    :param worker: (optional) String identifying the worker that must still hold the batch
+    :return: Boolean, False if the worker no longer holds the batch (the new owner's status is left unchanged)
+    """
+    sql_str = text("UPDATE {}.{} SET status = 'failed', finished_at = now(), seconds = EXTRACT(EPOCH FROM now() - started_at), message = :message WHERE batchid = :batchid{};".format(
+        ledger_schema, ledger_table, owner_sql(worker)))
+
+    # connect to database
+    with db_connection(dbparams) as conn:
+        result = conn.execute(sql_str, {'message': str(message), 'batchid': batchid})
+
+    return result.rowcount > 0
+
+
+# CLASSES
+class LeaseLostError(RuntimeError):
+    """
+    Raised when a worker's ledger update finds the batch held by another worker (lease expired and reclaimed)
+    """
+    pass
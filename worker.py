@@ -0,0 +1,119 @@
+# Jessica Embury, SDSU, GEOG683 final project, Spring 2022
+# Functions related to distributed routing: any number of worker processes, on any number of hosts, claim O-D batches
+# from the batch ledger (util.create_batch_ledger()) under a lease, so batches of crashed workers are reclaimed
+
+# IMPORTS
+import logging
+import os
+import socket
+import threading
+import time
+from network_analysis import get_od_batch
+from util import claim_batch, renew_lease, count_batches, finish_batch_sql, fail_batch, LeaseLostError
+
+logger = logging.getLogger(__name__)
+
+
+# FUNCTIONS
+def worker_name():
+    """
+    Name identifying this worker process in the batch ledger
+    :return: String '{host name}:{process ID}'
+    """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def run_worker(dbparams, ledger_schema, ledger_table, routes_schema, routes_table, mode, route_batch, write_batch,
+               lease_seconds=600, max_attempts=3, worker=None, poll_seconds=30, node_index=None):
+    """
+    Claim, route, and write batches until the ledger has no batch left for this mode. Each batch's results and its
+    'done' status are committed in one transaction. A heartbeat thread renews the lease while a batch is processed; if
+    the worker dies, the lease expires and another worker reclaims the batch (claim_batch()). Results are written with
+    UPDATE by routeid; a worker that lost its lease can't change the batch's status (its write is rolled back).
+    :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine/connection
+    :param ledger_schema: String containing database schema name of the ledger table
+    :param ledger_table: String containing database table name of the ledger table (create_batch_ledger())
+    :param routes_schema: String containing database schema name of the O-D routes table
+    :param routes_table: String containing database table name of the O-D routes table
+    :param mode: String containing travel mode ('walk' or 'drive')
+    :param route_batch: Function called with one O-D dataframe, returns (paths, errors) (e.g. partial(find_shortest_route, G, ...))
+    :param write_batch: Function called with one paths list and a post_sql keyword argument (e.g. partial(routes2dbtable_copy, ...))
+    :param lease_seconds: (optional) Lease length in seconds, renewed every lease_seconds / 3 seconds
+    :param max_attempts: (optional) Maximum number of attempts per batch
+    :param worker: (optional) String identifying this worker (default: worker_name())
+    :param poll_seconds: (optional) While no batch can be claimed but other workers still hold batches, wait this long
+        and try again (picks up the batches of workers whose lease expires). None: stop as soon as no batch can be claimed
+    :param node_index: (optional) NodeIndex object, O-D batches carry dense node indices (get_od_batch())
+    :return: Integer number of batches processed by this worker
+    """
+    worker = worker or worker_name()
+    n_batches = 0
+
+    while True:
+        batch = claim_batch(dbparams, ledger_schema, ledger_table, mode, max_attempts, worker, lease_seconds)
+        if batch is None:
+            # wait for running batches that may still be reclaimed
+            if poll_seconds is not None and count_batches(dbparams, ledger_schema, ledger_table, mode, 'running') > 0:
+                time.sleep(poll_seconds)
+                continue
+            break
+
+        st = time.time()
+        heartbeat = LeaseHeartbeat(dbparams, ledger_schema, ledger_table, batch['batchid'], worker, lease_seconds)
+        heartbeat.start()
+        try:
+            od = get_od_batch(dbparams, routes_schema, routes_table, batch['first_routeid'], batch['last_routeid'], walk=(mode == 'walk'), node_index=node_index)
+            paths, errors = route_batch(od)
+            # results and 'done' status in one transaction (rolled back if another worker holds the batch now)
+            write_batch(paths, post_sql=finish_batch_sql(ledger_schema, ledger_table, batch['batchid'], len(errors), worker))
+            logger.info('%s: batch %s (%s rows, %s errors) took %.1f seconds', worker, batch['batchid'], len(od), len(errors), time.time() - st)
+        except LeaseLostError:
+            logger.warning('%s: lease of batch %s lost, results discarded', worker, batch['batchid'])
+        except Exception as e_message:
+            if fail_batch(dbparams, ledger_schema, ledger_table, batch['batchid'], e_message, worker):
+                logger.warning('%s: batch %s failed (attempt %s): %s', worker, batch['batchid'], batch['attempts'], e_message)
+            else:
+                logger.warning('%s: batch %s failed after its lease was lost: %s', worker, batch['batchid'], e_message)
+        finally:
+            heartbeat.stop()
+        n_batches += 1
+
+    logger.info('%s: no batches left, %s batches processed', worker, n_batches)
+    return n_batches
+
+
+# CLASSES
+class LeaseHeartbeat:
+    """
+    Background thread renewing the lease of one claimed batch (renew_lease()) until stopped
+    """
+    def __init__(self, dbparams, ledger_schema, ledger_table, batchid, worker, lease_seconds):
+        """
+        :param dbparams: Dictionary containing database log in information (user, password, host, port, dbname), or SQLAlchemy engine
+        :param ledger_schema: String containing database schema name of the ledger table
+        :param ledger_table: String containing database table name of the ledger table
+        :param batchid: Integer ID of the batch (claim_batch())
+        :param worker: String identifying the worker holding the lease
+        :param lease_seconds: Lease length in seconds
+        """
+        self.args = (dbparams, ledger_schema, ledger_table, batchid, worker, lease_seconds)
+        self.interval = lease_seconds / 3
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if not renew_lease(*self.args):
+                    logger.warning('%s: lease of batch %s lost (reclaimed by another worker)', self.args[4], self.args[3])
+                    return
+            except Exception as e_message:
+                # a later renewal may still succeed before the lease expires
+                logger.warning('%s: lease renewal of batch %s failed: %s', self.args[4], self.args[3], e_message)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()